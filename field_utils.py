@@ -28,6 +28,9 @@ __contributors__ = "Aaron Steele, John Wieczorek"
 __copyright__ = "Copyright 2016 vertnet.org"
 __version__ = "field_utils.py 2017-04-07T18:00-3:00"
 
+import re
+from itertools import izip
+
 # NOTE: The field lists here should match exactly those of 
 # https://github.com/VertNet/post-harvest-processor/blob/master/lib/field_utils.py
 
@@ -96,3 +99,60 @@ def index_fields():
     for f in REMOVE_FIELDS:
         indexthese.remove(f)
     return indexthese
+
+# Runs of tabs, vertical tabs, carriage returns, and line feeds in field contents are 
+# replaced with a space. A tab can't be part of a value in a tab-separated row, so a 
+# whole row can be cleaned at once by replacing runs of the others.
+ROW_CONTROL_CHARACTERS = re.compile('[\v\r\n]+')
+
+def decode_row(row, header):
+    """ Split a tab-separated row into its cleaned values in a single pass.
+    parameters:
+        row - a line of a harvest file without the line terminator (required)
+        header - list of the column names of the row (required)
+    returns:
+        a tuple (values, rec) where values is a list with the cleaned value of each 
+        column in header, None for empty or missing columns, and rec is a dictionary of
+        the non-empty columns and their cleaned values
+    """
+    if ROW_CONTROL_CHARACTERS.search(row) is not None:
+        row = ROW_CONTROL_CHARACTERS.sub(' ', row)
+    values = [v.strip(' ') if v else None for v in row.split('\t')]
+    n = len(header)
+    if len(values) < n:
+        values.extend([None] * (n - len(values)))
+    elif len(values) > n:
+        del values[n:]
+    rec = dict([(name, v) for name, v in izip(header, values) if v is not None])
+    return values, rec
+
+def column_positions(columns, header):
+    """ Map the columns of precompiled rows to the columns of header.
+    parameters:
+        columns - list of the column names of the rows (required)
+        header - list of the column names to decode the rows into (required)
+    returns:
+        a list with the position in columns of each column in header, None for those 
+        not in columns, or None if columns is header
+    """
+    if columns == header:
+        return None
+    return [columns.index(name) if name in columns else None for name in header]
+
+def decode_values(values, header, positions=None):
+    """ Turn a row precompiled from the values decode_row returned back into them.
+    parameters:
+        values - sequence of the cleaned values of the row, None for empty columns 
+            (required)
+        header - list of the column names to decode the row into (required)
+        positions - the column_positions of the row, or None if its columns are 
+            header (optional)
+    returns:
+        a tuple (values, rec) as decode_row
+    """
+    if positions is None:
+        values = list(values)
+    else:
+        values = [values[p] if p is not None else None for p in positions]
+    rec = dict([(name, v) for name, v in izip(header, values) if v is not None])
+    return values, rec
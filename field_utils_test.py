@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests for field_utils.py. They need only the standard library.
+#
+# Example:
+#
+# python field_utils_test.py
+
+__author__ = "John Wieczorek"
+__contributors__ = "Aaron Steele, John Wieczorek"
+__copyright__ = "Copyright 2018 vertnet.org"
+__version__ = "field_utils_test.py 2018-04-07T19:30-3:00"
+
+import random
+import re
+import unittest
+from field_utils import column_positions, decode_row, decode_values, index_fields
+
+HEADER = index_fields()
+
+def baseline_rec_dict(row):
+    """The row dictionary the indexer built before decode_row."""
+    val = {}
+    for name, value in dict(zip(HEADER, row.split('\t'))).iteritems():
+        if value:
+            val[name] = re.sub('[\v\t\r\n]+', ' ', value).strip(' ')
+    return val
+
+# Characters the fuzzed values are made of, weighted toward the ones that are cleaned.
+FUZZ_CHARACTERS = ['a', 'Z', '0', '.', ' ', ' ', '\v', '\r', '\n', '\xc3\xa9']
+
+def fuzzed_row(rnd):
+    """A random row of about len(HEADER) columns with dirty and empty values."""
+    values = []
+    for _ in range(len(HEADER) + rnd.randint(-3, 3)):
+        if rnd.random() < 0.3:
+            values.append('')
+        else:
+            values.append(''.join([rnd.choice(FUZZ_CHARACTERS)
+                                   for _ in range(rnd.randint(1, 12))]))
+    return '\t'.join(values)
+
+class DecodeRowTest(unittest.TestCase):
+
+    def test_values_in_header_order(self):
+        values, rec = decode_row('a\tb\tc', ['x', 'y', 'z'])
+        self.assertEqual(['a', 'b', 'c'], values)
+        self.assertEqual({'x': 'a', 'y': 'b', 'z': 'c'}, rec)
+
+    def test_empty_columns_are_none(self):
+        values, rec = decode_row('a\t\tc', ['x', 'y', 'z'])
+        self.assertEqual(['a', None, 'c'], values)
+        self.assertEqual({'x': 'a', 'z': 'c'}, rec)
+
+    def test_missing_columns_are_none(self):
+        values, rec = decode_row('a', ['x', 'y', 'z'])
+        self.assertEqual(['a', None, None], values)
+        self.assertEqual({'x': 'a'}, rec)
+
+    def test_extra_columns_are_dropped(self):
+        values, rec = decode_row('a\tb\tc\td', ['x', 'y'])
+        self.assertEqual(['a', 'b'], values)
+        self.assertEqual({'x': 'a', 'y': 'b'}, rec)
+
+    def test_control_characters_are_replaced(self):
+        values, rec = decode_row(' a\r\nb \t\v\vc\vd\t\n', ['x', 'y', 'z'])
+        self.assertEqual(['a b', 'c d', ''], values)
+        self.assertEqual({'x': 'a b', 'y': 'c d', 'z': ''}, rec)
+
+    def test_matches_baseline_on_fuzzed_rows(self):
+        rnd = random.Random(20180407)
+        for _ in range(2000):
+            row = fuzzed_row(rnd)
+            expected = baseline_rec_dict(row)
+            values, rec = decode_row(row, HEADER)
+            self.assertEqual(expected, rec, row)
+            self.assertEqual(map(expected.get, HEADER), values, row)
+
+class ColumnPositionsTest(unittest.TestCase):
+
+    def test_same_columns(self):
+        self.assertEqual(None, column_positions(HEADER, HEADER))
+        self.assertEqual(None, column_positions(list(HEADER), HEADER))
+
+    def test_reordered_missing_and_extra_columns(self):
+        positions = column_positions(['z', 'w', 'x'], ['x', 'y', 'z'])
+        self.assertEqual([2, None, 0], positions)
+        values, rec = decode_values(('c', 'd', 'a'), ['x', 'y', 'z'], positions)
+        self.assertEqual(['a', None, 'c'], values)
+        self.assertEqual({'x': 'a', 'z': 'c'}, rec)
+
+    def test_decode_values_round_trip(self):
+        rnd = random.Random(20180407)
+        for _ in range(200):
+            row = fuzzed_row(rnd)
+            values, rec = decode_row(row, HEADER)
+            self.assertEqual((values, rec), decode_values(tuple(values), HEADER))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -17,16 +17,22 @@ __contributors__ = "Aaron Steele, John Wieczorek"
 __copyright__ = "Copyright 2018 vertnet.org"
 __version__ = "index_utils.py 2018-04-07T19:30-3:00"
 
+import hashlib
 import json
 import logging
 import re
 import os
-from field_utils import index_fields
+from collections import OrderedDict
+from operator import itemgetter
+from field_utils import column_positions, decode_row, decode_values, index_fields
 from datetime import datetime
+from google.appengine.api import memcache
 from google.appengine.api import namespace_manager
 from google.appengine.api import search
+from google.appengine.ext import ndb
 from mapreduce import operation as op
 from mapreduce import context
+from mapreduce.api import map_job
 
 IS_DEV = 'Development' in os.environ['SERVER_SOFTWARE']
 
@@ -34,9 +40,264 @@ IS_DEV = 'Development' in os.environ['SERVER_SOFTWARE']
 # here to define the structure of the stream.
 HEADER = index_fields()
 
+class IndexFailure(ndb.Model):
+    """A document the search pool could not put to its index."""
+    mrid = ndb.StringProperty()
+    index_name = ndb.StringProperty()
+    namespace = ndb.StringProperty()
+    doc_id = ndb.StringProperty()
+    code = ndb.StringProperty()
+    message = ndb.TextProperty()
+    failed = ndb.DateTimeProperty(auto_now=True)
+
+class VerbatimRecord(ndb.Model):
+    """The verbatim record of an index document kept out of the document itself. Stored
+    in the namespace of the index with the keyname of the record as id.
+    """
+    record = ndb.BlobProperty(compressed=True)
+
+class IndexedRecord(ndb.Model):
+    """
+    An entry of the manifest of incremental indexing jobs: the hashid a record was last
+    put to an index with, and the last job that put it. Stored in the namespace of the
+    index with '<index_name>/<keyname>' as id. Written only when the hashid changes.
+    """
+    index_name = ndb.StringProperty()
+    dataset = ndb.StringProperty()
+    mrid = ndb.StringProperty(indexed=False)
+    hashid = ndb.IntegerProperty(indexed=False)
+
+class IndexedDataset(ndb.Model):
+    """
+    A data set seen by an incremental indexing job. Stored in the namespace of the index
+    with '<mrid>/<dataset>' as id.
+    """
+    mrid = ndb.StringProperty()
+    dataset = ndb.StringProperty()
+
+class IndexedKeys(ndb.Model):
+    """
+    The keynames of a data set a slice of an incremental indexing job read, one per 
+    line, changed or not, to find the records of the data set that disappeared. Stored
+    in the namespace of the index with '<shard id>/<slice>/<dataset>/<chunk>' as id, 
+    so that a retried slice writes the same entities again.
+    """
+    mrid = ndb.StringProperty()
+    dataset = ndb.StringProperty()
+    keynames = ndb.BlobProperty(compressed=True)
+
+class IndexPartitions(ndb.Model):
+    """
+    The partition map of an index: the physical indexes the documents of the index are
+    put to, and the strategy that routes each document to one of them. Stored in the
+    namespace of the index with the index_name as id. Documents of an index without a
+    partition map are put to the index of that name.
+    """
+    strategy = ndb.StringProperty()
+    partitions = ndb.StringProperty(repeated=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+# Values of the verbatim_store mapper parameter. 'document' keeps the verbatim record in 
+# the verbatim_record field of the document. 'datastore' stores it as a VerbatimRecord 
+# and keeps only its digest in the verbatim_digest field of the document.
+VERBATIM_IN_DOCUMENT = 'document'
+VERBATIM_IN_DATASTORE = 'datastore'
+
+# Search API limits. Values over MAX_ATOM_LENGTH fail when the field is built, documents
+# over MAX_DOCUMENT_SIZE fail when they are put.
+MAX_ATOM_LENGTH = search.MAXIMUM_FIELD_ATOM_LENGTH
+MAX_DOCUMENT_SIZE = 1024 * 1024
+# Allowance for the encoding of a field besides its name and value, and for the size of
+# the number, date and geopoint values.
+FIELD_SIZE_OVERHEAD = 32
+# Text values are not truncated to less than this to make a document fit.
+MIN_TRUNCATED_TEXT_LENGTH = 1024
+
+# Counters of the changes fit_document makes to rows.
+COUNTER_ATOM_TRUNCATED = 'index-atom-truncated'
+COUNTER_TEXT_TRUNCATED = 'index-text-truncated'
+COUNTER_VERBATIM_DROPPED = 'index-verbatim-dropped'
+# Counter of the rows incremental jobs did not put because their hashid did not change.
+COUNTER_UNCHANGED = 'index-unchanged'
+# Keynames per IndexedKeys entity, well under the entity size limit once compressed.
+KEYNAMES_PER_ENTITY = 20000
+
+# Values of the partition parameter of IndexGcsPath. 'hash' spreads the documents over a
+# fixed number of partitions by the hash of their keyname. 'taxon' puts them in a 
+# partition per class, or per kingdom for records without a class. 'rollover' puts them 
+# in the last partition until its storage_usage reaches ROLLOVER_STORAGE_FRACTION of its
+# storage_limit, then in a new one.
+PARTITION_BY_HASH = 'hash'
+PARTITION_BY_TAXON = 'taxon'
+PARTITION_BY_ROLLOVER = 'rollover'
+PARTITION_STRATEGIES = [PARTITION_BY_HASH, PARTITION_BY_TAXON, PARTITION_BY_ROLLOVER]
+ROLLOVER_STORAGE_FRACTION = 0.9
+# Seconds the storage check of a rollover partition is kept in memcache, shared by all the
+# shards and slices of the jobs on the index.
+ROLLOVER_CHECK_SECONDS = 60
+# Partition of the records without a class or kingdom in the taxon strategy.
+TAXON_PARTITION_OTHER = 'other'
+
+class SearchIndexMapper(map_job.Mapper):
+    """
+    Builds a document from each line of a harvest file and puts it in the search pool.
+    The job parameters, the pools and the index date are resolved once per slice 
+    instead of once per line, and the pools are flushed at the end of every slice.
+
+    If the incremental mapper parameter is set, the lines of a block are checked 
+    against the IndexedRecord manifest in one batch, and only the records whose hashid
+    changed since they were last indexed are put. Their manifest entries are kept
+    until the search pool is flushed at the end of the slice, and only those of the
+    documents that were put are written, so that a retried slice or the next job puts
+    the others again.
+    The keynames read are written per data set as IndexedKeys at the end of the slice.
+
+    Blocks of rows from the GoogleCloudStorageRowInputReader were split and cleaned 
+    when they were precompiled by tools/compile_rows.py and are not decoded again.
+
+    Documents of an index with IndexPartitions are put to the partition their 
+    PartitionRouter picks, and the partitions created in a slice are added to the 
+    partition map before its documents are flushed.
+    """
+    def begin_slice(self, slice_ctx):
+        """Resolve the job constants for this slice."""
+        ctx = context.get()
+        params = ctx.mapreduce_spec.mapper.params
+        self._namespace = params['namespace']
+        self._index_name = params['index_name']
+        self._verbatim_store = params.get('verbatim_store', VERBATIM_IN_DOCUMENT)
+        # Jobs started by IndexGcsPath carry the date they were started on, so that all
+        # the documents of a job get the same lastindexed.
+        self._indexdate = params.get('indexdate') or datetime.now().strftime('%Y-%m-%d')
+        self._search_pool = ctx.get_pool('search_pool')
+        self._mutation_pool = ctx.get_pool('mutation_pool')
+        self._router = PartitionRouter(self._index_name, self._namespace)
+        self._incremental = bool(params.get('incremental'))
+        self._mrid = ctx.mapreduce_id
+        # The data sets already recorded as IndexedDataset in this slice.
+        self._datasets = set()
+        # The keynames read in this slice by data set.
+        self._keynames = {}
+        # The IndexedRecord manifest entries of the documents put in this slice by 
+        # keyname, written once the documents are.
+        self._indexed_records = {}
+        # The columns of the precompiled rows last seen and their column_positions.
+        self._columns = None
+        self._positions = None
+
+    def __call__(self, slice_ctx, readbuffer):
+        """
+        Construct a document from each line of a readbuffer and put it in the search 
+        pool.
+        """
+        # readbuffer should be a tuple from GoogleCloudLineInputReader composed of a
+        # tuple of the form ((file_name, offset), line), or in block mode of the form
+        # ((file_name, offset), [line, ...]) where offset is that of the first line.
+        # From GoogleCloudStorageRowInputReader it is ((file_name, columns), [row, ...])
+        # where the rows are tuples of the cleaned values of the columns.
+        position, lines = readbuffer
+        if not isinstance(lines, list):
+            lines = [lines]
+        rows = []
+        if isinstance(position[1], tuple):
+            columns = position[1]
+            if columns != self._columns:
+                self._columns = columns
+                self._positions = column_positions(list(columns), HEADER)
+            for values in lines:
+                rows.append((values,) + decode_values(values, HEADER, self._positions))
+        else:
+            for line in lines:
+                try:
+                    rows.append((line,) + decode_row(line, HEADER))
+                except Exception, e:
+                    logging.error('%s\n%s' % (e, (position, line)))
+        if self._incremental:
+            rows = self._changed_rows(slice_ctx, rows)
+        for line, values, data in rows:
+            try:
+                doc, verbatim_record = index_values(values, data, self._indexdate, 
+                                                    self._namespace, 
+                                                    self._verbatim_store, 
+                                                    slice_ctx.incr)
+                if verbatim_record is not None:
+                    self._mutation_pool.put(verbatim_record)
+                self._search_pool.put(doc, self._router.route(values), 
+                                      self._namespace)
+            except Exception, e:
+                self._indexed_records.pop(values[KEYNAME], None)
+                logging.error('%s\n%s' % (e, (position, line)))
+
+    def _changed_rows(self, slice_ctx, rows):
+        """
+        Look up the manifest entries of a block of decoded rows in one batch and return
+        the rows whose hashid is not the one they were last indexed with. Only the 
+        manifest entries of those rows are made again, to be written in end_slice.
+        """
+        keyed = []
+        changed = []
+        for row in rows:
+            values = row[1]
+            hashid = as_int(values[HASHID])
+            if values[KEYNAME] and hashid is not None:
+                keyed.append((row, hashid, indexed_record_key(self._index_name, 
+                              values[KEYNAME], self._namespace)))
+            else:
+                # Rows without a keyname or hashid are rejected by build_document.
+                changed.append(row)
+        # Each slice reads a different part of the manifest, keep it out of the caches.
+        records = ndb.get_multi([key for _, _, key in keyed], use_cache=False, 
+                                use_memcache=False)
+        for (row, hashid, key), record in zip(keyed, records):
+            dataset = row[1][DATASET]
+            if record is None or record.hashid != hashid or record.dataset != dataset:
+                changed.append(row)
+                self._indexed_records[row[1][KEYNAME]] = IndexedRecord(key=key, 
+                    index_name=self._index_name, dataset=dataset, mrid=self._mrid, 
+                    hashid=hashid)
+            else:
+                slice_ctx.incr(COUNTER_UNCHANGED)
+            if not dataset:
+                continue
+            self._keynames.setdefault(dataset, []).append(row[1][KEYNAME])
+            if dataset not in self._datasets:
+                self._datasets.add(dataset)
+                self._mutation_pool.put(IndexedDataset(
+                    id='%s/%s' % (self._mrid, dataset), namespace=self._namespace,
+                    mrid=self._mrid, dataset=dataset))
+        return changed
+
+    def end_slice(self, slice_ctx):
+        """Put the documents and verbatim records still pending in this slice."""
+        # Before the flush, so that the partitions are in the map once they have 
+        # documents, or the slice is retried.
+        self._router.add_new()
+        for dataset, keynames in self._keynames.iteritems():
+            for chunk in range(0, len(keynames), KEYNAMES_PER_ENTITY):
+                self._mutation_pool.put(IndexedKeys(
+                    id='%s/%s/%s/%s' % (slice_ctx.shard_context.id, slice_ctx.number,
+                                        dataset, chunk / KEYNAMES_PER_ENTITY),
+                    namespace=self._namespace, mrid=self._mrid, dataset=dataset,
+                    keynames='\n'.join(keynames[chunk:chunk + KEYNAMES_PER_ENTITY])))
+        self._search_pool.flush()
+        # Only once the documents are put, and not for those that failed, or a slice
+        # that is retried would find them unchanged and never put them.
+        failed = self._search_pool.failed_doc_ids
+        for keyname, record in self._indexed_records.iteritems():
+            if keyname not in failed:
+                self._mutation_pool.put(record)
+        self._indexed_records = {}
+        self._mutation_pool.flush()
+
+    def __getstate__(self):
+        # Everything is resolved again in begin_slice, nothing needs to be carried 
+        # across slices.
+        return {}
+
 def build_search_index(readbuffer):
     """
-    Construct a document from a readbuffer and index it.
+    Construct a document from a readbuffer and yield it to the search pool, which puts
+    documents to the index in batches. Kept for jobs started before SearchIndexMapper.
     """
     # readbuffer should be a tuple from GoogleCloudLineInputReader composed of a
     # tuple of the form ((file_name, offset), line)
@@ -46,25 +307,308 @@ def build_search_index(readbuffer):
     params = ctx.mapreduce_spec.mapper.params
     namespace = params['namespace']
     index_name = params['index_name']
-    indexdate = datetime.now().strftime('%Y-%m-%d')
+    verbatim_store = params.get('verbatim_store', VERBATIM_IN_DOCUMENT)
+    indexdate = params.get('indexdate') or datetime.now().strftime('%Y-%m-%d')
 
     try:
-        # Get the row out of the input buffer
-        row=readbuffer[1]
+        doc, verbatim_record = index_row(readbuffer[1], indexdate, namespace, 
+                                         verbatim_store, ctx.counters.increment)
+        if verbatim_record is not None:
+            # Queue the verbatim record for the mutation pool, which puts it in batches.
+            yield op.db.Put(verbatim_record)
 
-        # Create a dictionary from the HEADER and the row
-        data = get_rec_dict(dict(zip(HEADER, row.split('\t'))))
-#        s =  'Data from %s' % readbuffer[0][0]
-#        s += ' offset %s: %s' % (readbuffer[0][0], data)
-#        logging.warning('%s' % s)
+        # Queue the document for the given index. The search pool on the mapreduce
+        # context puts documents in batches of up to 200 per Search API call.
+        yield op.search.Put(doc, index_name, namespace)
+    except Exception, e:
+        logging.error('%s\n%s' % (e, readbuffer))
 
-        # Create an index document from the row dictionary
-        doc = index_record(data, indexdate)
+def index_row(row, indexdate, namespace, verbatim_store=VERBATIM_IN_DOCUMENT, 
+              incr=None):
+    """
+    Creates the document for a line of a harvest file.
+    parameters:
+        row - the line, without its line terminator (required)
+        indexdate - the lastindexed date of the document (required)
+        namespace - namespace of the index the document is for (required)
+        verbatim_store - where to keep the verbatim record (optional)
+        incr - function(counter_name, delta) counting the changes made to fit the 
+            document in the Search API limits (optional)
+    returns:
+        a tuple (document, verbatim_record) where verbatim_record is the VerbatimRecord
+        to store for the document, or None if the verbatim record is in the document
+    """
+    # Split the row into cleaned values by HEADER position and a dictionary of the
+    # non-empty ones for the verbatim record
+    values, data = decode_row(row, HEADER)
+    return index_values(values, data, indexdate, namespace, verbatim_store, incr)
 
-        # Store the document in the given index
-        index_doc(doc, index_name, namespace)
+def index_values(values, data, indexdate, namespace, 
+                 verbatim_store=VERBATIM_IN_DOCUMENT, incr=None):
+    """
+    Creates the document for a row decoded by decode_row. See index_row.
+    parameters:
+        values - list of the values of the row in HEADER order (required)
+        data - dictionary of the non-empty values of the row (required)
+        indexdate - the lastindexed date of the document (required)
+        namespace - namespace of the index the document is for (required)
+        verbatim_store - where to keep the verbatim record (optional)
+        incr - function(counter_name, delta) counting the changes made to fit the 
+            document in the Search API limits (optional)
+    returns:
+        a tuple (document, verbatim_record) as index_row
+    """
+    verbatim = json.dumps(data)
+    verbatim_record = None
+    if verbatim_store == VERBATIM_IN_DATASTORE and data.get('keyname'):
+        verbatim_record = VerbatimRecord(id=data['keyname'], namespace=namespace, 
+                                         record=verbatim)
+    else:
+        verbatim_store = VERBATIM_IN_DOCUMENT
+
+    # Create an index document from the row values
+    doc = build_document(values, verbatim, indexdate, verbatim_store, incr)
+    return doc, verbatim_record
+
+def record_put_failures(index, failures):
+    """
+    Store the documents that could not be put to the index as IndexFailure entities so
+    that they can be found and re-indexed after the job. This is the
+    search_failure_handler of the indexing jobs.
+    parameters:
+        index - the search.Index the documents were destined for (required)
+        failures - list of (document, code, message) tuples (required)
+    """
+    ctx = context.get()
+    mrid = ctx.mapreduce_id if ctx else None
+    entities = []
+    for doc, code, message in failures:
+        entities.append(IndexFailure(
+            id='%s/%s/%s' % (index.namespace, index.name, doc.doc_id), 
+            mrid=mrid, index_name=index.name, namespace=index.namespace, 
+            doc_id=doc.doc_id, code=code, message=message))
+    try:
+        ndb.put_multi(entities)
     except Exception, e:
-        logging.error('%s\n%s' % (e, readbuffer))
+        logging.error('Unable to record %s put failures (%s)' % (len(entities), e))
+
+def indexed_record_key(index_name, keyname, namespace):
+    """Return the key of the IndexedRecord of a record in an index."""
+    return ndb.Key(IndexedRecord, '%s/%s' % (index_name, keyname), namespace=namespace)
+
+def forget_indexed_records(keynames, index_name, namespace):
+    """
+    Delete the IndexedRecord entries of documents deleted from an index, so that the 
+    next incremental job puts them again if they are still in its files.
+    parameters:
+        keynames - list of document ids (required)
+        index_name - name of the index (required)
+        namespace - namespace of the index (required)
+    """
+    ndb.delete_multi([indexed_record_key(index_name, k, namespace) 
+                      for k in keynames if k])
+
+def forget_failed_records(mrid):
+    """
+    Delete the IndexedRecord entries of the documents of a job that could not be put to
+    their index, so that the next incremental job puts them again.
+    parameters:
+        mrid - id of the indexing job (required)
+    returns:
+        the number of entries deleted
+    """
+    keys = [indexed_record_key(f.index_name, f.doc_id, f.namespace) 
+            for f in IndexFailure.query(IndexFailure.mrid == mrid)]
+    ndb.delete_multi(keys)
+    return len(keys)
+
+def disappeared_keys(mrid, index_name, namespace):
+    """
+    Generate the keynames of the records of the data sets seen by an incremental 
+    indexing job that are in the manifest of the index but not in the IndexedKeys of 
+    the job, so that they can be deleted from the index. The IndexedKeys of a data set
+    are deleted once it has been compared.
+    parameters:
+        mrid - id of the indexing job (required)
+        index_name - name of the index the job put to (required)
+        namespace - namespace of the index (required)
+    """
+    prefix = len(index_name) + 1
+    datasets = IndexedDataset.query(IndexedDataset.mrid == mrid, namespace=namespace)
+    for dataset in datasets:
+        # Needs the IndexedKeys (mrid, dataset) index in index.yaml.
+        chunks = IndexedKeys.query(IndexedKeys.mrid == mrid, 
+                                   IndexedKeys.dataset == dataset.dataset,
+                                   namespace=namespace).fetch()
+        seen = set()
+        for chunk in chunks:
+            seen.update(chunk.keynames.split('\n'))
+        # Needs the IndexedRecord (index_name, dataset) index in index.yaml.
+        query = IndexedRecord.query(IndexedRecord.index_name == index_name, 
+                                    IndexedRecord.dataset == dataset.dataset,
+                                    namespace=namespace)
+        for key in query.iter(keys_only=True):
+            keyname = key.id()[prefix:]
+            if keyname not in seen:
+                yield keyname
+        ndb.delete_multi([chunk.key for chunk in chunks])
+
+def partition_name(index_name, suffix):
+    """Return the name of a partition of an index."""
+    return '%s-%s' % (index_name, suffix)
+
+def get_partitions(index_name, namespace):
+    """Return the IndexPartitions of an index, or None if it is not partitioned."""
+    return IndexPartitions.get_by_id(index_name, namespace=namespace)
+
+def partition_indexes(index_name, namespace):
+    """
+    Return the names of the physical indexes the documents of an index are in, so that
+    they can be searched or deleted across all of them.
+    parameters:
+        index_name - name of the index (required)
+        namespace - namespace of the index (required)
+    returns:
+        the partitions of the index, or [index_name] if it has none
+    """
+    partitions = get_partitions(index_name, namespace)
+    if partitions is None or not partitions.partitions:
+        return [index_name]
+    return list(partitions.partitions)
+
+@ndb.transactional
+def create_partitions(index_name, namespace, strategy, count):
+    """
+    Create the partition map of an index, or return the one it has. The strategy and 
+    the partitions of an existing map are kept, since the documents already in the 
+    index were routed by them.
+    parameters:
+        index_name - name of the index (required)
+        namespace - namespace of the index (required)
+        strategy - one of PARTITION_STRATEGIES (required)
+        count - number of partitions of the hash strategy (required)
+    returns:
+        the IndexPartitions of the index
+    """
+    if strategy not in PARTITION_STRATEGIES:
+        raise ValueError('Unknown partition strategy: %s' % strategy)
+    partitions = get_partitions(index_name, namespace)
+    if partitions is not None:
+        if partitions.strategy != strategy:
+            logging.warning('Index %s.%s is already partitioned by %s, not by %s.' % 
+                            (namespace, index_name, partitions.strategy, strategy))
+        return partitions
+    names = []
+    if strategy == PARTITION_BY_HASH:
+        names = [partition_name(index_name, i) for i in range(count)]
+    elif strategy == PARTITION_BY_ROLLOVER:
+        names = [partition_name(index_name, 0)]
+    # The taxon partitions are added as the jobs come across the taxa.
+    partitions = IndexPartitions(id=index_name, namespace=namespace, strategy=strategy,
+                                 partitions=names)
+    partitions.put()
+    return partitions
+
+@ndb.transactional
+def add_partitions(index_name, namespace, names):
+    """Add the partitions that are not in the partition map of an index yet."""
+    partitions = get_partitions(index_name, namespace)
+    new = [name for name in names if name not in partitions.partitions]
+    if new:
+        partitions.partitions.extend(new)
+        partitions.put()
+    return partitions
+
+@ndb.transactional
+def roll_over(index_name, namespace, full):
+    """
+    Add a partition to the partition map of an index if its last partition is still
+    the one found full, so that only one of the shards that found it full adds one.
+    parameters:
+        index_name - name of the index (required)
+        namespace - namespace of the index (required)
+        full - name of the partition found full (required)
+    returns:
+        the IndexPartitions of the index
+    """
+    partitions = get_partitions(index_name, namespace)
+    if partitions.partitions[-1] == full:
+        partitions.partitions.append(partition_name(index_name, 
+                                                    len(partitions.partitions)))
+        partitions.put()
+        logging.info('Index %s.%s rolled over from %s to %s.' % 
+                     (namespace, index_name, full, partitions.partitions[-1]))
+    return partitions
+
+def storage_is_full(index_name, namespace, fraction=ROLLOVER_STORAGE_FRACTION):
+    """
+    Return True if the storage_usage of an index, as shown by ListIndexes, is at least 
+    fraction of its storage_limit. An index that does not exist yet is not full. The 
+    answer is kept in memcache for ROLLOVER_CHECK_SECONDS.
+    """
+    key = 'storage-full/%s/%s/%s' % (namespace, index_name, fraction)
+    full = memcache.get(key)
+    if full is None:
+        full = _storage_is_full(index_name, namespace, fraction)
+        memcache.set(key, full, time=ROLLOVER_CHECK_SECONDS)
+    return full
+
+def _storage_is_full(index_name, namespace, fraction):
+    """Return the answer of storage_is_full from the Search API."""
+    response = search.get_indexes(namespace=namespace, index_name_prefix=index_name,
+                                  fetch_schema=False)
+    for index in response.results:
+        if index.name == index_name:
+            if index.storage_usage is None or not index.storage_limit:
+                return False
+            return index.storage_usage >= fraction * index.storage_limit
+    return False
+
+class PartitionRouter(object):
+    """
+    Picks the partition of its index each document of a slice is put to. The map is 
+    read, and a full rollover partition replaced, when the router is created, once per
+    slice. The storage of the partition is checked at most once per 
+    ROLLOVER_CHECK_SECONDS for all the shards, see storage_is_full. Partitions of 
+    taxa not in the map are kept in new until add_new.
+    """
+    def __init__(self, index_name, namespace):
+        self.index_name = index_name
+        self.namespace = namespace
+        self.new = set()
+        partitions = get_partitions(index_name, namespace)
+        self.strategy = partitions.strategy if partitions else None
+        self.partitions = list(partitions.partitions) if partitions else []
+        if self.strategy == PARTITION_BY_ROLLOVER and \
+            storage_is_full(self.partitions[-1], namespace):
+            self.partitions = roll_over(index_name, namespace, 
+                                        self.partitions[-1]).partitions
+
+    def route(self, values):
+        """Return the name of the index the document of a row of values goes to."""
+        if self.strategy == PARTITION_BY_HASH:
+            keyname = values[KEYNAME]
+            if isinstance(keyname, unicode):
+                keyname = keyname.encode('utf-8')
+            digest = int(hashlib.md5(keyname).hexdigest()[:8], 16)
+            return self.partitions[digest % len(self.partitions)]
+        if self.strategy == PARTITION_BY_TAXON:
+            taxon = values[CLASS] or values[KINGDOM] or ''
+            taxon = TAXON_CHARACTERS.sub('_', taxon.strip().lower()).strip('_')[:64]
+            name = partition_name(self.index_name, taxon or TAXON_PARTITION_OTHER)
+            if name not in self.partitions:
+                self.partitions.append(name)
+                self.new.add(name)
+            return name
+        if self.strategy == PARTITION_BY_ROLLOVER:
+            return self.partitions[-1]
+        return self.index_name
+
+    def add_new(self):
+        """Add the partitions created since the last call to the partition map."""
+        if self.new:
+            add_partitions(self.index_name, self.namespace, sorted(self.new))
+            self.new = set()
 
 def get_rec_dict(rec):
     """Returns a dictionary of all fields in rec with non-printing characters removed."""
@@ -85,216 +629,142 @@ def get_rec_dict(rec):
 
 def index_record(data, indexdate, issue=None):
     """
-    Creates a document ready to index from the given input data. This is where the work 
-    is done to construct the document.
-    """
-    keyname, iptrecordid, icode, collectioncode, catalognumber, \
-    gbifdatasetid, gbifpublisherid, networks, \
-    license, migrator, vntype, orgcountry, orgstateprovince, \
-    dctype, basisofrecord, \
-    continent, country, stateprov, county, municipality, \
-    islandgroup, island, waterbody, locality, \
-    decimallatitude, decimallongitude, coordinateuncertaintyinmeters, \
-    geodeticdatum, georeferencedby, georeferenceverificationstatus, \
-    kingdom, phylum, classs, order, family, \
-    genus, specificepithet, infraspecificepithet, \
-    scientificname, vernacularname, typestatus, \
-    recordedby, recordnumber, fieldnumber, establishmentmeans, \
-    bed, formation, group, member, \
-    sex, lifestage, preparations, reproductivecondition, \
-    year, month, day, startdayofyear, enddayofyear, eventdate, \
-    haslicense, hasmedia, hastissue, hastypestatus, \
-    isfossil, isarch, mappable, wascaptive, wasinvasive, \
-    haslength, haslifestage, hasmass, hassex, \
-    lengthinmm, lengthtype, massing, rank, hashid = map(data.get, 
-        ['keyname', 'iptrecordid', 'icode', 'collectioncode', 'catalognumber', 
-         'gbifdatasetid', 'gbifpublisherid', 'networks', 
-         'license', 'migrator', 'vntype', 'orgcountry', 'orgstateprovince',
-         'dctype', 'basisofrecord', 
-         'continent', 'country', 'stateprovince', 'county', 'municipality', 
-         'islandgroup', 'island', 'waterbody', 'locality',
-         'decimallatitude', 'decimallongitude', 'coordinateuncertaintyinmeters', 
-         'geodeticdatum', 'georeferencedby', 'georeferenceverificationstatus',
-         'kingdom', 'phylum', 'class', 'order', 'family', 
-         'genus', 'specificepithet', 'infraspecificepithet', 
-         'scientificname', 'vernacularname', 'typestatus', 
-         'recordedby', 'recordnumber', 'fieldnumber', 'establishmentmeans',
-         'bed', 'formation', 'group', 'member',
-         'sex', 'lifestage', 'preparations', 'reproductivecondition',
-         'year', 'month', 'day', 'startdayofyear', 'enddayofyear', 'eventdate',
-         'haslicense', 'hasmedia', 'hastissue', 'hastypestatus', 
-         'isfossil', 'isarch', 'mappable', 'wascaptive', 'wasinvasive',
-         'haslength', 'haslifestage', 'hasmass', 'hassex', 
-         'lengthinmm', 'lengthtype', 'massing', 'rank', 'hashid'])
-
-#    # The data type on eventdate is date, so turn the input string into a date.
-#    eventdate = _w3c_eventdate(data)
-    
-    # The data type for location is a GeoPoint. Create one from lat and lng ignoring
-    # datum. To do this correctly, the lat and lng should be transformed to WGS84 before
-    # this.
-    location = _location(decimallatitude, decimallongitude)
-
-    # Do full text indexing on all the verbatim fields of the record. 
-    # Index specific key fields for explicit searches on their content.
-
-    doc = search.Document(
-        doc_id=keyname,
-        rank=as_int(rank),
-		fields=[
-                ### RECORD-LEVEL ###
-                search.TextField(name='institutioncode', value=icode),
-                search.TextField(name='collectioncode', value=collectioncode),
-                search.TextField(name='catalognumber', value=catalognumber),
-                search.AtomField(name='dctype', value=dctype),
-                search.TextField(name='license', value=license),
-                search.AtomField(name='basisofrecord', value=basisofrecord),
-
-                ### OCCURRENCE ###
-                search.AtomField(name='iptrecordid', value=iptrecordid),
-                search.TextField(name='recordedby', value=recordedby),
-                search.TextField(name='recordnumber', value=recordnumber),
-                search.TextField(name='fieldnumber', value=fieldnumber),
-                search.TextField(name='establishmentmeans', value=establishmentmeans),
-                search.TextField(name='sex', value=sex),
-                search.TextField(name='lifestage', value=lifestage),
-                search.TextField(name='preparations', value=preparations),
-                search.TextField( \
-                    name='reproductivecondition', value=reproductivecondition),
-
-                ### EVENT (for year, month, day, see below) ###
-                search.TextField(name='eventdate', value=eventdate),
-
-                ### LOCATION (for coordinateuncertaintyinmeters, see below) ###
-                search.TextField(name='continent', value=continent),
-                search.TextField(name='country', value=country),
-                search.TextField(name='stateprovince', value=stateprov),
-                search.TextField(name='county', value=county),
-                search.TextField(name='municipality', value=municipality),
-                search.TextField(name='island', value=island),
-                search.TextField(name='islandgroup', value=islandgroup),
-                search.TextField(name='waterbody', value=waterbody),
-                search.TextField(name='locality', value=locality),
-                search.TextField(name='geodeticdatum', value=geodeticdatum),
-                search.TextField(name='georeferencedby', value=georeferencedby),
-                search.TextField( \
-                    name='georeferenceverificationstatus', \
-                    value=georeferenceverificationstatus),
-
-                ### GEOLOGICAL CONTEXT ###
-                search.TextField(name='bed', value=bed),
-                search.TextField(name='formation', value=formation),
-                search.TextField(name='group', value=group),
-                search.TextField(name='member', value=member),
-
-                ### IDENTIFICATION ###
-                search.TextField(name='typestatus', value=typestatus),
-
-                ### TAXON ###
-                search.AtomField(name='kingdom', value=kingdom),
-                search.AtomField(name='phylum', value=phylum),
-                search.AtomField(name='class', value=classs),
-                search.AtomField(name='order', value=order),
-                search.AtomField(name='family', value=family),
-                search.AtomField(name='genus', value=genus),
-                search.TextField(name='specificepithet', value=specificepithet),
-                search.TextField(name='infraspecificepithet', value=infraspecificepithet),
-                search.TextField(name='scientificname', value=scientificname),
-                search.TextField(name='vernacularname', value=vernacularname),
-
-                ### TRAIT (for lengthinmm, massing, see below) ###
-                search.TextField(name='lengthtype', value=lengthtype),
-
-                ### DATA SET ###
-                search.AtomField(name='gbifdatasetid', value=gbifdatasetid),
-                search.AtomField(name='gbifpublisherid', value=gbifpublisherid),
-                search.TextField(name='lastindexed', value=indexdate),                
-                search.TextField(name='networks', value=networks),
-                search.TextField(name='migrator', value=migrator),
-                search.TextField(name='orgcountry', value=orgcountry),
-                search.TextField(name='orgstateprovince', value=orgstateprovince),
-
-                ### BOOLEANS ###
-                search.AtomField(name='haslicense', value=haslicense),
-                search.AtomField(name='hasmedia', value=hasmedia),
-                search.AtomField(name='hastissue', value=hastissue),
-                search.AtomField(name='hastypestatus', value=hastypestatus),
-                search.AtomField(name='isfossil', value=isfossil),
-                search.AtomField(name='isarch', value=isarch),
-                search.AtomField(name='mappable', value=mappable),
-                search.AtomField(name='wascaptive', value=wascaptive),
-                search.AtomField(name='wasinvasive', value=wasinvasive),
-                search.AtomField(name='haslength', value=haslength),
-                search.AtomField(name='haslifestage', value=haslifestage),
-                search.AtomField(name='hasmass', value=hasmass),
-                search.AtomField(name='hassex', value=hassex),
-
-                ### INDEX ###
-                search.NumberField(name='rank', value=as_int(rank)),
-                search.AtomField(name='vntype', value=vntype),
-                search.NumberField(name='hashid', value=as_int(hashid)),
-                search.TextField(name='verbatim_record', value=json.dumps(data))])
-
-    v = as_int(year)
-    if v is not None:
-        doc.fields.append(search.NumberField( \
-            name='year', value=v))
-
-    v = as_int(month)
-    if v is not None:
-        doc.fields.append(search.NumberField( \
-            name='month', value=v))
-
-    v = as_int(day)
-    if v is not None:
-        doc.fields.append(search.NumberField( \
-            name='day', value=v))
-
-    v = as_int(startdayofyear)
-    if v is not None:
-        doc.fields.append(search.NumberField( \
-            name='startdayofyear', value=v))
-
-    v = as_int(enddayofyear)
-    if v is not None:
-        doc.fields.append(search.NumberField( \
-            name='enddayofyear', value=v))
-
-    v = as_float(lengthinmm)
-    if v is not None:
-        doc.fields.append(search.NumberField( \
-            name='lengthinmm', value=v))
-
-    v = as_float(massing)
-    if v is not None:
-        doc.fields.append(search.NumberField( \
-            name='massing', value=v))
-
-    if location is not None:
-        doc.fields.append(search.GeoField(name='location', value=location))
-
-    v = as_int(coordinateuncertaintyinmeters)
-    if v is not None:
-        doc.fields.append(search.NumberField( \
-            name='coordinateuncertaintyinmeters', value=v))
-
-    return doc
-
-def index_doc(doc, index_name, namespace, issue=None):
-    """
-    Index a document in the given index and namespace.
-    """
-    max_retries = 2
-    retry_count = 0
-    while retry_count < max_retries:
-        try:
-            search.Index(index_name, namespace=namespace).put(doc)
-#            logging.warning('Indexed doc:\n%s' % doc )
-            return # Successfully indexed document.
-        except Exception, e:
-            logging.error('Put #%s failed for doc %s (%s)' % (retry_count, doc.doc_id, e))
-            retry_count += 1
-    logging.error('Failed to index: %s' % doc.doc_id)
+    Creates a document ready to index from the given input data dictionary.
+    """
+    return build_document(map(data.get, HEADER), json.dumps(data), indexdate)
+
+def build_document(values, verbatim, indexdate, verbatim_store=VERBATIM_IN_DOCUMENT,
+                   incr=None):
+    """
+    Creates a document ready to index from the values of a row in HEADER order. The 
+    fields of the document are built by running the values through FIELD_PLAN, which 
+    is compiled from INDEX_SCHEMA when the module is loaded. The data set fields are 
+    shared with the other documents of the data set. verbatim is the JSON of the
+    non-empty values of the row. It is stored in the document unless verbatim_store is
+    VERBATIM_IN_DATASTORE, in which case the document only gets its digest. The values
+    are first fit in the Search API limits by fit_document, which counts what it 
+    changes with incr.
+    """
+    verbatim = fit_document(values, verbatim, verbatim_store, incr)
+    if verbatim_store == VERBATIM_IN_DATASTORE:
+        verbatim_fields = [search.AtomField(name='verbatim_digest', 
+                                            value=verbatim_digest(verbatim))]
+    elif verbatim is not None:
+        verbatim_fields = [search.TextField(name='verbatim_record', value=verbatim)]
+    else:
+        verbatim_fields = []
+    dataset_key = (indexdate, DATASET_KEY(values))
+    dataset_fields = DATASET_FIELD_CACHE.get(dataset_key)
+    if dataset_fields is None:
+        dataset_fields = [search.TextField(name='lastindexed', value=indexdate)]
+        for position, name, field_class in DATASET_FIELD_PLAN:
+            dataset_fields.append(field_class(name=name, value=values[position]))
+        DATASET_FIELD_CACHE.put(dataset_key, dataset_fields)
+    fields = dataset_fields + verbatim_fields
+    append = fields.append
+    for position, name, field_class in FIELD_PLAN:
+        append(field_class(name=name, value=values[position]))
+    for positions, name, field_class, converter in CONVERTED_FIELD_PLAN:
+        v = converter(*[values[p] for p in positions])
+        if v is not None:
+            append(field_class(name=name, value=v))
+    return search.Document(doc_id=values[KEYNAME], rank=as_int(values[RANK]), 
+                           fields=fields)
+
+def fit_document(values, verbatim, verbatim_store=VERBATIM_IN_DOCUMENT, incr=None):
+    """
+    Fit the values of a row in the Search API limits so that the document built from 
+    them can not be rejected for its size. Atom values are truncated to MAX_ATOM_LENGTH.
+    If the document could be over MAX_DOCUMENT_SIZE, the verbatim record is left out of
+    it, then the longest text values are truncated until it fits. The same row is 
+    always changed the same way.
+    parameters:
+        values - list of the values of the row in HEADER order, changed in place 
+            (required)
+        verbatim - the JSON string of the verbatim record (required)
+        verbatim_store - where the verbatim record is kept (optional)
+        incr - function(counter_name, delta) to count the changes with (optional)
+    returns:
+        verbatim, or None if it must be left out of the document
+    """
+    for position in ATOM_POSITIONS:
+        v = values[position]
+        if v is not None and len(v) > MAX_ATOM_LENGTH:
+            values[position] = truncate_utf8(v, MAX_ATOM_LENGTH)
+            if incr is not None:
+                incr(COUNTER_ATOM_TRUNCATED)
+    in_document = verbatim_store != VERBATIM_IN_DATASTORE
+    # The verbatim record holds every value of the row, so it bounds the size of the
+    # text values without measuring them.
+    verbatim_size = len(verbatim) if in_document else 0
+    if FIXED_DOCUMENT_SIZE + len(verbatim) + verbatim_size <= MAX_DOCUMENT_SIZE:
+        return verbatim
+    text_lengths = [(len(values[p]) if values[p] is not None else 0, p) 
+                    for p in TEXT_POSITIONS]
+    size = FIXED_DOCUMENT_SIZE + sum([n for n, _ in text_lengths]) + verbatim_size
+    if size > MAX_DOCUMENT_SIZE and in_document:
+        verbatim = None
+        size -= verbatim_size
+        if incr is not None:
+            incr(COUNTER_VERBATIM_DROPPED)
+    # Longest first, in HEADER order among equals.
+    text_lengths.sort(key=lambda item: (-item[0], item[1]))
+    for n, position in text_lengths:
+        excess = size - MAX_DOCUMENT_SIZE
+        if excess <= 0 or n <= MIN_TRUNCATED_TEXT_LENGTH:
+            break
+        v = truncate_utf8(values[position], max(MIN_TRUNCATED_TEXT_LENGTH, n - excess))
+        values[position] = v
+        size -= n - len(v)
+        if incr is not None:
+            incr(COUNTER_TEXT_TRUNCATED)
+    return verbatim
+
+def truncate_utf8(value, length):
+    """ Truncate a string without splitting a UTF-8 encoded character.
+    parameters:
+        value - str or unicode string longer than length (required)
+        length - the maximum length of the result (required)
+    returns:
+        the longest prefix of value no longer than length that ends on a character 
+        boundary
+    """
+    if isinstance(value, unicode):
+        return value[:length]
+    # Back up over continuation bytes to the start of the character that is cut.
+    while length > 0 and '\x80' <= value[length] <= '\xbf':
+        length -= 1
+    return value[:length]
+
+def verbatim_digest(verbatim):
+    """ Return a short digest of a verbatim record.
+    parameters:
+        verbatim - the JSON string of the verbatim record (required)
+    returns:
+        the first 16 hex digits of the SHA-1 of the verbatim record
+    """
+    return hashlib.sha1(verbatim).hexdigest()[:16]
+
+def get_verbatim_records(keynames, namespace):
+    """ Get the verbatim records stored for a list of documents in one round trip.
+    parameters:
+        keynames - list of document ids (required)
+        namespace - namespace of the index the documents are in (required)
+    returns:
+        a list with the verbatim record JSON string of each keyname, or None for 
+        keynames that have no stored verbatim record
+    """
+    keys = [ndb.Key(VerbatimRecord, k, namespace=namespace) for k in keynames]
+    return [r.record if r is not None else None for r in ndb.get_multi(keys)]
+
+def delete_verbatim_records(keynames, namespace):
+    """ Delete the verbatim records stored for a list of documents, if any.
+    parameters:
+        keynames - list of document ids (required)
+        namespace - namespace of the index the documents are in (required)
+    """
+    ndb.delete_multi([ndb.Key(VerbatimRecord, k, namespace=namespace) 
+                      for k in keynames if k])
 
 def as_float(str): 
     """ Convert a string into a float, if possible.
@@ -329,6 +799,225 @@ def _location(lat, lon):
     except:
         return None
 
+# The schema of the index documents as (source column, index field name, field class, 
+# converter) entries. Entries without a converter always put the verbatim column value 
+# in the document. Entries with a converter put the converted value in the document if
+# it is not None. A converter that raises rejects the whole row. A tuple of source 
+# columns passes all of their values to the converter. The lastindexed and 
+# verbatim_record fields do not come from a single column and are added by 
+# index_record.
+INDEX_SCHEMA = [
+    ### RECORD-LEVEL ###
+    ('icode', 'institutioncode', search.TextField, None),
+    ('collectioncode', 'collectioncode', search.TextField, None),
+    ('catalognumber', 'catalognumber', search.TextField, None),
+    ('dctype', 'dctype', search.AtomField, None),
+    ('license', 'license', search.TextField, None),
+    ('basisofrecord', 'basisofrecord', search.AtomField, None),
+
+    ### OCCURRENCE ###
+    ('iptrecordid', 'iptrecordid', search.AtomField, None),
+    ('recordedby', 'recordedby', search.TextField, None),
+    ('recordnumber', 'recordnumber', search.TextField, None),
+    ('fieldnumber', 'fieldnumber', search.TextField, None),
+    ('establishmentmeans', 'establishmentmeans', search.TextField, None),
+    ('sex', 'sex', search.TextField, None),
+    ('lifestage', 'lifestage', search.TextField, None),
+    ('preparations', 'preparations', search.TextField, None),
+    ('reproductivecondition', 'reproductivecondition', search.TextField, None),
+
+    ### EVENT ###
+    ('eventdate', 'eventdate', search.TextField, None),
+    ('year', 'year', search.NumberField, as_int),
+    ('month', 'month', search.NumberField, as_int),
+    ('day', 'day', search.NumberField, as_int),
+    ('startdayofyear', 'startdayofyear', search.NumberField, as_int),
+    ('enddayofyear', 'enddayofyear', search.NumberField, as_int),
+
+    ### LOCATION ###
+    ('continent', 'continent', search.TextField, None),
+    ('country', 'country', search.TextField, None),
+    ('stateprovince', 'stateprovince', search.TextField, None),
+    ('county', 'county', search.TextField, None),
+    ('municipality', 'municipality', search.TextField, None),
+    ('island', 'island', search.TextField, None),
+    ('islandgroup', 'islandgroup', search.TextField, None),
+    ('waterbody', 'waterbody', search.TextField, None),
+    ('locality', 'locality', search.TextField, None),
+    ('geodeticdatum', 'geodeticdatum', search.TextField, None),
+    ('georeferencedby', 'georeferencedby', search.TextField, None),
+    ('georeferenceverificationstatus', 'georeferenceverificationstatus', 
+        search.TextField, None),
+    # The data type for location is a GeoPoint. Create one from lat and lng ignoring
+    # datum. To do this correctly, the lat and lng should be transformed to WGS84 
+    # before this.
+    (('decimallatitude', 'decimallongitude'), 'location', search.GeoField, _location),
+    ('coordinateuncertaintyinmeters', 'coordinateuncertaintyinmeters', 
+        search.NumberField, as_int),
+
+    ### GEOLOGICAL CONTEXT ###
+    ('bed', 'bed', search.TextField, None),
+    ('formation', 'formation', search.TextField, None),
+    ('group', 'group', search.TextField, None),
+    ('member', 'member', search.TextField, None),
+
+    ### IDENTIFICATION ###
+    ('typestatus', 'typestatus', search.TextField, None),
+
+    ### TAXON ###
+    ('kingdom', 'kingdom', search.AtomField, None),
+    ('phylum', 'phylum', search.AtomField, None),
+    ('class', 'class', search.AtomField, None),
+    ('order', 'order', search.AtomField, None),
+    ('family', 'family', search.AtomField, None),
+    ('genus', 'genus', search.AtomField, None),
+    ('specificepithet', 'specificepithet', search.TextField, None),
+    ('infraspecificepithet', 'infraspecificepithet', search.TextField, None),
+    ('scientificname', 'scientificname', search.TextField, None),
+    ('vernacularname', 'vernacularname', search.TextField, None),
+
+    ### TRAIT ###
+    ('lengthtype', 'lengthtype', search.TextField, None),
+    ('lengthinmm', 'lengthinmm', search.NumberField, as_float),
+    ('massing', 'massing', search.NumberField, as_float),
+
+    ### DATA SET ###
+    ('gbifdatasetid', 'gbifdatasetid', search.AtomField, None),
+    ('gbifpublisherid', 'gbifpublisherid', search.AtomField, None),
+    ('networks', 'networks', search.TextField, None),
+    ('migrator', 'migrator', search.TextField, None),
+    ('orgcountry', 'orgcountry', search.TextField, None),
+    ('orgstateprovince', 'orgstateprovince', search.TextField, None),
+
+    ### BOOLEANS ###
+    ('haslicense', 'haslicense', search.AtomField, None),
+    ('hasmedia', 'hasmedia', search.AtomField, None),
+    ('hastissue', 'hastissue', search.AtomField, None),
+    ('hastypestatus', 'hastypestatus', search.AtomField, None),
+    ('isfossil', 'isfossil', search.AtomField, None),
+    ('isarch', 'isarch', search.AtomField, None),
+    ('mappable', 'mappable', search.AtomField, None),
+    ('wascaptive', 'wascaptive', search.AtomField, None),
+    ('wasinvasive', 'wasinvasive', search.AtomField, None),
+    ('haslength', 'haslength', search.AtomField, None),
+    ('haslifestage', 'haslifestage', search.AtomField, None),
+    ('hasmass', 'hasmass', search.AtomField, None),
+    ('hassex', 'hassex', search.AtomField, None),
+
+    ### INDEX ###
+    # rank and hashid are required. Rows where they are not integers are rejected.
+    ('rank', 'rank', search.NumberField, int),
+    ('vntype', 'vntype', search.AtomField, None),
+    ('hashid', 'hashid', search.NumberField, int)]
+
+# Columns that have the same value in (almost) every row of a data set. The fields built
+# from them are shared by all the documents of a data set through DATASET_FIELD_CACHE.
+DATASET_COLUMNS = [
+    'icode', 'gbifdatasetid', 'gbifpublisherid', 'license', 'networks', 'migrator',
+    'orgcountry', 'orgstateprovince']
+
+def compile_field_plan(schema, header, dataset_columns=()):
+    """ Compile an index schema into the plans build_document runs every row through.
+    parameters:
+        schema - list of (source column, index field name, field class, converter) 
+            entries (required)
+        header - list of the column names of the input rows (required)
+        dataset_columns - source columns of the fields taken as they are that are shared
+            by the rows of a data set (optional)
+    returns:
+        a tuple (field_plan, converted_field_plan, dataset_field_plan) where field_plan
+        and dataset_field_plan are lists of (position, name, field class) for the fields
+        taken as they are, split by whether their source is in dataset_columns, and 
+        converted_field_plan is a list of (positions, name, field class, converter) for
+        the converted fields. Positions are indexes of source columns in header.
+    raises:
+        ValueError if a source column is not in header
+    """
+    field_plan = []
+    converted_field_plan = []
+    dataset_field_plan = []
+    for source, name, field_class, converter in schema:
+        if converter is None and source in dataset_columns:
+            dataset_field_plan.append((header.index(source), name, field_class))
+        elif converter is None:
+            field_plan.append((header.index(source), name, field_class))
+        else:
+            if not isinstance(source, tuple):
+                source = (source,)
+            positions = tuple([header.index(column) for column in source])
+            converted_field_plan.append((positions, name, field_class, converter))
+    return field_plan, converted_field_plan, dataset_field_plan
+
+def compile_size_plan(schema, header):
+    """ Compile what fit_document needs to know about an index schema.
+    parameters:
+        schema - list of (source column, index field name, field class, converter) 
+            entries (required)
+        header - list of the column names of the input rows (required)
+    returns:
+        a tuple (atom_positions, text_positions, fixed_size) where atom_positions and 
+        text_positions are the positions in header of the columns taken as they are 
+        into atom and text fields, and fixed_size bounds the size of a document 
+        without its text values or verbatim record. 
+    """
+    atom_positions = []
+    text_positions = []
+    # lastindexed and the verbatim record or its digest are not in the schema.
+    fixed_size = 2 * FIELD_SIZE_OVERHEAD + len('lastindexed') + len('verbatim_record')
+    for source, name, field_class, converter in schema:
+        fixed_size += len(name) + FIELD_SIZE_OVERHEAD
+        if converter is not None:
+            continue
+        if issubclass(field_class, search.AtomField):
+            atom_positions.append(header.index(source))
+            fixed_size += MAX_ATOM_LENGTH
+        elif issubclass(field_class, (search.TextField, search.HtmlField)):
+            text_positions.append(header.index(source))
+    return atom_positions, text_positions, fixed_size
+
+class FieldCache(object):
+    """A least recently used cache of lists of prebuilt search fields."""
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._fields = OrderedDict()
+        self._last_key = None
+        self._last_fields = None
+
+    def get(self, key):
+        """Return the fields cached for key, or None."""
+        # Consecutive rows nearly always come from the same data set.
+        if key == self._last_key:
+            return self._last_fields
+        fields = self._fields.pop(key, None)
+        if fields is not None:
+            self._fields[key] = fields
+            self._last_key, self._last_fields = key, fields
+        return fields
+
+    def put(self, key, fields):
+        """Cache fields for key, evicting the least recently used entry if full."""
+        self._fields[key] = fields
+        if len(self._fields) > self.max_size:
+            self._fields.popitem(last=False)
+        self._last_key, self._last_fields = key, fields
+
+FIELD_PLAN, CONVERTED_FIELD_PLAN, DATASET_FIELD_PLAN = \
+    compile_field_plan(INDEX_SCHEMA, HEADER, DATASET_COLUMNS)
+DATASET_KEY = itemgetter(*[position for position, _, _ in DATASET_FIELD_PLAN])
+# Shared by all the documents built in this instance, which is where the slices of a 
+# shard run one after another.
+DATASET_FIELD_CACHE = FieldCache(64)
+KEYNAME = HEADER.index('keyname')
+RANK = HEADER.index('rank')
+HASHID = HEADER.index('hashid')
+DATASET = HEADER.index('gbifdatasetid')
+CLASS = HEADER.index('class')
+KINGDOM = HEADER.index('kingdom')
+# Characters replaced in the names of the taxon partitions.
+TAXON_CHARACTERS = re.compile('[^a-z0-9]+')
+ATOM_POSITIONS, TEXT_POSITIONS, FIXED_DOCUMENT_SIZE = \
+    compile_size_plan(INDEX_SCHEMA, HEADER)
+
 # def _w3c_eventdate(rec):
 #     """Construct a W3C datetime from year, month, and day, if possible."""
 #     if rec.has_key('day') is False:
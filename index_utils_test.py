@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Tests for index_utils.py. They need the App Engine SDK on the python path, but no
+# services.
+#
+# Example:
+#
+# python index_utils_test.py
+
+__author__ = "John Wieczorek"
+__contributors__ = "Aaron Steele, John Wieczorek"
+__copyright__ = "Copyright 2018 vertnet.org"
+__version__ = "index_utils_test.py 2018-04-07T19:30-3:00"
+
+import json
+import os
+import random
+import unittest
+
+# index_utils reads it when it is loaded.
+os.environ.setdefault('SERVER_SOFTWARE', 'Development/2.0')
+
+from google.appengine.api import search
+import index_utils
+from field_utils import decode_row
+from index_utils import HEADER
+
+# The fields of the documents index_record built before INDEX_SCHEMA, as
+# (field name, source column).
+BASELINE_TEXT_FIELDS = [
+    ('institutioncode', 'icode'), ('collectioncode', 'collectioncode'),
+    ('catalognumber', 'catalognumber'), ('license', 'license'),
+    ('recordedby', 'recordedby'), ('recordnumber', 'recordnumber'),
+    ('fieldnumber', 'fieldnumber'), ('establishmentmeans', 'establishmentmeans'),
+    ('sex', 'sex'), ('lifestage', 'lifestage'), ('preparations', 'preparations'),
+    ('reproductivecondition', 'reproductivecondition'), ('eventdate', 'eventdate'),
+    ('continent', 'continent'), ('country', 'country'),
+    ('stateprovince', 'stateprovince'), ('county', 'county'),
+    ('municipality', 'municipality'), ('island', 'island'),
+    ('islandgroup', 'islandgroup'), ('waterbody', 'waterbody'),
+    ('locality', 'locality'), ('geodeticdatum', 'geodeticdatum'),
+    ('georeferencedby', 'georeferencedby'),
+    ('georeferenceverificationstatus', 'georeferenceverificationstatus'),
+    ('bed', 'bed'), ('formation', 'formation'), ('group', 'group'),
+    ('member', 'member'), ('typestatus', 'typestatus'),
+    ('specificepithet', 'specificepithet'),
+    ('infraspecificepithet', 'infraspecificepithet'),
+    ('scientificname', 'scientificname'), ('vernacularname', 'vernacularname'),
+    ('lengthtype', 'lengthtype'), ('networks', 'networks'),
+    ('migrator', 'migrator'), ('orgcountry', 'orgcountry'),
+    ('orgstateprovince', 'orgstateprovince')]
+BASELINE_ATOM_FIELDS = [
+    'dctype', 'basisofrecord', 'iptrecordid', 'kingdom', 'phylum', 'class', 'order',
+    'family', 'genus', 'gbifdatasetid', 'gbifpublisherid', 'haslicense', 'hasmedia',
+    'hastissue', 'hastypestatus', 'isfossil', 'isarch', 'mappable', 'wascaptive',
+    'wasinvasive', 'haslength', 'haslifestage', 'hasmass', 'hassex', 'vntype']
+BASELINE_INT_FIELDS = [
+    'rank', 'hashid', 'year', 'month', 'day', 'startdayofyear', 'enddayofyear',
+    'coordinateuncertaintyinmeters']
+BASELINE_FLOAT_FIELDS = ['lengthinmm', 'massing']
+
+def baseline_fields(data, indexdate):
+    """ The fields the baseline index_record built from a row dictionary, as sorted
+    (name, field class name, value) tuples without the verbatim record.
+    """
+    fields = [('lastindexed', 'TextField', indexdate)]
+    fields += [(name, 'TextField', data.get(column))
+               for name, column in BASELINE_TEXT_FIELDS]
+    fields += [(name, 'AtomField', data.get(name)) for name in BASELINE_ATOM_FIELDS]
+    for name in BASELINE_INT_FIELDS:
+        v = index_utils.as_int(data.get(name))
+        if v is not None:
+            fields.append((name, 'NumberField', v))
+    for name in BASELINE_FLOAT_FIELDS:
+        v = index_utils.as_float(data.get(name))
+        if v is not None:
+            fields.append((name, 'NumberField', v))
+    location = index_utils._location(data.get('decimallatitude'),
+                                     data.get('decimallongitude'))
+    if location is not None:
+        fields.append(('location', 'GeoField',
+                       (location.latitude, location.longitude)))
+    return sorted(fields)
+
+def document_fields(doc):
+    """ The fields of a document as sorted (name, field class name, value) tuples
+    without the verbatim record.
+    """
+    fields = []
+    for field in doc.fields:
+        if field.name == 'verbatim_record':
+            continue
+        value = field.value
+        if isinstance(value, search.GeoPoint):
+            value = (value.latitude, value.longitude)
+        fields.append((field.name, field.__class__.__name__, value))
+    return sorted(fields)
+
+# Values the fuzzed columns take, so that the converted fields are sometimes numbers,
+# sometimes not and sometimes missing.
+FUZZ_VALUES = ['', '', '', ' ', '0', '7', '-12', '3.25', '91', '-181', '1e3', 'x',
+               'Mus musculus', ' spaced\r\nout ', '\xc3\xa9t\xc3\xa9']
+
+def fuzzed_row(rnd):
+    """A random row with every column of HEADER and integer rank and hashid."""
+    values = []
+    for name in HEADER:
+        if name == 'keyname':
+            values.append('key-%d' % rnd.randint(0, 10**9))
+        elif name in ('rank', 'hashid'):
+            values.append(str(rnd.randint(0, 10**6)))
+        elif name == 'gbifdatasetid':
+            # Few data sets, so that documents share cached data set fields.
+            values.append('dataset-%d' % rnd.randint(0, 3))
+        else:
+            values.append(rnd.choice(FUZZ_VALUES))
+    return '\t'.join(values)
+
+class BuildDocumentTest(unittest.TestCase):
+
+    def test_matches_baseline_on_fuzzed_rows(self):
+        rnd = random.Random(20180407)
+        for _ in range(500):
+            row = fuzzed_row(rnd)
+            values, data = decode_row(row, HEADER)
+            doc = index_utils.build_document(values, json.dumps(data), '2018-04-07')
+            self.assertEqual(data['keyname'], doc.doc_id)
+            self.assertEqual(int(data['rank']), doc.rank)
+            self.assertEqual(baseline_fields(data, '2018-04-07'), document_fields(doc))
+            verbatim = [f.value for f in doc.fields if f.name == 'verbatim_record']
+            self.assertEqual([json.dumps(data)], verbatim)
+
+class FieldCacheTest(unittest.TestCase):
+
+    def test_get_and_put(self):
+        cache = index_utils.FieldCache(2)
+        self.assertEqual(None, cache.get('a'))
+        cache.put('a', ['A'])
+        self.assertEqual(['A'], cache.get('a'))
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(['A'], cache.get('a'))
+
+    def test_evicts_least_recently_used(self):
+        cache = index_utils.FieldCache(2)
+        cache.put('a', ['A'])
+        cache.put('b', ['B'])
+        self.assertEqual(['A'], cache.get('a'))
+        cache.put('c', ['C'])
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(['A'], cache.get('a'))
+        self.assertEqual(['C'], cache.get('c'))
+
+    def test_evicted_keys_are_not_returned(self):
+        cache = index_utils.FieldCache(1)
+        cache.put('a', ['A'])
+        self.assertEqual(['A'], cache.get('a'))
+        cache.put('b', ['B'])
+        cache.put('c', ['C'])
+        self.assertEqual(None, cache.get('b'))
+        self.assertEqual(None, cache.get('a'))
+        self.assertEqual(['C'], cache.get('c'))
+
+    def test_documents_share_data_set_fields(self):
+        values, data = decode_row(fuzzed_row(random.Random(1)), HEADER)
+        first = index_utils.build_document(list(values), json.dumps(data), '2018-04-07')
+        second = index_utils.build_document(list(values), json.dumps(data), '2018-04-07')
+        shared = len(index_utils.DATASET_FIELD_PLAN) + 1
+        self.assertEqual('lastindexed', first.fields[0].name)
+        for a, b in zip(first.fields[:shared], second.fields[:shared]):
+            self.assertTrue(a is b)
+
+def counter():
+    """A dictionary of counts and the incr function that fills it."""
+    counts = {}
+    def incr(name, delta=1):
+        counts[name] = counts.get(name, 0) + delta
+    return counts, incr
+
+class FitDocumentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.values = [None] * len(HEADER)
+        self.values[index_utils.KEYNAME] = 'key-1'
+        self.atom = index_utils.ATOM_POSITIONS[0]
+        self.text, self.other_text = index_utils.TEXT_POSITIONS[:2]
+
+    def verbatim(self):
+        return json.dumps(dict([(name, v) for name, v in zip(HEADER, self.values)
+                                if v is not None]))
+
+    def text_size(self):
+        return sum([len(self.values[p]) for p in index_utils.TEXT_POSITIONS
+                    if self.values[p] is not None])
+
+    def test_small_document_is_unchanged(self):
+        self.values[self.atom] = 'atom'
+        self.values[self.text] = 'text'
+        values = list(self.values)
+        verbatim = self.verbatim()
+        counts, incr = counter()
+        self.assertEqual(verbatim, index_utils.fit_document(self.values, verbatim,
+                                                            incr=incr))
+        self.assertEqual(values, self.values)
+        self.assertEqual({}, counts)
+
+    def test_long_atom_is_truncated(self):
+        self.values[self.atom] = 'a' * (index_utils.MAX_ATOM_LENGTH + 10)
+        counts, incr = counter()
+        index_utils.fit_document(self.values, self.verbatim(), incr=incr)
+        self.assertEqual('a' * index_utils.MAX_ATOM_LENGTH, self.values[self.atom])
+        self.assertEqual({index_utils.COUNTER_ATOM_TRUNCATED: 1}, counts)
+
+    def test_verbatim_is_dropped_before_text_is_truncated(self):
+        self.values[self.text] = 't' * 600000
+        counts, incr = counter()
+        self.assertEqual(None, index_utils.fit_document(self.values, self.verbatim(),
+                                                        incr=incr))
+        self.assertEqual('t' * 600000, self.values[self.text])
+        self.assertEqual({index_utils.COUNTER_VERBATIM_DROPPED: 1}, counts)
+
+    def test_longest_text_is_truncated(self):
+        self.values[self.text] = 't' * 800000
+        self.values[self.other_text] = 'o' * 400000
+        counts, incr = counter()
+        self.assertEqual(None, index_utils.fit_document(self.values, self.verbatim(),
+                                                        incr=incr))
+        self.assertEqual('o' * 400000, self.values[self.other_text])
+        self.assertEqual(index_utils.MAX_DOCUMENT_SIZE,
+                         index_utils.FIXED_DOCUMENT_SIZE + self.text_size())
+        self.assertEqual({index_utils.COUNTER_VERBATIM_DROPPED: 1,
+                          index_utils.COUNTER_TEXT_TRUNCATED: 1}, counts)
+
+    def test_verbatim_in_datastore_is_kept(self):
+        self.values[self.text] = 't' * 800000
+        self.values[self.other_text] = 'o' * 400000
+        verbatim = self.verbatim()
+        counts, incr = counter()
+        self.assertEqual(verbatim, index_utils.fit_document(
+            self.values, verbatim, index_utils.VERBATIM_IN_DATASTORE, incr))
+        self.assertTrue(index_utils.FIXED_DOCUMENT_SIZE + self.text_size() <=
+                        index_utils.MAX_DOCUMENT_SIZE)
+        self.assertEqual({index_utils.COUNTER_TEXT_TRUNCATED: 1}, counts)
+
+    def test_same_row_is_fit_the_same_way(self):
+        self.values[self.text] = '\xc3\xa9' * 400000
+        self.values[self.other_text] = 'o' * 700000
+        values = list(self.values)
+        verbatim = self.verbatim()
+        index_utils.fit_document(self.values, verbatim)
+        index_utils.fit_document(values, verbatim)
+        self.assertEqual(values, self.values)
+        self.assertTrue(index_utils.FIXED_DOCUMENT_SIZE + self.text_size() <=
+                        index_utils.MAX_DOCUMENT_SIZE)
+        # The truncated value is still valid UTF-8.
+        self.values[self.text].decode('utf-8')
+
+class TruncateUtf8Test(unittest.TestCase):
+
+    def test_ascii(self):
+        self.assertEqual('abc', index_utils.truncate_utf8('abcdef', 3))
+
+    def test_does_not_split_characters(self):
+        value = 'a\xc3\xa9\xe2\x82\xacb'
+        self.assertEqual('a', index_utils.truncate_utf8(value, 1))
+        self.assertEqual('a', index_utils.truncate_utf8(value, 2))
+        self.assertEqual('a\xc3\xa9', index_utils.truncate_utf8(value, 3))
+        self.assertEqual('a\xc3\xa9', index_utils.truncate_utf8(value, 4))
+        self.assertEqual('a\xc3\xa9', index_utils.truncate_utf8(value, 5))
+        self.assertEqual('a\xc3\xa9\xe2\x82\xac', index_utils.truncate_utf8(value, 6))
+
+    def test_unicode(self):
+        self.assertEqual(u'a\xe9', index_utils.truncate_utf8(u'a\xe9\u20acb', 2))
+
+if __name__ == '__main__':
+    unittest.main()
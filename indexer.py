@@ -18,9 +18,11 @@ __copyright__ = "Copyright 2018 vertnet.org"
 __version__ = "indexer.py 2018-04-07T19:13-3:00"
 
 # This module contains request handlers for admin APIs.
+import json
 import logging
 import os
 import time
+import urllib
 import webapp2
 import index_utils
 import cloudstorage as gcs
@@ -56,9 +58,225 @@ class IndexJob(ndb.Model):
     bucket_name = ndb.StringProperty()
     files_list = ndb.StringProperty()
     namespace = ndb.StringProperty()
+    index_name = ndb.StringProperty()
+    incremental = ndb.BooleanProperty(default=False)
     done = ndb.BooleanProperty(default=False)
     failures = ndb.ComputedProperty(lambda self: len(self.failed_logs) > 1)
+    shard_count = ndb.IntegerProperty(default=0)
+    scheduled = ndb.BooleanProperty(default=False)
+    alias = ndb.StringProperty()
 
+class IndexAlias(ndb.Model):
+    """
+    An alias of an index for blue/green reindexing. The namespace and index_name are
+    the side the alias points to. The inactive side is the one the job mrid started
+    with &alias=<alias> builds, or the side the alias pointed to before the last
+    switch. Stored with the alias as id.
+    """
+    namespace = ndb.StringProperty()
+    index_name = ndb.StringProperty()
+    inactive_namespace = ndb.StringProperty()
+    inactive_index_name = ndb.StringProperty()
+    mrid = ndb.StringProperty()
+    switched = ndb.DateTimeProperty()
+
+class PendingIndexJob(ndb.Model):
+    """
+    An IndexGcsPath request with &scheduled=1 waiting for IndexDispatch to start it. 
+    Pending jobs are started by ascending priority, then in the order they came in.
+    """
+    query_string = ndb.TextProperty()
+    priority = ndb.IntegerProperty()
+    shard_count = ndb.IntegerProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+
+class IndexScheduler(ndb.Model):
+    """
+    The jobs started by IndexDispatch that are not finalized yet, as a dictionary of 
+    their shard counts by mrid. There is a single one, with id SCHEDULER_ID.
+    """
+    running = ndb.JsonProperty()
+
+SCHEDULER_ID = 'scheduler'
+# Scheduled jobs are not started while this many are running, or while the shards of 
+# the running jobs and those of the next job would be more than SCHEDULER_MAX_SHARDS.
+SCHEDULER_MAX_JOBS = 4
+SCHEDULER_MAX_SHARDS = 64
+# Seconds to wait after a job is scheduled before dispatching, so that a burst of
+# requests is dispatched together and by priority.
+SCHEDULER_DISPATCH_DELAY = 10
+
+def dispatch_later(countdown=0):
+    """Queue a task to start the scheduled jobs that can run."""
+    taskqueue.add(url='/index-dispatch', queue_name='index-dispatch', 
+                  countdown=countdown)
+
+@ndb.transactional
+def update_running(started=None, finished=None):
+    """
+    Record jobs started by IndexDispatch and jobs finalized in IndexScheduler.
+    parameters:
+        started - dictionary of the shard counts of the started jobs by mrid (optional)
+        finished - mrid of a finalized job (optional)
+    """
+    scheduler = IndexScheduler.get_or_insert(SCHEDULER_ID)
+    running = scheduler.running or {}
+    running.update(started or {})
+    running.pop(finished, None)
+    scheduler.running = running
+    scheduler.put()
+
+# Seconds an instance keeps the sides of the aliases it resolved. Other instances see a
+# switch within this time.
+ALIAS_CACHE_SECONDS = 30
+# The inactive side of an alias is switched to only if it has at least this share of 
+# the documents of the active side.
+ALIAS_MIN_DOCUMENT_RATIO = 0.95
+# (expiry time, (namespace, index_name) or None) of the aliases resolved, by alias.
+_alias_cache = {}
+
+def resolve_alias(alias):
+    """
+    Return the (namespace, index_name) an alias points to, or None if it does not 
+    point to any index yet.
+    """
+    now = time.time()
+    cached = _alias_cache.get(alias)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    record = IndexAlias.get_by_id(alias)
+    side = None
+    if record is not None and record.namespace:
+        side = (record.namespace, record.index_name)
+    _alias_cache[alias] = (now + ALIAS_CACHE_SECONDS, side)
+    return side
+
+@ndb.transactional
+def build_alias(alias, namespace, index_name, mrid):
+    """Record the job building the inactive side of an alias, which may be new."""
+    record = IndexAlias.get_by_id(alias) or IndexAlias(id=alias)
+    record.inactive_namespace = namespace
+    record.inactive_index_name = index_name
+    record.mrid = mrid
+    record.put()
+
+@ndb.transactional
+def switch_alias(alias, mrid):
+    """
+    Point an alias to its inactive side and keep the side it pointed to as the 
+    inactive side. 
+    parameters:
+        alias - the alias to switch (required)
+        mrid - the job that built the inactive side, None to switch back after a 
+               switch (required)
+    returns:
+        the switched IndexAlias, or None if the inactive side changed in the meantime
+    """
+    record = IndexAlias.get_by_id(alias)
+    if record is None or record.mrid != mrid or not record.inactive_namespace:
+        return None
+    record.namespace, record.inactive_namespace = \
+        record.inactive_namespace, record.namespace
+    record.index_name, record.inactive_index_name = \
+        record.inactive_index_name, record.index_name
+    # The side switched from was live, switching back to it needs no job.
+    record.mrid = None
+    record.switched = datetime.now()
+    record.put()
+    _alias_cache.pop(alias, None)
+    return record
+
+def count_documents(index_name, namespace):
+    """
+    Return the number of documents in the partitions of an index, exact up to 
+    search.MAXIMUM_NUMBER_FOUND_ACCURACY documents per partition, estimated above.
+    """
+    options = search.QueryOptions(limit=1, ids_only=True, 
+        number_found_accuracy=search.MAXIMUM_NUMBER_FOUND_ACCURACY)
+    count = 0
+    for partition in index_utils.partition_indexes(index_name, namespace):
+        index = search.Index(partition, namespace=namespace)
+        count += index.search(search.Query('', options=options)).number_found
+    return count
+
+def verify_alias(record):
+    """
+    Check that the inactive side of an alias can be switched to: the job that built 
+    it is done without failures, and it has at least ALIAS_MIN_DOCUMENT_RATIO of the 
+    documents of the active side.
+    returns:
+        a list of the reasons not to switch, empty if none
+    """
+    job = IndexJob.get_by_id(record.mrid)
+    if job is None:
+        return ['Job %s not found.' % record.mrid]
+    if not job.done:
+        return ['Job %s is not finished.' % record.mrid]
+    problems = []
+    if job.failures:
+        problems.append('Job %s had failures: %s' % (record.mrid, job.failed_logs))
+    inactive = count_documents(record.inactive_index_name, record.inactive_namespace)
+    if inactive < 1:
+        problems.append('No documents in %s.%s.' % 
+                        (record.inactive_namespace, record.inactive_index_name))
+    if record.namespace:
+        active = count_documents(record.index_name, record.namespace)
+        if inactive < ALIAS_MIN_DOCUMENT_RATIO * active:
+            problems.append('%s documents in %s.%s, %s in %s.%s.' % 
+                (inactive, record.inactive_namespace, record.inactive_index_name, 
+                 active, record.namespace, record.index_name))
+    return problems
+
+def delete_matching(querystr, index_name, namespace, limit):
+    """
+    Delete up to limit documents matching a query from the partitions of an index.
+    parameters:
+        querystr - search query of the documents to delete (required)
+        index_name - name of the index (required)
+        namespace - namespace of the index (required)
+        limit - maximum number of documents to delete (required)
+    returns:
+        the number of documents deleted
+    """
+    deleted = 0
+    for partition in index_utils.partition_indexes(index_name, namespace):
+        if deleted >= limit:
+            break
+        query = search.Query(querystr, 
+            options=search.QueryOptions(limit=limit-deleted, ids_only=True))
+        index = search.Index(partition, namespace=namespace)
+        ids = [doc.doc_id for doc in index.search(query)]
+        if ids:
+            logging.info('Deleting %s documents from %s.\nFirst: %s\nLast:  %s' % 
+                        (len(ids), partition, ids[0], ids[-1]))
+            index.delete(ids)
+            forget_documents(ids, index_name, namespace)
+            deleted += len(ids)
+    return deleted
+
+def forget_documents(ids, index_name, namespace):
+    """
+    Delete what is stored besides the index for documents deleted from an index: 
+    their VerbatimRecords, and their entries in the manifest of incremental jobs, 
+    which would otherwise keep the next incremental job from putting them again.
+    """
+    index_utils.delete_verbatim_records(ids, namespace)
+    index_utils.forget_indexed_records(ids, index_name, namespace)
+
+def find_document(doc_id, index_name, namespace):
+    """
+    Find a document in the partitions of an index.
+    returns:
+        (search.Index the document is in, document), or (search.Index of the first 
+        partition, None) if it is in none of them
+    """
+    partitions = index_utils.partition_indexes(index_name, namespace)
+    for partition in partitions:
+        index = search.Index(partition, namespace=namespace)
+        doc = index.get(doc_id)
+        if doc:
+            return index, doc
+    return search.Index(partitions[0], namespace=namespace), None
 
 class ListIndexes(webapp2.RequestHandler):
     def get(self):
@@ -117,53 +335,239 @@ class IndexGcsPath(webapp2.RequestHandler):
        &bucket_name=vertnet-harvesting
        &files_list=processed/KU/gbifdatasetid/*
        &shard_count=1
+
+       Files ending in .gz are decompressed as they are read. Write them with
+       tools/gzip_blocks.py and copy the .gz.members file next to them so that they can
+       be split across shards and resumed by each slice without decompressing them 
+       again from the start. Files over 4MB without it fail the job. Write a .lines 
+       index of other files with tools/line_index.py to split them at lines and count 
+       io-read-rows out of io-total-rows in the mapreduce status.
+
+       Add &precompiled=1 to index files written by tools/compile_rows.py instead, 
+       which hold the rows already split and cleaned. Each file is read by one shard,
+       and the rows come in the blocks of ROWS_PER_RECORD rows they were compiled with,
+       which processing_rate is converted with, so lines_per_block, 
+       bytes_per_shard, prefetch and work_stealing do not apply.
+
+       Add &verbatim_store=datastore to keep verbatim records out of the documents.
+       See VerbatimRecords.
+
+       The mapper is called with blocks of lines_per_block lines (default 100). 
+       processing_rate is in lines per second per job regardless of the block size.
+       Add &adaptive_rate=1 to start at processing_rate and let the job raise the rate
+       while the Search API keeps up and halve it when puts are throttled. The 
+       throttled documents are counted in search-put-throttled.
+
+       Add &bytes_per_shard=<bytes> to choose the number of shards from the total size
+       of the files instead of shard_count.
+
+       Add &buffer_size=<bytes> to set the size of the GCS reads (default 1MB) and
+       &prefetch=<n> to keep n reads ahead of the lines being indexed (default 2). 
+       With more than one, the reads grow while the indexing waits on them, up to 16MB
+       ahead in all, and shrink again while they arrive ahead of the indexing.
+
+       The listing of the files is kept in memcache for listing_cache_seconds (default
+       300), so that jobs started again on the same files_list do not list the bucket
+       again. Add &listing_cache_seconds=0 after replacing files in the bucket.
+
+       Add &search_puts_in_flight=<n> to let each shard go on reading while n batch 
+       puts to the index are running (default 4). 0 waits for every put.
+
+       Add &scheduled=1 to queue the job instead of starting it. IndexDispatch starts 
+       queued jobs as long as fewer than SCHEDULER_MAX_JOBS jobs and 
+       SCHEDULER_MAX_SHARDS shards are running, smallest first by the size of their 
+       files, or by &priority=<n> if given (lowest first).
+
+       Add &work_stealing=1 to let shards that finished early take over half of the 
+       remaining input of the shards that lag behind.
+
+       Add &partition=hash, taxon or rollover to put the documents in several indexes 
+       instead of index_name: by the hash of their keyname over &partitions=<n> indexes
+       (default 4), in an index per class (or kingdom), or in one index at a time, 
+       rolling over to a new one when it nears its storage limit. The partitions are
+       in the IndexPartitions map of index_name, see IndexPartitionMap, and later jobs
+       on index_name follow the map. The delete and find handlers take index_name and
+       cover all of its partitions. Records re-indexed with a different class, or after
+       a rollover, keep their older document in its partition until it is deleted.
+
+       Add &alias=<alias> to build a new side of the index for IndexAlias <alias> 
+       while clients search the side it points to. The job puts the documents in the
+       namespace <alias>-<time>, and index_name or that of the current side. When the
+       job is finished, IndexAliasSwitch checks the new side and points the alias to 
+       it. Full reindexes only, &alias with &incremental=1 is refused with a 400, the 
+       new side would start with an empty manifest.
+
+       Add &incremental=1 to put only the records whose hashid changed since they were
+       last put to the index. The keynames of the records of the indexed data sets that
+       were not in the files are written to disappeared/<mrid>.txt in the bucket, the 
+       write_path of the IndexJob, so that they can be deleted.
        """
     def get(self):
         """Fires off an indexing MR job over files in GCS at supplied path."""
+        error = self.invalid(self.request)
+        if error:
+            logging.warning(error)
+            self.response.set_status(400)
+            self.response.out.write(error)
+            return
+        if self.request.get('scheduled'):
+            body = self.schedule(self.request)
+        else:
+            mrid, body = self.start(self.request)
+        logging.warning(body)
+        self.response.out.write(body)
+
+    @staticmethod
+    def invalid(request):
+        """Returns why the parameters of a request can not start a job, or None."""
+        if request.get('alias') and request.get('incremental'):
+            return ('An incremental job can not build a new side of alias %s, its '
+                    'manifest would be empty. Remove &incremental or &alias.<br>' % 
+                    request.get('alias'))
+        return None
+
+    @staticmethod
+    def schedule(request):
+        """Queue a PendingIndexJob for a request and dispatch it shortly."""
+        priority = request.get_range('priority', default=None)
+        if priority is None:
+            # Smaller jobs first, by the size of their files.
+            listing = input_readers.GoogleCloudStorageLineInputReader._list_files(
+                request.get('bucket_name'), [request.get('files_list')], None, None, 
+                request.get_range('listing_cache_seconds', min_value=0, default=300))
+            priority = sum(file_stats.st_size for file_stats in listing)
+        query_string = urllib.urlencode([(name, value.encode('utf-8')) for name, value 
+                                         in request.GET.items() if name != 'scheduled'])
+        PendingIndexJob(query_string=query_string, priority=priority,
+                        shard_count=request.get_range('shard_count', default=8)).put()
+        dispatch_later(SCHEDULER_DISPATCH_DELAY)
+        body = 'Scheduled indexing resource: %s<br>' % request.get('files_list')
+        body += 'Priority: %s<br>' % priority
+        return body
+
+    @staticmethod
+    def start(request, scheduled=False):
+        """Starts the indexing MR job of a request. Returns its mrid and a description."""
         # Note: To make this work, the Mapreduce library had to be modified to include the 
         # custom GoogleCloudStorageLineInputReader. Be aware of this if updating MapReduce.
         global __version__
         input_class = (input_readers.__name__ + "." +
                     input_readers.GoogleCloudStorageLineInputReader.__name__)
-        shard_count = self.request.get_range('shard_count', default=8)
-        processing_rate = self.request.get_range('processing_rate', default=100)
+        shard_count = request.get_range('shard_count', default=8)
+        processing_rate = request.get_range('processing_rate', default=100)
+        lines_per_block = request.get_range('lines_per_block', min_value=1, 
+                                            default=100)
         now = datetime.now().isoformat().replace(':', '-')
-        namespace = self.request.get('namespace', 'ns-' + now)
-        index_name = self.request.get('index_name', 'dwc-' + now)
-        bucket_name = self.request.get('bucket_name')
-        files_list = self.request.get('files_list')
+        namespace = request.get('namespace', 'ns-' + now)
+        index_name = request.get('index_name', 'dwc-' + now)
+        alias = request.get('alias')
+        if alias:
+            # The new side gets a namespace of its own, the sides never mix documents.
+            namespace = '%s-%s' % (alias, now)
+            side = resolve_alias(alias)
+            index_name = request.get('index_name', side[1] if side else 'dwc')
+        bucket_name = request.get('bucket_name')
+        files_list = request.get('files_list')
+        verbatim_store = request.get('verbatim_store', 
+                                     index_utils.VERBATIM_IN_DOCUMENT)
+        incremental = bool(request.get('incremental'))
+        bytes_per_shard = request.get_range('bytes_per_shard', min_value=1)
+        work_stealing = bool(request.get('work_stealing'))
+        buffer_size = request.get_range('buffer_size', min_value=1)
+        prefetch = request.get_range('prefetch', min_value=1, default=2)
+        listing_cache_seconds = request.get_range('listing_cache_seconds', 
+                                                  min_value=0, default=300)
+        precompiled = bool(request.get('precompiled'))
+        search_puts_in_flight = request.get_range('search_puts_in_flight', 
+                                                  min_value=0, default=4)
+        adaptive_rate = bool(request.get('adaptive_rate'))
+        partition = request.get('partition')
+        partitions = request.get_range('partitions', min_value=1, default=4)
+
+        input_reader = {
+            "bucket_name": bucket_name,
+            "objects": [files_list],
+            "lines_per_block": lines_per_block,
+            "prefetch": prefetch,
+            "listing_cache_seconds": listing_cache_seconds
+        }
+        if bytes_per_shard:
+            input_reader["bytes_per_shard"] = bytes_per_shard
+        if buffer_size:
+            input_reader["buffer_size"] = buffer_size
+        if precompiled:
+            input_class = (input_readers.__name__ + "." +
+                input_readers.GoogleCloudStorageRowInputReader.__name__)
+            input_reader = {
+                "bucket_name": bucket_name,
+                "objects": [files_list]
+            }
+            if buffer_size:
+                input_reader["buffer_size"] = buffer_size
+        # The mapreduce rate limit counts map calls, which are blocks of lines.
+        rows_per_call = lines_per_block
+        if precompiled:
+            rows_per_call = input_readers.GoogleCloudStorageRowInputReader.ROWS_PER_RECORD
+
+        if partition:
+            # Before the job starts, so that its first slices find the map.
+            partitions = len(index_utils.create_partitions(
+                index_name, namespace, partition, partitions).partitions)
 
         mrid = control.start_map(
             files_list,
-            "index_utils.build_search_index",
+            "index_utils.SearchIndexMapper",
             input_class,
             {
-                "input_reader": {
-                    "bucket_name": bucket_name,
-                    "objects": [files_list]
-                },
+                "input_reader": input_reader,
                 "bucket_name": bucket_name,
                 "files_list": files_list,
                 "namespace": namespace,
                 "index_name": index_name,
-                "processing_rate": processing_rate,
-                "shard_count": shard_count
+                "indexdate": datetime.now().strftime('%Y-%m-%d'),
+                "processing_rate": processing_rate / float(rows_per_call),
+                "shard_count": shard_count,
+                "verbatim_store": verbatim_store,
+                "incremental": incremental,
+                "work_stealing": work_stealing,
+                "search_puts_in_flight": search_puts_in_flight,
+                "adaptive_rate": adaptive_rate,
+                "search_failure_handler": "index_utils.record_put_failures"
             },
             mapreduce_parameters={'done_callback': '/index-gcs-path-finalize'},
             shard_count=shard_count)
+        if alias:
+            build_alias(alias, namespace, index_name, mrid)
 
         body = 'Indexing resource: %s<br>' % files_list
         body += 'Version: %s<br>' % __version__
         body += 'Namespace: %s<br>' % namespace
         body += 'Index_name: %s<br>' % index_name
+        if alias:
+            body += 'Alias: %s<br>' % alias
         body += 'Processing rate: %s<br>' % processing_rate
+        body += 'Adaptive rate: %s<br>' % adaptive_rate
+        body += 'Lines per block: %s<br>' % lines_per_block
         body += 'Shard count: %s<br>' % shard_count
+        body += 'Bytes per shard: %s<br>' % bytes_per_shard
+        body += 'Work stealing: %s<br>' % work_stealing
+        body += 'Search puts in flight: %s<br>' % search_puts_in_flight
+        body += 'Buffer size: %s<br>' % buffer_size
+        body += 'Prefetch: %s<br>' % prefetch
+        body += 'Listing cache seconds: %s<br>' % listing_cache_seconds
+        body += 'Verbatim store: %s<br>' % verbatim_store
+        body += 'Incremental: %s<br>' % incremental
+        if partition:
+            body += 'Partition: %s<br>' % partition
+            body += 'Partitions: %s<br>' % partitions
+        body += 'Precompiled: %s<br>' % precompiled
         body += 'mrid: %s<br>' % mrid
-        logging.warning(body)
-        self.response.out.write(body)
 
         IndexJob(id=mrid, write_path='write_path', bucket_name=bucket_name, 
-                files_list=files_list, failed_logs=['NONE'], namespace=namespace).put()
+                files_list=files_list, failed_logs=['NONE'], namespace=namespace,
+                index_name=index_name, incremental=incremental, 
+                shard_count=shard_count, scheduled=scheduled, alias=alias).put()
+        return mrid, body
 
     def finalize(self):
         """Finalizes indexing MR job by finalizing files on GCS."""
@@ -173,9 +577,160 @@ class IndexGcsPath(webapp2.RequestHandler):
         if not job:
             return
         logging.info('Finalizing index job for resource %s' % job.resource)
+        failures = index_utils.IndexFailure.query(
+            index_utils.IndexFailure.mrid == mrid).count()
+        if failures > 0:
+            logging.error('%s documents failed to index in job %s' % (failures, mrid))
+            job.failed_logs.append('IndexFailure:%s' % failures)
+            if job.incremental:
+                index_utils.forget_failed_records(mrid)
+        if job.incremental:
+            job.write_path = '/%s/disappeared/%s.txt' % (job.bucket_name, mrid)
+            disappeared = 0
+            with gcs.open(job.write_path, 'w', content_type='text/plain') as f:
+                for keyname in index_utils.disappeared_keys(mrid, job.index_name, 
+                                                            job.namespace):
+                    f.write('%s\n' % keyname)
+                    disappeared += 1
+            logging.info('%s records disappeared in job %s, see %s' % 
+                         (disappeared, mrid, job.write_path))
         job.done = True
         job.put()
         logging.info('Index job finalized for resource %s' % job.resource)
+        if job.scheduled:
+            update_running(finished=mrid)
+            dispatch_later()
+
+class IndexDispatch(webapp2.RequestHandler):
+    """Start the jobs scheduled with IndexGcsPath &scheduled=1 that fit in 
+       SCHEDULER_MAX_JOBS and SCHEDULER_MAX_SHARDS, in the order of their priority. 
+       Runs in the index-dispatch queue, one task at a time, when jobs are scheduled 
+       and when scheduled jobs are finalized. 
+       Example:
+       http://dwc-indexer.vertnet-portal.appspot.com/index-dispatch
+       """
+    def get(self):
+        """Starts the next scheduled jobs."""
+        running = IndexScheduler.get_or_insert(SCHEDULER_ID).running or {}
+        jobs = len(running)
+        shards = sum(running.values())
+        started = 0
+        pending_jobs = PendingIndexJob.query().order(
+            PendingIndexJob.priority, PendingIndexJob.created).fetch(SCHEDULER_MAX_JOBS)
+        for pending in pending_jobs:
+            if jobs >= SCHEDULER_MAX_JOBS:
+                break
+            # A job with more shards than the limit still runs, on its own.
+            if jobs > 0 and shards + pending.shard_count > SCHEDULER_MAX_SHARDS:
+                break
+            mrid, body = IndexGcsPath.start(
+                webapp2.Request.blank('/index-gcs-path?' + pending.query_string), 
+                scheduled=True)
+            logging.warning(body)
+            update_running(started={mrid: pending.shard_count})
+            pending.key.delete()
+            started += 1
+            jobs += 1
+            shards += pending.shard_count
+        body = 'Started %s scheduled jobs. Running: %s jobs, %s shards.' % (
+            started, jobs, shards)
+        logging.info(body)
+        self.response.out.write(body)
+
+class VerbatimRecords(webapp2.RequestHandler):
+    """Get the verbatim records of documents indexed with verbatim_store=datastore in 
+       one round trip, for example for a page of search results.
+       Example:
+       http://dwc-indexer.vertnet-portal.appspot.com/verbatim-records?namespace=index-2014-02-06t2&id=urn:catalog:MVZ:Mamm:1&id=urn:catalog:MVZ:Mamm:2
+
+       Responds with a JSON object of the verbatim record of each id, null for ids
+       without a stored verbatim record.
+       """
+    def get(self):
+        """Looks up the verbatim records of the requested document ids."""
+        namespace = self.request.get('namespace')
+        # Empty ids are not valid keys.
+        ids = [id for id in self.request.get_all('id') if id]
+        records = index_utils.get_verbatim_records(ids, namespace)
+        body = dict((id, json.loads(record) if record else None)
+                    for id, record in zip(ids, records))
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(body))
+
+class IndexPartitionMap(webapp2.RequestHandler):
+    """Get the partitions of an index, for clients to search all of them.
+       Example:
+       http://dwc-indexer.vertnet-portal.appspot.com/index-partitions?namespace=index-2014-02-06t2&index_name=dwc
+
+       Responds with a JSON object of the partition strategy of the index, null if it
+       is not partitioned, and the list of the indexes its documents are in.
+       """
+    def get(self):
+        """Looks up the partition map of the requested index."""
+        index_name, namespace = map(self.request.get, ['index_name', 'namespace'])
+        partitions = index_utils.get_partitions(index_name, namespace)
+        body = {
+            'strategy': partitions.strategy if partitions else None,
+            'partitions': index_utils.partition_indexes(index_name, namespace)
+        }
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps(body))
+
+class IndexAliasResolve(webapp2.RequestHandler):
+    """Get the index an alias points to, for clients to search.
+       Example:
+       http://dwc-indexer.vertnet-portal.appspot.com/index-alias?alias=vertnet
+
+       Responds with a JSON object of the namespace and index_name of the alias, both
+       null if it does not point to an index yet.
+       """
+    def get(self):
+        """Resolves the requested alias."""
+        namespace, index_name = resolve_alias(self.request.get('alias')) or (None, None)
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.out.write(json.dumps({'namespace': namespace, 
+                                            'index_name': index_name}))
+
+class IndexAliasSwitch(webapp2.RequestHandler):
+    """Point an alias to the side built by the last IndexGcsPath job with &alias, once
+       the job is finished without failures and the side has at least 
+       ALIAS_MIN_DOCUMENT_RATIO of the documents of the current side.
+       Example:
+       http://dwc-indexer.vertnet-portal.appspot.com/index-alias-switch?alias=vertnet
+
+       Add &rollback=1 to point the alias back to the side it pointed to before the 
+       last switch. That side is kept until the next job with &alias replaces it, and
+       can be removed with IndexClean after that.
+       """
+    def get(self):
+        """Switches the requested alias."""
+        alias = self.request.get('alias')
+        rollback = bool(self.request.get('rollback'))
+        record = IndexAlias.get_by_id(alias)
+        if record is None or not record.inactive_namespace or \
+            (record.mrid is None) != rollback:
+            body = 'Nothing to switch alias %s to.<br>' % alias
+            logging.warning(body)
+            self.response.out.write(body)
+            return
+        if not rollback:
+            problems = verify_alias(record)
+            if problems:
+                body = 'Not switching alias %s:<br>%s' % (alias, '<br>'.join(problems))
+                logging.warning(body)
+                self.response.out.write(body)
+                return
+        record = switch_alias(alias, record.mrid)
+        if record is None:
+            body = 'Alias %s changed while switching, try again.<br>' % alias
+        else:
+            body = 'Switched alias %s:<br>' % alias
+            body += 'Namespace: %s<br>' % record.namespace
+            body += 'Index_name: %s<br>' % record.index_name
+            body += 'Previous namespace: %s<br>' % record.inactive_namespace
+            body += 'Previous index_name: %s<br>' % record.inactive_index_name
+        logging.warning(body)
+        self.response.out.write(body)
 
 class IndexDeleteResource(webapp2.RequestHandler):
     """Remove the records from an index for a gbifdatasetid.
@@ -236,21 +791,14 @@ class IndexDeleteResource(webapp2.RequestHandler):
         logging.info('Query: %s namespace: %s index: %s' % (querystr, namespace, index_name) )
 
         # Set task queue characteristics in queue.yaml to retry tasks that fail.
-        # Define the query by using a Query object.
-        query = search.Query(querystr, options=search.QueryOptions(limit=bsize, ids_only=True) )
-        index = search.Index(index_name, namespace=namespace)
-        docs = index.search(query)
-        ids = [doc.doc_id for doc in docs]
+        ndocs = delete_matching(querystr, index_name, namespace, bsize)
 
-        if len(ids) < 1:
+        if ndocs < 1:
             logging.info('No documents for resource=%s left to delete in %s.%s.' % 
                         (resource, namespace, index_name) )
             return
 
-        logging.info('Deleting %s documents.\nFirst: %s\nLast:  %s' % 
-                    ( len(ids), ids[0], ids[-1] ) )
-        index.delete(ids)
-        deleted_so_far = deleted_so_far + len(ids)
+        deleted_so_far = deleted_so_far + ndocs
         
         params = dict(index_name=index_name, namespace=namespace, 
                       batch_size=batch_size, max_delete=max_delete, 
@@ -259,7 +807,7 @@ class IndexDeleteResource(webapp2.RequestHandler):
         if dryrun:
             params['dryrun'] = 1
 
-        if deleted_so_far < maxdel and len(ids)==bsize:
+        if deleted_so_far < maxdel and ndocs==bsize:
             body = 'Queuing task index-delete-resource with params %s<br>' % params
             logging.info(body)
             self.response.out.write(body)
@@ -323,21 +871,14 @@ class IndexDeleteDataSet(webapp2.RequestHandler):
         logging.info('Query: %s namespace: %s index: %s' % (querystr, namespace, index_name) )
 
         # Set task queue characteristics in queue.yaml to retry tasks that fail.
-        # Define the query by using a Query object.
-        query = search.Query(querystr, options=search.QueryOptions(limit=bsize, ids_only=True) )
-        index = search.Index(index_name, namespace=namespace)
-        docs = index.search(query)
-        ids = [doc.doc_id for doc in docs]
+        ndocs = delete_matching(querystr, index_name, namespace, bsize)
 
-        if len(ids) < 1:
+        if ndocs < 1:
             logging.info('No documents for gbifdatasetid=%s left to delete in %s.%s.' % 
                         (gbifdatasetid, namespace, index_name) )
             return
 
-        logging.info('Deleting %s documents.\nFirst: %s\nLast:  %s' % 
-                    ( len(ids), ids[0], ids[-1] ) )
-        index.delete(ids)
-        deleted_so_far = deleted_so_far + len(ids)
+        deleted_so_far = deleted_so_far + ndocs
         
         params = dict(index_name=index_name, namespace=namespace, 
                       batch_size=batch_size, max_delete=max_delete, 
@@ -346,7 +887,7 @@ class IndexDeleteDataSet(webapp2.RequestHandler):
         if dryrun:
             params['dryrun'] = 1
 
-        if deleted_so_far < maxdel and len(ids)==bsize:
+        if deleted_so_far < maxdel and ndocs==bsize:
             body = 'Queuing task index-delete-dataset with params %s<br>' % params
             logging.info(body)
             self.response.out.write(body)
@@ -362,12 +903,17 @@ class IndexDeleteDataSet(webapp2.RequestHandler):
                      
 class IndexClean(webapp2.RequestHandler):
     def get(self):
-        """Removes up to max_delete documents from an index in batches of batch_size."""
-        index_name, namespace, id, batch_size, ndeleted, max_delete, dryrun = \
-            map(self.request.get,
+        """
+        Removes up to max_delete documents from an index in batches of batch_size, one
+        partition of the index after the other.
+        """
+        index_name, namespace, id, batch_size, ndeleted, max_delete, dryrun, \
+            partition = map(self.request.get,
                 ['index_name', 'namespace', 'id', 'batch_size', 'ndeleted', 'max_delete', 
-                 'dryrun'])
-        index = search.Index(index_name, namespace=namespace)
+                 'dryrun', 'partition'])
+        partitions = index_utils.partition_indexes(index_name, namespace)
+        if partition not in partitions:
+            partition = partitions[0]
 
         deleted_so_far=0
         if ndeleted is not None and ndeleted != '':
@@ -388,21 +934,28 @@ class IndexClean(webapp2.RequestHandler):
           logging.info('\n==IndexClean(id=%s, %s, %s, %s, %s, %s, %s)==' 
                 % (id, namespace, index_name, batch_size, ndeleted, max_delete, dryrun))
 
-        if id:
-            docs = index.get_range(start_id=id, ids_only=True, limit=to_delete+1,
-                                   include_start_object=True).results
-            if dryrun:
-                logging.info('index.get_range(start_id=%s, ids_only=True, limit=%s, include_start_object=True)' 
-                          % (id, to_delete+1) )
-        else:
-            docs = index.get_range(ids_only=True, limit=to_delete+1).results
-            if dryrun:
-                logging.info('index.get_range(ids_only=True, limit=%s)' % (to_delete+1) )
-
-        if len(docs) < 1:
-            if dryrun:
-                logging.info('No documents left to index.' )
-            return
+        while True:
+            index = search.Index(partition, namespace=namespace)
+            if id:
+                docs = index.get_range(start_id=id, ids_only=True, limit=to_delete+1,
+                                       include_start_object=True).results
+                if dryrun:
+                    logging.info('%s.get_range(start_id=%s, ids_only=True, limit=%s, include_start_object=True)' 
+                              % (partition, id, to_delete+1) )
+            else:
+                docs = index.get_range(ids_only=True, limit=to_delete+1).results
+                if dryrun:
+                    logging.info('%s.get_range(ids_only=True, limit=%s)' 
+                                 % (partition, to_delete+1) )
+            if len(docs) > 0:
+                break
+            # Go on with the next partition, from its start.
+            later = partitions[partitions.index(partition)+1:]
+            if not later:
+                if dryrun:
+                    logging.info('No documents left to index.' )
+                return
+            partition, id = later[0], None
 
         if dryrun:
             logging.info('Got %s documents.' % len(docs) )
@@ -418,6 +971,7 @@ class IndexClean(webapp2.RequestHandler):
         body = 'Cleaning index. Deleting documents:<br>'
         body += 'Namespace: %s<br>' % namespace
         body += 'Index_name: %s<br>' % index_name
+        body += 'Partition: %s<br>' % partition
         body += 'Batch size: %s<br>' % bsize
         body += 'Maximum documents to delete: %s<br>' % maxdel
         body += 'Dryrun: %s' % dryrun
@@ -425,15 +979,24 @@ class IndexClean(webapp2.RequestHandler):
         logging.info(body)
         # Delete all but the last document, which is the key for where to start next.
         index.delete(delete_these)
+        forget_documents(delete_these, index_name, namespace)
    
         deleted_so_far = deleted_so_far + len(delete_these)
         
+        more = len(delete_these)==bsize
+        if not more:
+            # This partition is done, go on with the next one from its start.
+            later = partitions[partitions.index(partition)+1:]
+            if later:
+                partition, next_id, more = later[0], '', True
+
         params = dict(index_name=index_name, namespace=namespace, batch_size=batch_size, 
-                    max_delete=max_delete, ndeleted=deleted_so_far, id=next_id)
+                    max_delete=max_delete, ndeleted=deleted_so_far, id=next_id,
+                    partition=partition)
         if dryrun:
             params['dryrun'] = 1
 
-        if deleted_so_far < maxdel and len(delete_these)==bsize:
+        if deleted_so_far < maxdel and more:
             logging.info('Queuing index-clean task with params %s' % (params) )
             taskqueue.add(url='/index-clean', params=params, queue_name="index-clean")
         else:
@@ -446,10 +1009,9 @@ class IndexFindRecord(webapp2.RequestHandler):
         index_name, namespace, id = \
             map(self.request.get,
                 ['index_name', 'namespace', 'id'])
-        index = search.Index(index_name, namespace=namespace)
 
         if id:
-            doc = index.get(id)
+            index, doc = find_document(id, index_name, namespace)
             if doc:
                 body = 'Found %s:<br>' % id
                 body += 'Namespace: %s<br>' % namespace
@@ -465,7 +1027,7 @@ class IndexFindRecord(webapp2.RequestHandler):
                 missingid=requestargs[0]
                 if missingid is not None:
                     id = '%s&%s' % (id,missingid)
-                    doc = index.get(id)
+                    index, doc = find_document(id, index_name, namespace)
                     body = 'Found %s:<br>' % id
                     body += 'Namespace: %s<br>' % namespace
                     body += 'Index_name: %s<br>' % index_name
@@ -486,10 +1048,9 @@ class IndexDeleteRecord(webapp2.RequestHandler):
         index_name, namespace, id = \
             map(self.request.get,
                 ['index_name', 'namespace', 'id'])
-        index = search.Index(index_name, namespace=namespace)
 
         if id:
-            doc = index.get(id)
+            index, doc = find_document(id, index_name, namespace)
             if doc:
                 body = 'Deleting document:<br>'
                 body += 'Namespace: %s<br>' % namespace
@@ -498,6 +1059,7 @@ class IndexDeleteRecord(webapp2.RequestHandler):
                 logging.info(body)
                 self.response.out.write(body)
                 index.delete(id)
+                forget_documents([id], index_name, namespace)
             else:
                 requestargs = self.request.arguments()
                 requestargs.remove('index_name')
@@ -506,7 +1068,7 @@ class IndexDeleteRecord(webapp2.RequestHandler):
                 missingid=requestargs[0]
                 if missingid is not None:
                     id = '%s&%s' % (id,missingid)
-                    doc = index.get(id)
+                    index, doc = find_document(id, index_name, namespace)
                     body = 'Deleting document with & in it:<br>'
                     body += 'Namespace: %s<br>' % namespace
                     body += 'Index_name: %s<br>' % index_name
@@ -515,6 +1077,7 @@ class IndexDeleteRecord(webapp2.RequestHandler):
                     logging.info(body)
                     self.response.out.write(body)
                     index.delete(id)
+                    forget_documents([id], index_name, namespace)
                 else:
                     body = 'Document not found:<br>'
                     body += 'Namespace: %s<br>' % namespace
@@ -529,9 +1092,14 @@ routes = [
     webapp2.Route(r'/bootstrap-gcs', handler='indexer.BootstrapGcs:get'),
     webapp2.Route(r'/index-gcs-path', handler='indexer.IndexGcsPath:get'),
     webapp2.Route(r'/index-gcs-path-finalize', handler='indexer.IndexGcsPath:finalize'),
+    webapp2.Route(r'/index-dispatch', handler='indexer.IndexDispatch:get'),
+    webapp2.Route(r'/index-partitions', handler='indexer.IndexPartitionMap:get'),
+    webapp2.Route(r'/index-alias', handler='indexer.IndexAliasResolve:get'),
+    webapp2.Route(r'/index-alias-switch', handler='indexer.IndexAliasSwitch:get'),
     webapp2.Route(r'/index-delete-dataset', handler='indexer.IndexDeleteDataSet:get'),
     webapp2.Route(r'/index-delete-resource', handler='indexer.IndexDeleteResource:get'),
     webapp2.Route(r'/index-find-record', handler='indexer.IndexFindRecord:get'),
+    webapp2.Route(r'/verbatim-records', handler='indexer.VerbatimRecords:get'),
 
 # index-clean is dangerous. Re-implement if really needed at some point.
 #    webapp2.Route(r'/index-delete-record', handler='indexer.IndexDeleteRecord:get'),
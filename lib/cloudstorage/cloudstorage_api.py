@@ -24,10 +24,13 @@ __all__ = ['copy2',
            'delete',
            'listbucket',
            'open',
+           'read_multi',
            'stat',
+           'stat_multi',
            'compose',
           ]
 
+import collections
 import logging
 import StringIO
 import urllib
@@ -49,7 +52,10 @@ def open(filename,
          read_buffer_size=storage_api.ReadBuffer.DEFAULT_BUFFER_SIZE,
          retry_params=None,
          _account_id=None,
-         offset=0):
+         offset=0,
+         file_size=None,
+         etag=None,
+         prefetch=1):
   """Opens a Google Cloud Storage file and returns it as a File-like object.
 
   Args:
@@ -74,6 +80,14 @@ def open(filename,
     _account_id: Internal-use only.
     offset: Number of bytes to skip at the start of the file. If None, 0 is
       used.
+    file_size: The size of the file if already known, e.g. from stat or
+      listbucket. Saves a HEAD request in reading mode.
+    etag: The etag of the file if already known. Only valid in reading mode
+      with file_size.
+    prefetch: The number of buffers read keeps requested ahead. With more
+      than one, request sizes also grow while reading outpaces fetching, up
+      to 16MB for all the buffers requested ahead, and shrink again while
+      fetching keeps up.
 
   Returns:
     A reading or writing buffer that supports File-like interface. Buffer
@@ -100,7 +114,10 @@ def open(filename,
     return storage_api.ReadBuffer(api,
                                   filename,
                                   buffer_size=read_buffer_size,
-                                  offset=offset)
+                                  offset=offset,
+                                  file_size=file_size,
+                                  etag=etag,
+                                  prefetch=prefetch)
   else:
     raise ValueError('Invalid mode %s.' % mode)
 
@@ -149,7 +166,12 @@ def stat(filename, retry_params=None, _account_id=None):
       api_utils._quote_filename(filename))
   errors.check_status(status, [200], filename, resp_headers=headers,
                       body=content)
-  file_stat = common.GCSFileStat(
+  return _file_stat(filename, headers)
+
+
+def _file_stat(filename, headers):
+  """Returns the GCSFileStat of a file from the headers of a HEAD response."""
+  return common.GCSFileStat(
       filename=filename,
       st_size=common.get_stored_content_length(headers),
       st_ctime=common.http_time_to_posix(headers.get('last-modified')),
@@ -157,7 +179,103 @@ def stat(filename, retry_params=None, _account_id=None):
       content_type=headers.get('content-type'),
       metadata=common.get_metadata(headers))
 
-  return file_stat
+
+# Maximum number of requests stat_multi and read_multi keep in flight.
+_MAX_CONCURRENT_REQUESTS = 32
+
+
+def stat_multi(filenames, retry_params=None, _account_id=None):
+  """Get GCSFileStat of many Google Cloud storage files at once.
+
+  Same as stat on each file, except that up to _MAX_CONCURRENT_REQUESTS
+  requests are issued before waiting on any of them.
+
+  Args:
+    filenames: A list of Google Cloud Storage filenames of form
+      '/bucket/filename'.
+    retry_params: An api_utils.RetryParams for these calls to GCS. If None,
+      the default one is used.
+    _account_id: Internal-use only.
+
+  Returns:
+    A list of a GCSFileStat object for each file, or None for the files that
+    do not exist.
+
+  Raises:
+    errors.AuthorizationError: if authorization failed.
+  """
+  for filename in filenames:
+    common.validate_file_path(filename)
+  api = storage_api._get_storage_api(retry_params=retry_params,
+                                     account_id=_account_id)
+  def _stat(filename, response):
+    status, headers, content = response
+    if status == 404:
+      return None
+    errors.check_status(status, [200], filename, resp_headers=headers,
+                        body=content)
+    return _file_stat(filename, headers)
+  return _multi(filenames, api.head_object_async, _stat)
+
+
+def read_multi(filenames, retry_params=None, _account_id=None):
+  """Read many small Google Cloud storage files at once.
+
+  Each file is read in a single request. Up to _MAX_CONCURRENT_REQUESTS
+  requests are issued before waiting on any of them.
+
+  Args:
+    filenames: A list of Google Cloud Storage filenames of form
+      '/bucket/filename'.
+    retry_params: An api_utils.RetryParams for these calls to GCS. If None,
+      the default one is used.
+    _account_id: Internal-use only.
+
+  Returns:
+    A list of the content of each file as a str, or None for the files that
+    do not exist.
+
+  Raises:
+    errors.AuthorizationError: if authorization failed.
+  """
+  for filename in filenames:
+    common.validate_file_path(filename)
+  api = storage_api._get_storage_api(retry_params=retry_params,
+                                     account_id=_account_id)
+  def _read(filename, response):
+    status, headers, content = response
+    if status == 404:
+      return None
+    errors.check_status(status, [200], filename, resp_headers=headers,
+                        body=content)
+    return content
+  return _multi(filenames, api.get_object_async, _read)
+
+
+def _multi(filenames, request_async, result):
+  """Makes a request for each file with a bounded number in flight.
+
+  Args:
+    filenames: A list of Google Cloud Storage filenames.
+    request_async: an async method of the storage api taking a quoted path.
+    result: a function of a filename and its (status, headers, content)
+      response that returns the result for the file.
+
+  Returns:
+    The list of the results of the files in order.
+  """
+  results = []
+  futures = collections.deque()
+  for filename in filenames:
+    if len(futures) == _MAX_CONCURRENT_REQUESTS:
+      done_filename, future = futures.popleft()
+      results.append(result(done_filename, future.get_result()))
+    futures.append((filename, request_async(
+        api_utils._quote_filename(filename))))
+  while futures:
+    done_filename, future = futures.popleft()
+    results.append(result(done_filename, future.get_result()))
+  return results
 
 
 def copy2(src, dst, metadata=None, retry_params=None):
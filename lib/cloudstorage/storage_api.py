@@ -211,24 +211,39 @@ class ReadBuffer(object):
 
   DEFAULT_BUFFER_SIZE = 1024 * 1024
   MAX_REQUEST_SIZE = 30 * DEFAULT_BUFFER_SIZE
+  # Max bytes of the buffers requested ahead, together, once request sizes
+  # have grown. Keeps prefetching within the memory of small instances.
+  MAX_PREFETCH_SIZE = 16 * DEFAULT_BUFFER_SIZE
 
   def __init__(self,
                api,
                path,
                buffer_size=DEFAULT_BUFFER_SIZE,
                max_request_size=MAX_REQUEST_SIZE,
-               offset=0):
+               offset=0,
+               file_size=None,
+               etag=None,
+               prefetch=1):
     """Constructor.
 
     Args:
       api: A StorageApi instance.
       path: Quoted/escaped path to the object, e.g. /mybucket/myfile
       buffer_size: buffer size. The ReadBuffer keeps
-        one buffer. But there may be a pending future that contains
-        a second buffer. This size must be less than max_request_size.
+        one buffer. But there may be pending futures that contain
+        the next buffers. This size must be less than max_request_size.
       max_request_size: Max bytes to request in one urlfetch.
       offset: Number of bytes to skip at the start of the file. If None, 0 is
         used.
+      file_size: size of the object if already known, e.g. from a GCSFileStat.
+        If given, no HEAD request is made for the object.
+      etag: etag of the object if already known. Reading fails if the object
+        no longer has this etag.
+      prefetch: number of buffers to request ahead of the one being read.
+        With more than one, the size of the requests also doubles whenever
+        reading has to wait for a buffer, up to max_request_size and to
+        MAX_PREFETCH_SIZE for all the pending buffers, and halves again, down
+        to buffer_size, whenever a buffer arrived before it was needed.
     """
     self._api = api
     self._path = path
@@ -236,12 +251,27 @@ class ReadBuffer(object):
     self.closed = False
 
     assert buffer_size <= max_request_size
+    assert prefetch >= 1
     self._buffer_size = buffer_size
     self._max_request_size = max_request_size
+    self._prefetch = prefetch
+    self._prefetch_stopped = False
+    self._request_size = buffer_size
+    self._max_prefetch_request_size = self._prefetch_request_ceiling()
     self._offset = offset
 
     self._buffer = _Buffer()
+    self._buffer_futures = collections.deque()
     self._etag = None
+    self._check_etag(etag)
+
+    if file_size is not None:
+      self._file_size = long(file_size)
+      if self._remaining() > 0:
+        self._buffer.reset(
+            self._get_segment(offset, self._buffer_size).get_result())
+        self._request_next_buffer()
+      return
 
     get_future = self._get_segment(offset, self._buffer_size, check_response=False)
 
@@ -250,8 +280,6 @@ class ReadBuffer(object):
     self._file_size = long(common.get_stored_content_length(headers))
     self._check_etag(headers.get('etag'))
 
-    self._buffer_future = None
-
     if self._file_size != 0:
       content, check_response_closure = get_future.get_result()
       check_response_closure()
@@ -273,6 +301,7 @@ class ReadBuffer(object):
             'path': self._path,
             'buffer_size': self._buffer_size,
             'request_size': self._max_request_size,
+            'prefetch': self._prefetch,
             'etag': self._etag,
             'size': self._file_size,
             'offset': self._offset,
@@ -291,12 +320,17 @@ class ReadBuffer(object):
     self.name = api_utils._unquote_filename(self._path)
     self._buffer_size = state['buffer_size']
     self._max_request_size = state['request_size']
-    self._etag = state['etag']
+    self._prefetch = state.get('prefetch', 1)
+    self._prefetch_stopped = False
+    self._request_size = self._buffer_size
+    self._max_prefetch_request_size = self._prefetch_request_ceiling()
+    self._etag = None
+    self._check_etag(state['etag'])
     self._file_size = state['size']
     self._offset = state['offset']
     self._buffer = _Buffer()
     self.closed = state['closed']
-    self._buffer_future = None
+    self._buffer_futures = collections.deque()
     if self._remaining() and not self.closed:
       self._request_next_buffer()
 
@@ -352,8 +386,7 @@ class ReadBuffer(object):
       data_list.append(data)
       if size == 0 or not self._remaining():
         return ''.join(data_list)
-      self._buffer.reset(self._buffer_future.get_result())
-      self._request_next_buffer()
+      self._next_buffer()
       newline_offset = self._buffer.find_newline(size)
 
     data = self._buffer.read_to_offset(newline_offset + 1)
@@ -362,6 +395,50 @@ class ReadBuffer(object):
 
     return ''.join(data_list)
 
+  def readlines(self, max_lines=-1, max_bytes=-1):
+    """Read many lines delimited by '\n' from the file.
+
+    The complete lines in the buffer are split all at once instead of one
+    readline at a time. Unlike readline, the newline characters are not kept
+    in the strings. The partial line at the end of the buffer is read on
+    with the next buffer, and the last line of the file is returned even if
+    it does not end with a newline. tell() is after the newline of the last
+    line returned.
+
+    Args:
+      max_lines: Maximum number of lines to read. Negative for no limit.
+      max_bytes: Lines are read as long as fewer than this many bytes,
+        counting the newlines, have been read. The last line read may end past
+        max_bytes. Negative for no limit.
+
+    Returns:
+      A list of lines. Empty only when EOF is encountered immediately or a
+      limit is 0.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    lines = []
+    size = 0
+    while (self._remaining() and
+           (max_lines < 0 or len(lines) < max_lines) and
+           (max_bytes < 0 or size < max_bytes)):
+      if self._buffer.find_newline() < 0:
+        line = self.readline()
+        size += len(line)
+        if line.endswith('\n'):
+          line = line[:-1]
+        lines.append(line)
+        continue
+      buffered = self._buffer.remaining()
+      lines.extend(self._buffer.read_lines(
+          max_lines - len(lines) if max_lines >= 0 else -1,
+          max_bytes - size if max_bytes >= 0 else -1))
+      size += buffered - self._buffer.remaining()
+      self._offset += buffered - self._buffer.remaining()
+    return lines
+
   def read(self, size=-1):
     """Read data from RAW file.
 
@@ -392,7 +469,7 @@ class ReadBuffer(object):
         self._offset += remaining
         data_list.append(self._buffer.read())
 
-        if self._buffer_future is None:
+        if not self._buffer_futures:
           if size < 0 or size >= self._remaining():
             needs = self._remaining()
           else:
@@ -401,11 +478,11 @@ class ReadBuffer(object):
           self._offset += needs
           break
 
-        if self._buffer_future:
-          self._buffer.reset(self._buffer_future.get_result())
-          self._buffer_future = None
+        self._buffer.reset(self._buffer_futures.popleft().get_result())
 
-    if self._buffer_future is None:
+    if self._buffer_futures:
+      self._fill_prefetch()
+    else:
       self._request_next_buffer()
     return ''.join(data_list)
 
@@ -413,15 +490,61 @@ class ReadBuffer(object):
     return self._file_size - self._offset
 
   def _request_next_buffer(self):
-    """Request next buffer.
+    """Request next buffers, dropping any pending ones.
 
     Requires self._offset and self._buffer are in consistent state.
     """
-    self._buffer_future = None
-    next_offset = self._offset + self._buffer.remaining()
-    if next_offset != self._file_size:
-      self._buffer_future = self._get_segment(next_offset,
-                                              self._buffer_size)
+    self._buffer_futures = collections.deque()
+    self._next_offset = self._offset + self._buffer.remaining()
+    self._fill_prefetch()
+
+  def _fill_prefetch(self, depth=None):
+    """Request buffers after the pending ones up to the prefetch depth.
+
+    Args:
+      depth: Number of buffers to have pending. Defaults to the prefetch
+        depth, or to none once prefetching is stopped.
+    """
+    if depth is None:
+      depth = 0 if self._prefetch_stopped else self._prefetch
+    while (len(self._buffer_futures) < depth and
+           self._next_offset < self._file_size):
+      if self._prefetch_stopped:
+        request_size = self._buffer_size
+      else:
+        request_size = self._request_size
+      request_size = min(request_size, self._file_size - self._next_offset)
+      self._buffer_futures.append(self._get_segment(self._next_offset,
+                                                    request_size))
+      self._next_offset += request_size
+
+  def _prefetch_request_ceiling(self):
+    """Returns the largest request size prefetching may grow to."""
+    return max(self._buffer_size,
+               min(self._max_request_size,
+                   self.MAX_PREFETCH_SIZE // self._prefetch))
+
+  def _next_buffer(self):
+    """Replace the drained buffer with the first pending one.
+
+    If the pending buffer has not arrived yet, reading is faster than
+    fetching, so later requests are made larger to need fewer round trips.
+    If it has, fetching keeps up, and later requests are made smaller again
+    to hold less in memory.
+
+    Once prefetching is stopped, the next buffer is requested only now.
+    """
+    if not self._buffer_futures:
+      self._fill_prefetch(1)
+    future = self._buffer_futures.popleft()
+    if self._prefetch > 1:
+      if future.done():
+        self._request_size = max(self._request_size // 2, self._buffer_size)
+      else:
+        self._request_size = min(self._request_size * 2,
+                                 self._max_prefetch_request_size)
+    self._buffer.reset(future.get_result())
+    self._fill_prefetch()
 
   def _get_segments(self, start, request_size):
     """Get segments of the file from Google Storage as a list.
@@ -507,7 +630,9 @@ class ReadBuffer(object):
     """
     if etag is None:
       return
-    elif self._etag is None:
+    # Response headers quote etags, GCSFileStat does not.
+    etag = etag.strip('"')
+    if self._etag is None:
       self._etag = etag
     elif self._etag != etag:
       raise ValueError('File on GCS has changed while reading.')
@@ -515,7 +640,7 @@ class ReadBuffer(object):
   def close(self):
     self.closed = True
     self._buffer = None
-    self._buffer_future = None
+    self._buffer_futures = None
 
   def __enter__(self):
     return self
@@ -542,7 +667,7 @@ class ReadBuffer(object):
     self._check_open()
 
     self._buffer.reset()
-    self._buffer_future = None
+    self._buffer_futures = collections.deque()
 
     if whence == os.SEEK_SET:
       self._offset = offset
@@ -558,6 +683,41 @@ class ReadBuffer(object):
     if self._remaining():
       self._request_next_buffer()
 
+  def buffered(self):
+    """Returns the number of bytes in the read buffer past the current offset.
+
+    These are fetched again if the file is reopened at the current offset.
+    Prefetched buffers are not counted, see prefetched.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    return self._buffer.remaining()
+
+  def prefetched(self):
+    """Returns the number of bytes requested after the read buffer.
+
+    Like those of buffered, these are fetched again if the file is reopened
+    at the current offset.
+
+    Raises:
+      IOError: When this buffer is closed.
+    """
+    self._check_open()
+    if not self._buffer_futures:
+      return 0
+    return self._next_offset - self._offset - self._buffer.remaining()
+
+  def stop_prefetch(self):
+    """Stops requesting buffers ahead of the read buffer.
+
+    For a reader that will stop reading soon, so that the buffers it has not
+    read are not fetched in vain. The pending buffers are still read, and
+    after them each buffer is requested when the read buffer runs out.
+    """
+    self._prefetch_stopped = True
+
   def tell(self):
     """Tell the file's current offset.
 
@@ -627,6 +787,32 @@ class _Buffer(object):
   def remaining(self):
     return len(self._buffer) - self._offset
 
+  def read_lines(self, max_lines=-1, max_bytes=-1):
+    """Returns complete lines from self._buffer and update related offsets.
+
+    Args:
+      max_lines: number of lines to read. All complete lines if negative.
+      max_bytes: read the lines that start within this many bytes from the
+        current offset. No limit if negative.
+
+    Returns:
+      The lines without their newline chars. The offset is moved after the
+      newline of the last one.
+    """
+    end = self._buffer.rfind('\n', self._offset)
+    if end < 0 or max_lines == 0 or max_bytes == 0:
+      return []
+    if max_bytes > 0:
+      last = self._buffer.find('\n', self._offset + max_bytes - 1, end)
+      if last >= 0:
+        end = last
+    lines = self._buffer[self._offset:end].split('\n')
+    if 0 < max_lines < len(lines):
+      del lines[max_lines:]
+      end = self._offset + sum(map(len, lines)) + max_lines - 1
+    self._offset = end + 1
+    return lines
+
   def find_newline(self, size=-1):
     """Search for newline char in buffer starting from current offset.
 
@@ -0,0 +1,174 @@
+# Copyright 2013 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing,
+# software distributed under the License is distributed on an
+# "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND,
+# either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+
+"""Tests for storage_api.py."""
+
+import unittest
+
+from cloudstorage import storage_api
+
+
+class BufferTest(unittest.TestCase):
+  """Tests for _Buffer."""
+
+  def setUp(self):
+    self.buf = storage_api._Buffer()
+    self.buf.reset('a\nbb\nccc\ndd')
+
+  def testReadLines(self):
+    self.assertEqual(['a', 'bb', 'ccc'], self.buf.read_lines())
+    self.assertEqual(2, self.buf.remaining())
+    self.assertEqual([], self.buf.read_lines())
+    self.assertEqual('dd', self.buf.read())
+
+  def testReadLinesFromOffset(self):
+    self.buf.read(3)
+    self.assertEqual(['b', 'ccc'], self.buf.read_lines())
+
+  def testMaxLines(self):
+    self.assertEqual([], self.buf.read_lines(max_lines=0))
+    self.assertEqual(['a', 'bb'], self.buf.read_lines(max_lines=2))
+    self.assertEqual('ccc\n', self.buf.read(4))
+    self.assertEqual([], self.buf.read_lines(max_lines=5))
+
+  def testMaxBytes(self):
+    self.assertEqual([], self.buf.read_lines(max_bytes=0))
+    self.assertEqual(['a'], self.buf.read_lines(max_bytes=1))
+    self.assertEqual(['bb'], self.buf.read_lines(max_bytes=1))
+    self.buf.reset('a\nbb\nccc\ndd')
+    self.assertEqual(['a', 'bb'], self.buf.read_lines(max_bytes=3))
+    self.buf.reset('a\nbb\nccc\ndd')
+    self.assertEqual(['a', 'bb', 'ccc'], self.buf.read_lines(max_bytes=6))
+    self.assertEqual('dd', self.buf.read())
+
+  def testMaxLinesAndMaxBytes(self):
+    self.assertEqual(['a', 'bb'], self.buf.read_lines(max_lines=2,
+                                                      max_bytes=100))
+    self.assertEqual(['ccc'], self.buf.read_lines(max_lines=2, max_bytes=1))
+
+  def testEmptyLines(self):
+    self.buf.reset('\n\na\n\n')
+    self.assertEqual(['', '', 'a', ''], self.buf.read_lines())
+    self.assertEqual(0, self.buf.remaining())
+
+  def testNoCompleteLine(self):
+    self.buf.reset('abc')
+    self.assertEqual([], self.buf.read_lines())
+    self.assertEqual(3, self.buf.remaining())
+
+  def testMatchesReadline(self):
+    content = ''.join('%s\n' % ('x' * (i % 7)) for i in range(100)) + 'end'
+    for max_lines in (-1, 1, 3, 10):
+      for max_bytes in (-1, 1, 5, 40):
+        self.buf.reset(content)
+        lines = []
+        while True:
+          block = self.buf.read_lines(max_lines, max_bytes)
+          if not block:
+            break
+          lines.extend(block)
+        self.assertEqual(content.split('\n')[:-1], lines)
+        self.assertEqual('end', self.buf.read())
+
+
+class _FakeFuture(object):
+  """A finished future of a segment."""
+
+  def __init__(self, content):
+    self._content = content
+
+  def done(self):
+    return True
+
+  def get_result(self):
+    return self._content
+
+
+class _FakeReadBuffer(storage_api.ReadBuffer):
+  """A ReadBuffer that reads from a string instead of GCS."""
+
+  def __init__(self, content, **kwargs):
+    self.content = content
+    self.requests = []
+    super(_FakeReadBuffer, self).__init__(
+        None, '/bucket/file', file_size=len(content), etag='etag', **kwargs)
+
+  def _get_segment(self, start, request_size, check_response=True):
+    self.requests.append((start, request_size))
+    return _FakeFuture(self.content[start:start + request_size])
+
+
+class ReadBufferTest(unittest.TestCase):
+  """Tests for ReadBuffer."""
+
+  def setUp(self):
+    self.content = ''.join('line %d %s\n' % (i, 'x' * (i % 50))
+                           for i in range(500)) + 'last'
+
+  def testReadlines(self):
+    for max_lines, max_bytes in ((-1, -1), (7, -1), (-1, 300), (7, 300)):
+      f = _FakeReadBuffer(self.content, buffer_size=1000, prefetch=2)
+      lines = []
+      while True:
+        block = f.readlines(max_lines, max_bytes)
+        if not block:
+          break
+        if max_lines > 0:
+          self.assertTrue(len(block) <= max_lines)
+        lines.extend(block)
+        self.assertEqual(min(len('\n'.join(lines)) + 1, len(self.content)),
+                         f.tell())
+      self.assertEqual(self.content.split('\n'), lines)
+      self.assertEqual(len(self.content), f.tell())
+
+  def testReadlinesAndReadline(self):
+    f = _FakeReadBuffer(self.content, buffer_size=1000)
+    lines = []
+    while True:
+      line = f.readline()
+      if not line:
+        break
+      lines.append(line.rstrip('\n'))
+      lines.extend(f.readlines(max_lines=3))
+    self.assertEqual(self.content.split('\n'), lines)
+
+  def testPrefetched(self):
+    f = _FakeReadBuffer(self.content, buffer_size=1000, prefetch=3)
+    self.assertEqual(3000, f.prefetched())
+    while f.readline():
+      pending = sum(len(future.get_result()) for future in f._buffer_futures)
+      self.assertEqual(pending, f.prefetched())
+    self.assertEqual(0, f.prefetched())
+
+  def testStopPrefetch(self):
+    f = _FakeReadBuffer(self.content, buffer_size=1000, prefetch=3)
+    lines = [f.readline() for _ in range(100)]
+    f.stop_prefetch()
+    stopped_at = len(f.requests)
+    prefetched = f.prefetched()
+    while True:
+      line = f.readline()
+      if not line:
+        break
+      lines.append(line)
+      self.assertTrue(f.prefetched() <= prefetched)
+      prefetched = f.prefetched()
+    self.assertEqual(self.content, ''.join(lines))
+    self.assertTrue(len(f.requests) > stopped_at)
+    for _, request_size in f.requests[stopped_at:]:
+      self.assertTrue(request_size <= 1000)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -28,21 +28,31 @@ __all__ = ["get",
            "Context",
            "COUNTER_MAPPER_CALLS",
            "COUNTER_MAPPER_WALLTIME_MS",
+           "COUNTER_SEARCH_PUT_DOCUMENTS",
+           "COUNTER_SEARCH_PUT_FAILED",
+           "COUNTER_SEARCH_PUT_RETRIED",
            "DATASTORE_DEADLINE",
            "MAX_ENTITY_COUNT",
+           "MAX_SEARCH_DOCUMENT_COUNT",
           ]
 
+import collections
 import heapq
 import logging
+import random
 import threading
+import time
 
 try:
   from google.appengine.ext import ndb
 except ImportError:
   ndb = None
 from google.appengine.api import datastore
+from google.appengine.api import search
 from google.appengine.ext import db
 from google.appengine.runtime import apiproxy_errors
+from mapreduce import parameters
+from mapreduce import util
 
 
 # Maximum number of items. Pool will be flushed when reaches this amount.
@@ -56,6 +66,30 @@ MAX_ENTITY_COUNT = 20
 # Deadline in seconds for mutation pool datastore operations.
 DATASTORE_DEADLINE = 15
 
+# Maximum number of documents the Search API accepts in a single put call.
+# Search pool will flush a (index_name, namespace) batch when it reaches this.
+MAX_SEARCH_DOCUMENT_COUNT = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+
+# Initial and maximum delay in seconds before transiently failed documents
+# are sent again. The actual delay is jittered between half and all of it.
+SEARCH_RETRY_INITIAL_DELAY = 0.2
+SEARCH_RETRY_MAX_DELAY = 5
+
+# Default number of search pool put calls that may be in flight at a time.
+# Overridden by the "search_puts_in_flight" mapper parameter.
+SEARCH_PUTS_IN_FLIGHT = 4
+
+# Time in seconds past the slice duration that search pool may spend retrying
+# documents. Without it the flush at the end of a slice could never retry.
+SEARCH_RETRY_GRACE_SEC = 5
+
+# Search API result codes of documents that are worth sending again.
+_TRANSIENT_SEARCH_CODES = frozenset([
+    search.OperationResult.TRANSIENT_ERROR,
+    search.OperationResult.INTERNAL_ERROR,
+    search.OperationResult.TIMEOUT,
+    search.OperationResult.CONCURRENT_TRANSACTION])
+
 # The name of the counter which counts all mapper calls.
 COUNTER_MAPPER_CALLS = "mapper-calls"
 
@@ -63,6 +97,19 @@ COUNTER_MAPPER_CALLS = "mapper-calls"
 # hundler function, but includes all i/o overhead.
 COUNTER_MAPPER_WALLTIME_MS = "mapper-walltime-ms"
 
+# The name of the counter which counts documents put by search pool.
+COUNTER_SEARCH_PUT_DOCUMENTS = "search-put-documents"
+
+# The name of the counter which counts documents search pool sent again.
+COUNTER_SEARCH_PUT_RETRIED = "search-put-retried"
+
+# The name of the counter which counts documents search pool failed to put.
+COUNTER_SEARCH_PUT_FAILED = "search-put-failed"
+
+# The name of the counter which counts put attempts of documents that failed
+# transiently, which is how the Search API throttles.
+COUNTER_SEARCH_PUT_THROTTLED = "search-put-throttled"
+
 
 # pylint: disable=protected-access
 # pylint: disable=g-bad-name
@@ -340,6 +387,208 @@ class _MutationPool(Pool):
                                   force_writes=self.force_writes)
 
 
+class _SearchPool(Pool):
+  """Search pool accumulates Search API documents to put them in batch.
+
+  Documents are grouped by the (index_name, namespace) pair they are destined
+  for. Each group is put with a single Index.put_async call once it holds
+  max_document_count documents, and all groups are put when the context is
+  flushed at the end of the slice. Up to max_puts_in_flight puts are left
+  running while the mapper goes on, and the oldest is waited for before
+  another is started. All of them are waited for when the pool is flushed,
+  so the slice only ends once every document is put or failed. Puts in
+  flight together may complete in any order, so a document put twice in a
+  slice may end up as either version. The number of puts in flight is halved
+  after a put was throttled and grows back by one after each put that was
+  not, the same way the job rate follows throttling with the adaptive rate.
+
+  A put is judged per document from the PutResult list of a PutError. Only
+  documents that failed with a transient code are sent again, after a jittered
+  exponential backoff, for as long as the slice has time left. Documents that
+  failed permanently, or were still failing when the time ran out, are logged,
+  counted and passed to the failure handler named by the
+  "search_failure_handler" mapper parameter, if any. The handler is called
+  with the search.Index and a list of (document, code, message) tuples.
+
+  Properties:
+    max_document_count: maximum number of documents per put call.
+    max_puts_in_flight: maximum number of put calls left running. 0 waits for
+      every put call as soon as it is made.
+    throttled: number of documents that failed transiently in this slice.
+    failed_doc_ids: set of the ids of the documents handed to the failure
+      handler in this slice.
+    puts: dict from (index_name, namespace) to _ItemList of documents.
+  """
+
+  def __init__(self,
+               max_document_count=MAX_SEARCH_DOCUMENT_COUNT,
+               mapreduce_spec=None,
+               counters=None):
+    """Constructor.
+
+    Args:
+      max_document_count: maximum number of documents per put call. Can not
+        be larger than MAX_SEARCH_DOCUMENT_COUNT.
+      mapreduce_spec: An optional instance of MapperSpec.
+      counters: An optional _Counters pool to report put results to.
+    """
+    self.max_document_count = min(int(max_document_count),
+                                  MAX_SEARCH_DOCUMENT_COUNT)
+    self.puts = {}
+    self._counters = counters
+    params = mapreduce_spec.mapper.params if mapreduce_spec is not None else {}
+    self.max_puts_in_flight = int(params.get("search_puts_in_flight",
+                                             SEARCH_PUTS_IN_FLIGHT))
+    # (index, documents, deadline, future) of the puts in flight, oldest first.
+    self._in_flight = collections.deque()
+    self._puts_in_flight = self.max_puts_in_flight
+    self.throttled = 0
+    self.failed_doc_ids = set()
+    self._failure_handler_spec = params.get("search_failure_handler")
+    self._failure_handler = None
+    # The pool lives as long as the slice, so it can tell how much time the
+    # slice has left for retries.
+    self._retry_deadline = (time.time() +
+                            parameters.config._SLICE_DURATION_SEC +
+                            SEARCH_RETRY_GRACE_SEC)
+
+  def put(self, document, index_name, namespace=None):
+    """Registers document to put to a search index.
+
+    Args:
+      document: a search.Document to put.
+      index_name: name of the index to put the document in.
+      namespace: namespace of the index. None for the current namespace.
+    """
+    key = (index_name, namespace)
+    item_list = self.puts.get(key)
+    if item_list is None:
+      index = search.Index(name=index_name, namespace=namespace)
+      item_list = _ItemList(
+          self.max_document_count,
+          lambda items, options: self._flush_puts(index, items, options),
+          repr_function=self._search_repr)
+      self.puts[key] = item_list
+    item_list.append(document)
+
+  def flush(self):
+    """Flush(apply) all pending documents to their indexes."""
+    for item_list in self.puts.values():
+      item_list.flush()
+    while self._in_flight:
+      self._complete_put(*self._in_flight.popleft())
+
+  @classmethod
+  def _search_repr(cls, document):
+    """Converts document to a readable repr.
+
+    Args:
+      document: search.Document
+
+    Returns:
+      Document in str.
+    """
+    return str(document)
+
+  def _flush_puts(self, index, items, options):
+    """Start putting all documents of one index to the Search API."""
+    documents = list(items)
+    deadline = options["deadline"]
+    self._in_flight.append(
+        (index, documents, deadline, self._put_async(index, documents, deadline)))
+    while len(self._in_flight) > self._puts_in_flight:
+      self._complete_put(*self._in_flight.popleft())
+
+  def _complete_put(self, index, documents, deadline, future):
+    """Wait for a put started by _flush_puts and retry what failed."""
+    pending = documents
+    failures = self._put_result(pending, future)
+    delay = SEARCH_RETRY_INITIAL_DELAY
+    while True:
+      self._increment(COUNTER_SEARCH_PUT_DOCUMENTS,
+                      len(pending) - len(failures))
+      retries = [f for f in failures if f[1] in _TRANSIENT_SEARCH_CODES]
+      self._throttle(len(retries))
+      if not retries or time.time() + delay > self._retry_deadline:
+        self._handle_failures(index, failures)
+        return
+      self._handle_failures(
+          index, [f for f in failures if f[1] not in _TRANSIENT_SEARCH_CODES])
+      self._increment(COUNTER_SEARCH_PUT_RETRIED, len(retries))
+      time.sleep(random.uniform(delay / 2, delay))
+      delay = min(delay * 2, SEARCH_RETRY_MAX_DELAY)
+      pending = [document for document, _, _ in retries]
+      failures = self._put_result(
+          pending, self._put_async(index, pending, deadline))
+
+  def _throttle(self, throttled):
+    """Counts the documents of a put that failed transiently and adjusts the
+    number of puts in flight."""
+    if throttled:
+      self.throttled += throttled
+      self._increment(COUNTER_SEARCH_PUT_THROTTLED, throttled)
+      self._puts_in_flight //= 2
+    elif self._puts_in_flight < self.max_puts_in_flight:
+      self._puts_in_flight += 1
+
+  def _put_async(self, index, documents, deadline):
+    """Starts putting documents to index once.
+
+    Args:
+      index: search.Index to put to.
+      documents: list of search.Document.
+      deadline: RPC deadline in seconds.
+
+    Returns:
+      A future of the put for _put_result.
+    """
+    return index.put_async(documents, deadline=deadline)
+
+  def _put_result(self, documents, future):
+    """Waits for a put started by _put_async.
+
+    Args:
+      documents: list of search.Document the put was started with.
+      future: the future _put_async returned.
+
+    Returns:
+      A list of (document, code, message) tuples for documents which failed.
+    """
+    try:
+      future.get_result()
+      return []
+    except search.PutError, e:
+      return [(document, result.code, result.message)
+              for document, result in zip(documents, e.results)
+              if result.code != search.OperationResult.OK]
+    except (search.TransientError,
+            search.InternalError,
+            apiproxy_errors.DeadlineExceededError,
+            apiproxy_errors.OverQuotaError), e:
+      code = search.OperationResult.TRANSIENT_ERROR
+    except search.Error, e:
+      code = search.OperationResult.INVALID_REQUEST
+    return [(document, code, str(e)) for document in documents]
+
+  def _handle_failures(self, index, failures):
+    """Logs, counts and hands over documents which could not be put."""
+    if not failures:
+      return
+    self._increment(COUNTER_SEARCH_PUT_FAILED, len(failures))
+    for document, code, message in failures:
+      self.failed_doc_ids.add(document.doc_id)
+      logging.error("Failed to put document %s to index %s: %s %s",
+                    document.doc_id, index.name, code, message)
+    if self._failure_handler_spec and self._failure_handler is None:
+      self._failure_handler = util.for_name(self._failure_handler_spec)
+    if self._failure_handler:
+      self._failure_handler(index, failures)
+
+  def _increment(self, counter_name, delta):
+    if self._counters is not None and delta:
+      self._counters.increment(counter_name, delta)
+
+
 class _Counters(Pool):
   """Regulates access to counters.
 
@@ -425,12 +674,15 @@ class Context(object):
     # as they know how big their entities are.
     self._mutation_pool = _MutationPool(mapreduce_spec=mapreduce_spec)
     self._counters = _Counters(shard_state)
+    self._search_pool = _SearchPool(mapreduce_spec=mapreduce_spec,
+                                    counters=self._counters)
     # TODO(user): Remove this after fixing
     # keyhole/dataeng/imagery/feeds/client_lib.py in another CL.
     self.counters = self._counters
 
     self._pools = {}
     self.register_pool("mutation_pool", self._mutation_pool)
+    self.register_pool("search_pool", self._search_pool)
     self.register_pool("counters", self.counters)
 
   def flush(self):
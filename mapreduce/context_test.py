@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the search pool of context.py."""
+
+import unittest
+
+from google.appengine.api import search
+from mapreduce import context
+
+OK = search.OperationResult.OK
+TRANSIENT_ERROR = search.OperationResult.TRANSIENT_ERROR
+INVALID_REQUEST = search.OperationResult.INVALID_REQUEST
+
+
+class _FakeTime(object):
+  """Stands in for the time module. sleep moves the clock on at once."""
+
+  def __init__(self):
+    self.now = 0.0
+
+  def time(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.now += seconds
+
+
+class _FakeCounters(object):
+  """Records the counters incremented by the pool."""
+
+  def __init__(self):
+    self.counters = {}
+
+  def increment(self, counter_name, delta=1):
+    self.counters[counter_name] = self.counters.get(counter_name, 0) + delta
+
+
+class _FakeFuture(object):
+
+  def __init__(self, result, documents):
+    self._result = result
+    self._documents = documents
+
+  def get_result(self):
+    if self._result is not None:
+      self._result(self._documents)
+
+
+class _FakeIndex(object):
+  """An index whose puts end as scripted.
+
+  Each put takes the next result: None for success, or a function called
+  with the documents that raises the error of the put.
+  """
+
+  name = "index"
+
+  def __init__(self, *results):
+    self.results = list(results)
+    self.calls = []
+
+  def put_async(self, documents, deadline=None):
+    self.calls.append([document.doc_id for document in documents])
+    result = self.results.pop(0) if self.results else None
+    return _FakeFuture(result, documents)
+
+
+def _put_error(*codes):
+  """A put result that fails with a PutError of the given codes."""
+  def fail(documents):
+    raise search.PutError("put failed", [
+        search.PutResult(code=code, message=code, id=document.doc_id)
+        for document, code in zip(documents, codes)])
+  return fail
+
+
+def _raise(error):
+  """A put result that raises error for the whole put."""
+  def fail(documents):
+    raise error
+  return fail
+
+
+def _documents(*doc_ids):
+  return [search.Document(doc_id=doc_id) for doc_id in doc_ids]
+
+
+class SearchPoolTest(unittest.TestCase):
+  """Tests for _SearchPool."""
+
+  def setUp(self):
+    self._time = context.time
+    context.time = _FakeTime()
+    self.counters = _FakeCounters()
+    self.pool = context._SearchPool(counters=self.counters)
+
+  def tearDown(self):
+    context.time = self._time
+
+  def put(self, index, documents):
+    self.pool._flush_puts(index, documents, {"deadline": 10})
+
+  def testRetriesOnlyTransientFailures(self):
+    index = _FakeIndex(_put_error(OK, TRANSIENT_ERROR, INVALID_REQUEST))
+    self.put(index, _documents("a", "b", "c"))
+    self.pool.flush()
+    self.assertEqual([["a", "b", "c"], ["b"]], index.calls)
+    self.assertEqual(set(["c"]), self.pool.failed_doc_ids)
+    self.assertEqual(1, self.pool.throttled)
+    self.assertEqual({context.COUNTER_SEARCH_PUT_DOCUMENTS: 2,
+                      context.COUNTER_SEARCH_PUT_RETRIED: 1,
+                      context.COUNTER_SEARCH_PUT_THROTTLED: 1,
+                      context.COUNTER_SEARCH_PUT_FAILED: 1},
+                     self.counters.counters)
+
+  def testRetriesWholePutAfterTransientError(self):
+    index = _FakeIndex(_raise(search.TransientError("busy")),
+                       _put_error(TRANSIENT_ERROR, OK))
+    self.put(index, _documents("a", "b"))
+    self.pool.flush()
+    self.assertEqual([["a", "b"], ["a", "b"], ["a"]], index.calls)
+    self.assertEqual(set(), self.pool.failed_doc_ids)
+
+  def testDoesNotRetryInvalidRequest(self):
+    index = _FakeIndex(_raise(search.InvalidRequest("bad")))
+    self.put(index, _documents("a", "b"))
+    self.pool.flush()
+    self.assertEqual([["a", "b"]], index.calls)
+    self.assertEqual(set(["a", "b"]), self.pool.failed_doc_ids)
+
+  def testGivesUpWhenSliceTimeIsUp(self):
+    results = [_put_error(TRANSIENT_ERROR)] * 1000
+    index = _FakeIndex(*results)
+    self.put(index, _documents("a"))
+    self.pool.flush()
+    self.assertTrue(len(index.calls) > 2)
+    self.assertTrue(context.time.time() <= self.pool._retry_deadline)
+    self.assertEqual(set(["a"]), self.pool.failed_doc_ids)
+    self.assertEqual(len(index.calls) - 1,
+                     self.counters.counters[context.COUNTER_SEARCH_PUT_RETRIED])
+
+  def testPutsInFlightHalveWhenThrottled(self):
+    # Each throttled put halves the puts in flight, and its retry, which is
+    # not throttled, grows them back by one.
+    for expected in (3, 2, 2):
+      self.put(_FakeIndex(_put_error(TRANSIENT_ERROR)), _documents("a"))
+      self.pool.flush()
+      self.assertEqual(expected, self.pool._puts_in_flight)
+    for expected in (3, 4, 4):
+      self.put(_FakeIndex(), _documents("b"))
+      self.pool.flush()
+      self.assertEqual(expected, self.pool._puts_in_flight)
+    self.assertEqual(3, self.pool.throttled)
+
+  def testPutsInFlightGrowBackByOne(self):
+    self.pool._puts_in_flight = 1
+    for doc_id in "abcdef":
+      self.put(_FakeIndex(), _documents(doc_id))
+    self.assertEqual(4, self.pool._puts_in_flight)
+    self.assertEqual(3, len(self.pool._in_flight))
+    self.pool.flush()
+    self.assertEqual(4, self.pool._puts_in_flight)
+
+
+if __name__ == "__main__":
+  unittest.main()
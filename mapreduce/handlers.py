@@ -52,6 +52,7 @@ from mapreduce import model
 from mapreduce import operation
 from mapreduce import output_writers
 from mapreduce import parameters
+from mapreduce import rate_control
 from mapreduce import shard_life_cycle
 from mapreduce import util
 from mapreduce.api import map_job
@@ -136,6 +137,9 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
     self._time = time.time
     self.slice_context = None
     self.shard_context = None
+    # Set by _split_shard.
+    self._handled_split_request = None
+    self._split = None
 
   def _drop_gracefully(self):
     """Drop worker task gracefully.
@@ -429,6 +433,13 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
     """
     # Reconstruct basic states.
     self._start_time = self._time()
+    self._last_buffered_size = None
+    # Whether the input reader was told to stop prefetching in this slice.
+    self._prefetch_stopped = False
+    # The adaptive job rate, read once per slice by _processing_limit.
+    self._job_rate = None
+    # Whether the slice stopped at its processing limit.
+    self._limited = False
     shard_id = self.request.headers[util._MR_SHARD_ID_TASK_HEADER]
     mr_id = self.request.headers[util._MR_ID_TASK_HEADER]
     spec = model.MapreduceSpec._get_mapreduce_spec(mr_id)
@@ -465,6 +476,13 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
       task_directive = self._TASK_DIRECTIVE.RETRY_SHARD
       return self.__return(shard_state, tstate, task_directive)
 
+    # Give part of the remaining input to an idle shard if the controller
+    # asked for it. This takes a slice of its own.
+    if (shard_state.split_request is not None and
+        not shard_state.is_input_finished()):
+      task_directive = self._split_shard(shard_state, tstate)
+      return self.__return(shard_state, tstate, task_directive)
+
     # TODO(user): Find a better way to set these per thread configs.
     # E.g. what if user change it?
     util._set_ndb_cache_policy()
@@ -506,6 +524,12 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
 
       ctx.flush()
 
+      if spec.mapper.params.get(rate_control.ADAPTIVE_RATE_PARAM):
+        rate_control.report(spec, ctx.get_pool("search_pool").throttled,
+                            self._limited)
+
+      shard_state.input_remaining = tstate.input_reader._remaining_size()
+
       if last_slice:
         # We're done processing data but we still need to finalize the output
         # stream. We save this condition in datastore and force a new slice.
@@ -563,6 +587,7 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
     finished_shard = True
     # Input reader may not be an iterator. It is only a container.
     iterator = iter(input_reader)
+    entity = None
 
     while True:
       try:
@@ -580,13 +605,6 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
       # TODO(user): Validate these assumptions on all readers. MR should
       # also have a way to detect fake forward progress.
 
-      if isinstance(entity, db.Model):
-        shard_state.last_work_item = repr(entity.key())
-      elif isinstance(entity, ndb.Model):
-        shard_state.last_work_item = repr(entity.key)
-      else:
-        shard_state.last_work_item = repr(entity)[:100]
-
       processing_limit -= 1
 
       if not self._process_datum(
@@ -595,8 +613,21 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
         break
       elif processing_limit == 0:
         finished_shard = False
+        self._limited = True
         break
 
+    # Only the last work item of the slice is ever seen, so describe it once
+    # instead of for every datum.
+    if entity is not None:
+      shard_state.last_work_item = self._work_item_repr(entity)
+
+    if not finished_shard:
+      reread_size = ((input_reader._buffered_size() or 0) +
+                     (input_reader._prefetched_size() or 0))
+      if reread_size:
+        self.slice_context.incr(input_readers.COUNTER_IO_REREAD_BYTES,
+                                reread_size)
+
     # Flush context and its pools.
     self.slice_context.incr(
         context.COUNTER_MAPPER_WALLTIME_MS,
@@ -604,6 +635,27 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
 
     return finished_shard
 
+  @staticmethod
+  def _work_item_repr(entity):
+    """Describes a datum for ShardState.last_work_item.
+
+    Args:
+      entity: a datum returned by the input reader.
+
+    Returns:
+      A short str representation of entity.
+    """
+    if isinstance(entity, db.Model):
+      return repr(entity.key())
+    elif isinstance(entity, ndb.Model):
+      return repr(entity.key)
+    elif isinstance(entity, tuple) and entity and isinstance(entity[-1], list):
+      # A block of data, e.g. from a line reader in block mode. Avoid the repr
+      # of the whole block.
+      return repr(entity[:-1] + (entity[-1][:1],))[:100]
+    else:
+      return repr(entity)[:100]
+
   def _process_datum(self, data, input_reader, ctx, transient_shard_state):
     """Process a single data piece.
 
@@ -643,10 +695,87 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
               else:
                 output_writer.write(output)
 
-    if self._time() - self._start_time >= parameters.config._SLICE_DURATION_SEC:
+    elapsed = self._time() - self._start_time
+    if elapsed >= parameters.config._SLICE_DURATION_SEC:
       return False
+    if (elapsed >= parameters.config._SLICE_DURATION_SEC -
+        parameters.config._SLICE_BUFFER_GRACE_SEC):
+      if not self._prefetch_stopped:
+        input_reader._stop_prefetch()
+        self._prefetch_stopped = True
+      return not self._at_buffer_end(input_reader)
     return True
 
+  def _at_buffer_end(self, input_reader):
+    """Whether the input reader is about to use up its read buffer.
+
+    That is when the bytes left in the buffer and in the prefetched buffers
+    are fewer than what the last datum took from them, so the next datum
+    would need a buffer not requested yet. Ending the slice there leaves the
+    least input for the next slice to read again. As prefetching is stopped
+    in the grace window, the prefetched buffers run out within it unless the
+    input is read slowly.
+
+    Args:
+      input_reader: input reader.
+
+    Returns:
+      True if the input reader is at the end of its buffers. False if not or
+    if the input reader does not tell its buffered size.
+    """
+    buffered_size = input_reader._buffered_size()
+    if buffered_size is not None:
+      buffered_size += input_reader._prefetched_size() or 0
+    last_buffered_size = self._last_buffered_size
+    self._last_buffered_size = buffered_size
+    if buffered_size is None or last_buffered_size is None:
+      return False
+    return buffered_size < last_buffered_size - buffered_size
+
+  def _split_shard(self, shard_state, tstate):
+    """Gives part of the remaining input of this shard to an idle shard.
+
+    The idle shard is revived in the transaction that saves the state of
+    this shard at the end of the slice, see _save_state_and_schedule_next.
+    No input is processed in this slice. The request is dropped if the
+    other shard is no longer idle or the input reader does not split.
+
+    Args:
+      shard_state: model.ShardState for current shard.
+      tstate: model.TransientShardState for current shard.
+
+    Returns:
+      A _TASK_DIRECTIVE enum. Always PROCEED_TASK.
+    """
+    target_number = shard_state.split_request
+    shard_state.split_request = None
+    self._handled_split_request = target_number
+    target_id = model.ShardState.shard_id_from_number(
+        shard_state.mapreduce_id, target_number)
+    if (tstate.output_writer or not
+        self._is_idle(model.ShardState.get_by_shard_id(target_id))):
+      logging.warning("Shard %s can't take input from shard %s.",
+                      target_id, shard_state.shard_id)
+      return self._TASK_DIRECTIVE.PROCEED_TASK
+
+    input_reader = tstate.input_reader._split_remaining()
+    if input_reader is None:
+      return self._TASK_DIRECTIVE.PROCEED_TASK
+    # If this shard is retried, it starts over from its initial input reader
+    # and reads the given input again. Duplicates are possible then as they
+    # are with any shard retry.
+    shard_state.input_remaining = tstate.input_reader._remaining_size()
+    self._split = (target_id, input_reader)
+    logging.info("Shard %s gives %s to shard %s.",
+                 shard_state.shard_id, input_reader, target_id)
+    return self._TASK_DIRECTIVE.PROCEED_TASK
+
+  @staticmethod
+  def _is_idle(shard_state):
+    """Whether a shard finished successfully and can take more input."""
+    return (shard_state is not None and not shard_state.active and
+            shard_state.result_status == model.ShardState.RESULT_SUCCESS)
+
   def _set_state(self, shard_state, tstate, task_directive):
     """Set shard_state and tstate based on task_directive.
 
@@ -736,7 +865,11 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
       task = self._state_to_task(tstate, shard_state)
     else:
       assert task_directive == self._TASK_DIRECTIVE.PROCEED_TASK
-      countdown = self._get_countdown_for_next_slice(spec)
+      if self._handled_split_request is not None:
+        # The slice only split the input, don't hold the next one back.
+        countdown = 0
+      else:
+        countdown = self._get_countdown_for_next_slice(spec)
       task = self._state_to_task(tstate, shard_state, countdown=countdown)
 
     # Prepare parameters for db transaction and taskqueue.
@@ -746,7 +879,9 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
                                 "default")
     config = util.create_datastore_write_config(spec)
 
-    @db.transactional(retries=5)
+    # Reviving the shard that takes part of the input of this one spans two
+    # entity groups.
+    @db.transactional(retries=5, xg=bool(self._split))
     def _tx():
       """The Transaction helper."""
       fresh_shard_state = model.ShardState.get_by_shard_id(tstate.shard_id)
@@ -759,7 +894,15 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
         logging.warning("Datastore's %s", str(fresh_shard_state))
         logging.warning("Slice's %s", str(shard_state))
         return
+      target_task = None
+      if self._split:
+        target_task = self._revive_shard(spec, tstate, config)
+      split_request = fresh_shard_state.split_request
       fresh_shard_state.copy_from(shard_state)
+      if (split_request is not None and
+          split_request != self._handled_split_request):
+        # The controller asked for a split while this slice ran.
+        fresh_shard_state.split_request = split_request
       fresh_shard_state.put(config=config)
       # Add task in the same datastore transaction.
       # This way we guarantee taskqueue is never behind datastore states.
@@ -769,6 +912,14 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
         # Not adding task transactionally.
         # transactional enqueue requires tasks with no name.
         self._add_task(task, spec, queue_name)
+      if target_task and not _run_task_hook(spec.get_hooks(),
+                                            "enqueue_worker_task",
+                                            target_task,
+                                            queue_name):
+        # Unlike the task of this shard, the task of the revived shard is
+        # added transactionally. A named task left behind by a failed
+        # transaction would block a later revival with the same slice id.
+        target_task.add(queue_name, transactional=True)
 
     try:
       _tx()
@@ -785,6 +936,39 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
       self._try_free_lease(shard_state)
       raise e
 
+  def _revive_shard(self, spec, tstate, config):
+    """Revives the shard that takes the input split off by _split_shard.
+
+    Must be called in the transaction that saves the state of this shard.
+
+    Args:
+      spec: model.MapreduceSpec of the job.
+      tstate: model.TransientShardState for current shard.
+      config: datastore write config.
+
+    Returns:
+      The unnamed model.HugeTask for the first slice of the revived shard.
+
+    Raises:
+      datastore_errors.TransactionFailedError: if the shard is no longer idle.
+    The slice is retried then and drops the split request.
+    """
+    target_id, input_reader = self._split
+    target_state = model.ShardState.get_by_shard_id(target_id)
+    if not self._is_idle(target_state):
+      raise datastore_errors.TransactionFailedError(
+          "Shard %s is no longer idle." % target_id)
+    target_state.reset_for_split()
+    target_state.shard_description = str(input_reader)
+    target_state.put(config=config)
+    target_tstate = model.TransientShardState(
+        tstate.base_path, spec, target_id, target_state.slice_id,
+        input_reader, input_reader, retries=target_state.retries,
+        handler=spec.mapper.handler)
+    target_task = self._state_to_task(target_tstate, target_state)
+    target_task.name = None
+    return target_task
+
   def _attempt_slice_recovery(self, shard_state, tstate):
     """Recover a slice.
 
@@ -1008,6 +1192,9 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
   def _processing_limit(self, spec):
     """Get the limit on the number of map calls allowed by this slice.
 
+    With the adaptive rate, the job rate rate_control keeps is used instead of
+    the processing_rate the job was started with.
+
     Args:
       spec: a Mapreduce spec.
 
@@ -1015,6 +1202,11 @@ class MapperWorkerCallbackHandler(base_handler.HugeTaskHandler):
       The limit as a positive int if specified by user. -1 otherwise.
     """
     processing_rate = float(spec.mapper.params.get("processing_rate", 0))
+    if (processing_rate > 0 and
+        spec.mapper.params.get(rate_control.ADAPTIVE_RATE_PARAM)):
+      if self._job_rate is None:
+        self._job_rate = rate_control.get_rate(spec)
+      processing_rate = self._job_rate
     slice_processing_limit = -1
     if processing_rate > 0:
       slice_processing_limit = int(math.ceil(
@@ -1137,6 +1329,9 @@ class ControllerCallbackHandler(base_handler.HugeTaskHandler):
     total_shards = 0
     processed_counts = []
     processed_status = []
+    # (shard number, shard state) of the shards for _request_splits. Only the
+    # properties it needs are kept to limit memory use.
+    split_candidates = []
     state.counters_map.clear()
 
     # Tally across shard states once.
@@ -1159,6 +1354,9 @@ class ControllerCallbackHandler(base_handler.HugeTaskHandler):
       state.counters_map.add_map(s.counters_map)
       processed_counts.append(s.counters_map.get(context.COUNTER_MAPPER_CALLS))
       processed_status.append(status)
+      split_candidates.append(
+          (s.shard_number, s.active, status == 'success', s.input_remaining,
+           s.split_request))
 
     state.set_processed_counts(processed_counts, processed_status)
     state.last_poll_time = datetime.datetime.utcfromtimestamp(self._time())
@@ -1179,6 +1377,10 @@ class ControllerCallbackHandler(base_handler.HugeTaskHandler):
     if not control and (state.failed_shards or state.aborted_shards):
       # Issue abort command if there are failed shards.
       model.MapreduceControl.abort(spec.mapreduce_id)
+    elif (state.active and not control and
+          spec.mapper.params.get("work_stealing") and
+          not spec.mapper.output_writer_class()):
+      self._request_splits(spec, split_candidates)
 
     if not state.active:
       # Set final result status derived from shard states.
@@ -1209,6 +1411,60 @@ class ControllerCallbackHandler(base_handler.HugeTaskHandler):
 
       _put_state()
 
+  def _request_splits(self, spec, split_candidates):
+    """Asks straggler shards to give part of their input to idle shards.
+
+    A running shard is a straggler when it has at least
+    _STRAGGLER_MIN_REMAINING input left and, unless it is the only one
+    running, more than _STRAGGLER_FACTOR times the median remaining input of
+    the running shards. The stragglers with the most input left are paired
+    with the shards that finished successfully, and each is asked to split at
+    the start of its next slice. See MapperWorkerCallbackHandler._split_shard.
+
+    Args:
+      spec: model.MapreduceSpec of the job.
+      split_candidates: list of (shard number, active, succeeded,
+        input_remaining, split_request) tuples, one per shard.
+    """
+    targeted = set(request for _, _, _, _, request in split_candidates
+                   if request is not None)
+    idle = [number for number, active, succeeded, _, _ in split_candidates
+            if not active and succeeded and number not in targeted]
+    if not idle:
+      return
+    remaining = sorted(left or 0 for _, active, _, left, _ in split_candidates
+                       if active)
+    if not remaining:
+      return
+    # The lower median, so that one of two running shards can be a straggler.
+    median = remaining[(len(remaining) - 1) // 2]
+    if len(remaining) == 1:
+      median = 0
+    stragglers = sorted(
+        [(left, number)
+         for number, active, _, left, request in split_candidates
+         if active and request is None and left and
+         left >= parameters.config._STRAGGLER_MIN_REMAINING and
+         left > parameters.config._STRAGGLER_FACTOR * median],
+        reverse=True)
+    config = util.create_datastore_write_config(spec)
+    for (left, number), target in zip(stragglers, idle):
+      shard_id = model.ShardState.shard_id_from_number(spec.mapreduce_id,
+                                                       number)
+
+      @db.transactional(retries=5)
+      def _tx():
+        """Sets the split request if the straggler has none."""
+        fresh_state = model.ShardState.get_by_shard_id(shard_id)
+        if (fresh_state and fresh_state.active and
+            fresh_state.split_request is None):
+          fresh_state.split_request = target
+          fresh_state.put(config=config)
+
+      _tx()
+      logging.info("Asked shard %s with %s left to split with shard %s.",
+                   shard_id, left, target)
+
   def serial_id(self):
     """Get serial unique identifier of this task from request.
 
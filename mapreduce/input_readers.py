@@ -26,6 +26,9 @@ __all__ = [
     "BlobstoreZipLineInputReader",
     "COUNTER_IO_READ_BYTES",
     "COUNTER_IO_READ_MSEC",
+    "COUNTER_IO_READ_ROWS",
+    "COUNTER_IO_REREAD_BYTES",
+    "COUNTER_IO_TOTAL_ROWS",
     "DatastoreEntityInputReader",
     "DatastoreInputReader",
     "DatastoreKeyInputReader",
@@ -33,6 +36,7 @@ __all__ = [
     # JRW add 2015-08-12
     "GoogleCloudStorageLineInputReader",
     "GoogleCloudStorageRecordInputReader",
+    "GoogleCloudStorageRowInputReader",
     "RandomStringInputReader",
     "RawDatastoreInputReader",
     "Error",
@@ -45,20 +49,26 @@ __all__ = [
 # pylint: disable=protected-access
 
 import base64
+import bisect
+import collections
 import copy
+import hashlib
 import logging
+import marshal
 import pickle
 import random
 import string
 import StringIO
 import time
 import zipfile
+import zlib
 
 from google.net.proto import ProtocolBuffer
 from google.appengine.ext import ndb
 
 from google.appengine.api import datastore
 from google.appengine.api import logservice
+from google.appengine.api import memcache
 from google.appengine.api.logservice import log_service_pb
 from google.appengine.ext import blobstore
 from google.appengine.ext import db
@@ -107,6 +117,16 @@ COUNTER_IO_READ_BYTES = "io-read-bytes"
 # Counter name for milliseconds spent reading data.
 COUNTER_IO_READ_MSEC = "io-read-msec"
 
+# Counter name for number of bytes read or requested ahead when a slice ended,
+# which the next slice reads again.
+COUNTER_IO_REREAD_BYTES = "io-reread-bytes"
+
+# Counter name for number of lines read by line readers.
+COUNTER_IO_READ_ROWS = "io-read-rows"
+
+# Counter name for number of lines to read in the files with a line index.
+COUNTER_IO_TOTAL_ROWS = "io-total-rows"
+
 # Special value that can be yielded by InputReaders if they want to give the
 # framework an opportunity to save the state of the mapreduce without having
 # to yield an actual value to the handler.
@@ -204,6 +224,58 @@ class InputReader(json_util.JsonMixin):
     if mapper_spec.input_reader_class() != cls:
       raise BadReaderParamsError("Input reader class mismatch")
 
+  def _remaining_size(self):
+    """Returns the amount of input left to this reader.
+
+    Used by the controller to find straggler shards in jobs with the
+    work_stealing mapper parameter.
+
+    Returns:
+      The remaining input as an int in a unit of the reader's choice, or None
+    if this reader does not know.
+    """
+    return None
+
+  def _split_remaining(self):
+    """Gives part of the remaining input of this reader to a new reader.
+
+    Called between slices only. After this call, this reader reads only
+    the part of its input that it kept.
+
+    Returns:
+      A new InputReader for the given part of the input, or None if this
+    reader does not split.
+    """
+    return None
+
+  def _buffered_size(self):
+    """Returns the number of bytes read ahead of the current position.
+
+    They are read again by the reader restored from to_json in the next
+    slice. The worker prefers to end a slice when this is small.
+
+    Returns:
+      The number of bytes as an int, or None if this reader does not buffer
+    or does not know.
+    """
+    return None
+
+  def _prefetched_size(self):
+    """Returns the number of bytes requested after those of _buffered_size.
+
+    Like those, they are read again by the reader restored from to_json in
+    the next slice.
+
+    Returns:
+      The number of bytes as an int, or None if this reader does not prefetch
+    or does not know.
+    """
+    return None
+
+  def _stop_prefetch(self):
+    """Stops reading ahead of what is needed, as the slice is about to end."""
+    pass
+
 
 def _get_params(mapper_spec, allowed_keys=None, allow_old=True):
   """Obtain input reader parameters.
@@ -2544,6 +2616,168 @@ GoogleCloudStorageInputReader = _GoogleCloudStorageInputReader
 
 # JRW added class below
 
+class _GzipLineReader(object):
+  """Reads the lines of a gzip file from a GCS read buffer.
+
+  A gzip file is a series of members, and decompression can only start at
+  the beginning of one. The position of this reader is the offset in the file
+  of the member where the next line starts, and the number of decompressed
+  bytes of that member before the line. A reader restored at this position
+  decompresses the member again up to the line. A file in a single member,
+  as written by gzip, is thus decompressed again from its start by every
+  slice, which is why large ones need members, see
+  GoogleCloudStorageLineInputReader._MAX_GZIP_SIZE_WITHOUT_MEMBERS.
+
+  Only the lines that start in members before end_position are read. Files
+  written in members of whole lines, see tools/gzip_blocks.py, can thus be
+  read in ranges that start and end at member offsets.
+  """
+
+  # Number of compressed bytes to decompress at a time.
+  _READ_SIZE = 256 * 1024
+
+  def __init__(self, file_reader, member_offset, end_position, skip=0):
+    """Initializes this instance.
+
+    Args:
+      file_reader: a cloudstorage ReadBuffer opened at member_offset.
+      member_offset: the offset of the member to start at.
+      end_position: lines starting in members at or after this offset are not
+        read.
+      skip: the number of decompressed bytes of the member to skip.
+    """
+    self._file_reader = file_reader
+    # May be moved back when the range is split.
+    self.end_position = end_position
+    self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # Offset of the compressed data to decompress next.
+    self._feed_offset = member_offset
+    self._unused = ''
+    # Decompressed data, read up to self._pos.
+    self._data = ''
+    self._pos = 0
+    # The member of the next line, and where it starts in self._data.
+    self._member_offset = member_offset
+    self._member_start = 0
+    # (index in self._data, member offset) of the members decompressed after
+    # the one of the next line.
+    self._boundaries = []
+    while skip:
+      if self._pos == len(self._data) and not self._fill():
+        break
+      skipped = min(skip, len(self._data) - self._pos)
+      self._advance(self._pos + skipped)
+      skip -= skipped
+
+  def tell(self):
+    """Returns the offset of the member where the next line starts."""
+    return self._member_offset
+
+  def skip(self):
+    """Returns the decompressed bytes of the member before the next line."""
+    return self._pos - self._member_start
+
+  def buffered(self):
+    """Returns the number of compressed bytes buffered but not decompressed."""
+    return self._file_reader.buffered() + len(self._unused)
+
+  def prefetched(self):
+    """Returns the number of compressed bytes requested after the buffer."""
+    return self._file_reader.prefetched()
+
+  def stop_prefetch(self):
+    """Stops requesting compressed buffers ahead of the read buffer."""
+    self._file_reader.stop_prefetch()
+
+  def readline(self):
+    """Reads one line, with its newline, or '' if there are none left."""
+    if not self._ready():
+      return ''
+    line_list = []
+    while True:
+      newline = self._data.find('\n', self._pos)
+      if newline >= 0:
+        line_list.append(self._data[self._pos:newline + 1])
+        self._advance(newline + 1)
+        break
+      line_list.append(self._data[self._pos:])
+      self._advance(len(self._data))
+      if not self._fill():
+        break
+    return ''.join(line_list)
+
+  def readlines(self, max_lines=-1):
+    """Reads many lines, without their newlines, like ReadBuffer.readlines.
+
+    Args:
+      max_lines: maximum number of lines to read. Negative for no limit.
+
+    Returns:
+      A list of lines. Empty if there are none left or max_lines is 0.
+    """
+    lines = []
+    while (max_lines < 0 or len(lines) < max_lines) and self._ready():
+      limit = len(self._data)
+      for index, member_offset in self._boundaries:
+        if member_offset >= self.end_position:
+          limit = index
+          break
+      end = self._data.rfind('\n', self._pos, limit)
+      if end < 0:
+        line = self.readline()
+        lines.append(line[:-1] if line.endswith('\n') else line)
+        continue
+      new_lines = self._data[self._pos:end].split('\n')
+      if 0 <= max_lines - len(lines) < len(new_lines):
+        del new_lines[max_lines - len(lines):]
+        end = self._pos + sum(map(len, new_lines)) + len(new_lines) - 1
+      lines.extend(new_lines)
+      self._advance(end + 1)
+    return lines
+
+  def _ready(self):
+    """Whether there is a line to read in the range."""
+    if self._pos == len(self._data) and not self._fill():
+      return False
+    return self._member_offset < self.end_position
+
+  def _advance(self, pos):
+    """Moves the read position in self._data to pos."""
+    while self._boundaries and self._boundaries[0][0] <= pos:
+      self._member_start, self._member_offset = self._boundaries.pop(0)
+    self._pos = pos
+
+  def _fill(self):
+    """Decompresses more data after the data read.
+
+    Returns:
+      False if the file has no more data.
+    """
+    self._data = self._data[self._pos:]
+    self._member_start -= self._pos
+    self._boundaries = [(index - self._pos, member_offset)
+                        for index, member_offset in self._boundaries]
+    self._pos = 0
+    while len(self._data) == 0:
+      if self._unused:
+        data, self._unused = self._unused, ''
+      else:
+        data = self._file_reader.read(self._READ_SIZE)
+        if not data:
+          return False
+      self._data = self._decompressor.decompress(data)
+      self._feed_offset += len(data)
+      if self._decompressor.unused_data:
+        # The member ended, what is left starts the next one.
+        self._unused = self._decompressor.unused_data
+        self._feed_offset -= len(self._unused)
+        self._boundaries.append((len(self._data), self._feed_offset))
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    # The next line starts in the next member if the last one just ended.
+    self._advance(0)
+    return True
+
+
 # pylint: disable=too-many-instance-attributes
 class GoogleCloudStorageLineInputReader(InputReader):
   """Input reader for a newline delimited file in Google Cloud Storage.
@@ -2562,32 +2796,104 @@ class GoogleCloudStorageLineInputReader(InputReader):
 
     Optional configuration in the mapper_sec.input_reader dictionary.
     buffer_size : the size of the read buffer for each file handle.
+    prefetch : the number of buffers to request ahead of the one being read.
+      With more than one, the size of the requests grows from buffer_size while
+      the lines are read faster than they are fetched.
     delimiter : if specified, turn on the shallow splitting mode.
       The delimiter is used as a path separator to designate directory
       hierarchy. Matching of prefixes from objects
       will stop at the first directory instead of matching
       all files under the directory. This allows MR to process bucket with
       hundreds of thousands of files.
+    bytes_per_shard : if specified, the number of shards is chosen so that
+      each shard reads about this many bytes, up to _MAX_SHARD_COUNT shards.
+      Otherwise the shard_count of the mapper spec is used.
+    listing_cache_seconds : if specified, the names, sizes and etags of the
+      files are kept in memcache for this many seconds, and jobs started with
+      the same bucket_name, objects and delimiter in that time do not list
+      and stat the files again. A file replaced in that time fails the job
+      on its etag, so use 0 after replacing files.
+
+  Prefixes are listed one directory level at a time with the directories
+  below the prefix listed concurrently, and the files named in full, along
+  with their .members and .lines objects, are stat'ed concurrently.
+
+  The total size of the files is split into shards of the same size. Large
+  files are split across shards and small files are packed together, so a
+  shard reads a list of line aligned ranges of one or more files.
+
+  Files with names ending in .gz are decompressed as they are read. A gzip
+  file is only split across shards at the member offsets listed in a
+  <file name>.members object next to it, see tools/gzip_blocks.py, and is
+  read by a single shard otherwise. Without that object the members of the
+  file are not known, and every slice decompresses the file again from its
+  start, or from the last member boundary it went by, so gzip files of more
+  than _MAX_GZIP_SIZE_WITHOUT_MEMBERS bytes without one are refused. Objects
+  ending in .members are not read.
+
+  Files that are not gzip may have a <file name>.lines line index next to
+  them, see tools/line_index.py. Such files are only cut at the lines of the
+  index, so that shards start right at a line. If all the files have one,
+  the shards get the same number of lines rather than bytes. The lines read
+  are counted in io-read-rows, out of io-total-rows lines in the files with
+  an index. Objects ending in .lines are not read.
   Outputs:
     A tuple containing an other tuple and the Line
     ((File name, start position), line)
     File name : Name of the file the data came from
     start position : Files index position for the start of the data
     line : The data read till a '\n' was reached
+
+    If lines_per_block is set in the mapper_spec.input_reader dictionary, the
+    reader runs in block mode and outputs up to that many lines at a time
+    ((File name, start position), [line, ...])
+    start position : Files index position for the start of the first line
   """
 
   # Supported parameters
   BUCKET_NAME_PARAM = 'bucket_name'
   OBJECT_NAMES_PARAM = 'objects'
   BUFFER_SIZE_PARAM = 'buffer_size'
+  PREFETCH_PARAM = 'prefetch'
   DELIMITER_PARAM = 'delimiter'
+  LINES_PER_BLOCK_PARAM = 'lines_per_block'
+  BYTES_PER_SHARD_PARAM = 'bytes_per_shard'
+  LISTING_CACHE_PARAM = 'listing_cache_seconds'
   # Internal parameters
   # Maximum number of shards to allow.
   _MAX_SHARD_COUNT = 256
+  # Maximum number of directories listed at the same time.
+  _LIST_CONCURRENCY = 32
+  # Maximum number of bytes of a listing per memcache value.
+  _LISTING_CHUNK_SIZE = 900 * 1024
+  # Minimum number of bytes left to a reader to split them with another shard.
+  _MIN_SPLIT_SIZE = 4 * 1024 * 1024
+  # Maximum size of a gzip file without a .members object. Each slice may
+  # decompress such a file again up to where it resumes.
+  _MAX_GZIP_SIZE_WITHOUT_MEMBERS = 4 * 1024 * 1024
   _ACCOUNT_ID_PARAM = 'account_id'
   # Serialization parameters.
   INITIAL_POSITION_PARAM = 'initial_position'
   END_POSITION_PARAM = 'end_position'
+  # The [file name, start position, end position] ranges after the current one.
+  RANGES_PARAM = 'ranges'
+  # The [size, etag] of the files of the ranges by file name.
+  FILE_STATS_PARAM = 'file_stats'
+  # The member offsets of the gzip files of the ranges by file name.
+  MEMBERS_PARAM = 'members'
+  # Decompressed bytes to skip in the gzip member at the initial position.
+  SKIP_PARAM = 'skip'
+  # Suffix of the names of gzip files.
+  GZIP_SUFFIX = '.gz'
+  # Suffix of the names of the objects listing the member offsets of a gzip
+  # file, one per line.
+  MEMBERS_SUFFIX = '.members'
+  # Suffix of the names of the line indexes. The first line of an index has
+  # the number of lines between indexed lines, the number of lines and the
+  # size of the file. The offsets of the indexed lines follow, one per line.
+  LINE_INDEX_SUFFIX = '.lines'
+  # Lines of the ranges of the reader not yet added to io-total-rows.
+  PLANNED_ROWS_PARAM = 'planned_rows'
 
   @classmethod
   def validate(cls, mapper_spec):
@@ -2632,6 +2938,39 @@ class GoogleCloudStorageLineInputReader(InputReader):
         raise errors.BadReaderParamsError(
         '%s is not a string but a %s' %
         (cls.DELIMITER_PARAM, type(delimiter)))
+    if reader_spec.get(cls.LINES_PER_BLOCK_PARAM) is not None:
+      lines_per_block = reader_spec[cls.LINES_PER_BLOCK_PARAM]
+      if not isinstance(lines_per_block, (int, long)) or lines_per_block < 1:
+        raise errors.BadReaderParamsError(
+          '%s is not a positive integer but %r' %
+          (cls.LINES_PER_BLOCK_PARAM, lines_per_block))
+    if reader_spec.get(cls.BYTES_PER_SHARD_PARAM) is not None:
+      bytes_per_shard = reader_spec[cls.BYTES_PER_SHARD_PARAM]
+      if not isinstance(bytes_per_shard, (int, long)) or bytes_per_shard < 1:
+        raise errors.BadReaderParamsError(
+          '%s is not a positive integer but %r' %
+          (cls.BYTES_PER_SHARD_PARAM, bytes_per_shard))
+    if reader_spec.get(cls.BUFFER_SIZE_PARAM) is not None:
+      buffer_size = reader_spec[cls.BUFFER_SIZE_PARAM]
+      if (not isinstance(buffer_size, (int, long)) or buffer_size < 1 or
+          buffer_size > cloudstorage.ReadBuffer.MAX_REQUEST_SIZE):
+        raise errors.BadReaderParamsError(
+          '%s is not a positive integer up to %d but %r' %
+          (cls.BUFFER_SIZE_PARAM,
+           cloudstorage.ReadBuffer.MAX_REQUEST_SIZE, buffer_size))
+    if reader_spec.get(cls.PREFETCH_PARAM) is not None:
+      prefetch = reader_spec[cls.PREFETCH_PARAM]
+      if not isinstance(prefetch, (int, long)) or prefetch < 1:
+        raise errors.BadReaderParamsError(
+          '%s is not a positive integer but %r' %
+          (cls.PREFETCH_PARAM, prefetch))
+    if reader_spec.get(cls.LISTING_CACHE_PARAM) is not None:
+      listing_cache_seconds = reader_spec[cls.LISTING_CACHE_PARAM]
+      if (not isinstance(listing_cache_seconds, (int, long)) or
+          listing_cache_seconds < 0):
+        raise errors.BadReaderParamsError(
+          '%s is not a non-negative integer but %r' %
+          (cls.LISTING_CACHE_PARAM, listing_cache_seconds))
 
   # pylint: disable=too-many-locals
   @classmethod
@@ -2651,59 +2990,437 @@ class GoogleCloudStorageLineInputReader(InputReader):
     delimiter = reader_spec.get(cls.DELIMITER_PARAM)
     account_id = reader_spec.get(cls._ACCOUNT_ID_PARAM)
     buffer_size = reader_spec.get(cls.BUFFER_SIZE_PARAM)
+    prefetch = reader_spec.get(cls.PREFETCH_PARAM)
+    lines_per_block = reader_spec.get(cls.LINES_PER_BLOCK_PARAM)
+    listing_cache_seconds = reader_spec.get(cls.LISTING_CACHE_PARAM)
     # Gather the complete list of files (expanding wildcards)
-    all_file_names = []
-    for file_name in file_names:
-      if file_name.endswith('*'):
-        all_file_names.extend(
-             [file_stat for file_stat in cloudstorage.listbucket(
-               '/' + bucket + '/' + file_name[:-1], delimiter=delimiter,
-               _account_id=account_id)])
-      else:
-        try:
-          all_file_names.append(cloudstorage
-                               .stat(('/%s/%s') % (bucket, file_name)))
-        except cloudstorage.NotFoundError:
-          logging.warning('File /%s/%s may have been removed. Skipping file.',
-            bucket, file_name)
-    shard_count = min(cls._MAX_SHARD_COUNT, mapper_spec.shard_count)
-    try:
-      shards_per_file = shard_count // len(all_file_names)
-    except ZeroDivisionError:
-      shards_per_file = 1
-    if shards_per_file == 0:
-      shards_per_file = 1
-    chunks = []
+    all_file_names = cls._list_files(bucket, file_names, delimiter, account_id,
+                                     listing_cache_seconds)
+    listed = set(file_stats.filename for file_stats in all_file_names)
+    all_file_names = [file_stats for file_stats in all_file_names
+                      if not file_stats.filename.endswith(
+                          (cls.MEMBERS_SUFFIX, cls.LINE_INDEX_SUFFIX))]
+    # Read the .members and .lines objects that exist, all at the same time.
+    sidecars = [cls._sidecar(file_stats.filename)
+                for file_stats in all_file_names if file_stats.st_size > 0 and
+                cls._sidecar(file_stats.filename) in listed]
+    sidecars = dict(zip(sidecars, cloudstorage.read_multi(
+        sidecars, _account_id=account_id)))
+    members = {}
+    line_indexes = {}
     for file_stats in all_file_names:
-      file_name = file_stats.filename
-      file_size = file_stats.st_size
-      file_chunk_size = file_size // shards_per_file
-      for i in xrange(shards_per_file - 1):
-        chunks.append(GoogleCloudStorageLineInputReader.from_json(
-          {cls.OBJECT_NAMES_PARAM: file_name,
-           cls.INITIAL_POSITION_PARAM: file_chunk_size * i,
-           cls.END_POSITION_PARAM: file_chunk_size * (i + 1),
-           cls.BUFFER_SIZE_PARAM : buffer_size,
-           cls.DELIMITER_PARAM: delimiter,
-           cls._ACCOUNT_ID_PARAM : account_id
-           }))
+      if file_stats.st_size > 0 and cls._is_gzip(file_stats.filename):
+        members[file_stats.filename] = cls._parse_members(
+            file_stats, sidecars.get(cls._sidecar(file_stats.filename)))
+      elif file_stats.st_size > 0:
+        line_index = cls._parse_line_index(
+            file_stats, sidecars.get(cls._sidecar(file_stats.filename)))
+        if line_index:
+          line_indexes[file_stats.filename] = line_index
+    total_size = sum(file_stats.st_size for file_stats in all_file_names)
+    bytes_per_shard = reader_spec.get(cls.BYTES_PER_SHARD_PARAM)
+    if bytes_per_shard:
+      shard_count = (total_size + bytes_per_shard - 1) // bytes_per_shard
+    else:
+      shard_count = mapper_spec.shard_count
+    shard_count = max(1, min(cls._MAX_SHARD_COUNT, shard_count))
+    non_empty = [[file_stats.filename, 0, file_stats.st_size]
+                 for file_stats in all_file_names if file_stats.st_size > 0]
+    if non_empty and len(line_indexes) == len(non_empty):
+      # Plan the lines, and cut the files at the positions of the lines.
+      row_ranges = [[file_name, 0, line_indexes[file_name][1]]
+                    for file_name, _, _ in non_empty]
+      row_points = dict((file_name, range(every, rows, every))
+                        for file_name, (every, rows, _, _)
+                        in line_indexes.items())
+      row_plan = cls._plan_ranges(row_ranges, shard_count, row_points)
+      plan = [[[file_name,
+                cls._line_position(line_indexes[file_name], start_row),
+                cls._line_position(line_indexes[file_name], end_row)]
+               for file_name, start_row, end_row in shard_ranges]
+              for shard_ranges in row_plan]
+    elif non_empty:
+      split_points = dict(members)
+      for file_name, (_, _, _, offsets) in line_indexes.items():
+        split_points[file_name] = [offset - 1 for offset in offsets[1:]]
+      plan = cls._plan_ranges(non_empty, shard_count, split_points)
+    else:
+      # Nothing to read, but keep a shard per file like before.
+      plan = [[[file_stats.filename, 0, 0]] for file_stats in all_file_names]
+    file_stats = dict((file_stats.filename, [file_stats.st_size,
+                                             file_stats.etag])
+                      for file_stats in all_file_names)
+    chunks = []
+    for ranges in plan:
+      file_name, start_position, end_position = ranges[0]
       chunks.append(GoogleCloudStorageLineInputReader.from_json(
          {cls.OBJECT_NAMES_PARAM: file_name,
-         cls.INITIAL_POSITION_PARAM: file_chunk_size * (shards_per_file - 1),
-         cls.END_POSITION_PARAM: file_size,
+         cls.INITIAL_POSITION_PARAM: start_position,
+         cls.END_POSITION_PARAM: end_position,
          cls.BUFFER_SIZE_PARAM : buffer_size,
+         cls.PREFETCH_PARAM: prefetch,
          cls.DELIMITER_PARAM: delimiter,
-         cls._ACCOUNT_ID_PARAM : account_id}))
+         cls._ACCOUNT_ID_PARAM : account_id,
+         cls.LINES_PER_BLOCK_PARAM: lines_per_block,
+         cls.RANGES_PARAM: ranges[1:],
+         cls.FILE_STATS_PARAM: cls._for_ranges(file_stats, ranges),
+         cls.MEMBERS_PARAM: cls._for_ranges(members, ranges),
+         cls.PLANNED_ROWS_PARAM: sum(
+             cls._line_row(line_indexes[file_name], end) -
+             cls._line_row(line_indexes[file_name], start)
+             for file_name, start, end in ranges
+             if file_name in line_indexes)}))
     return chunks
 
+  @classmethod
+  def _list_files(cls, bucket, file_names, delimiter, account_id,
+                  cache_seconds):
+    """Returns the GCSFileStats of the files to read.
+
+    Args:
+      bucket: the name of the bucket.
+      file_names: the object names and prefixes ending in * of the files.
+      delimiter: the delimiter of the shallow splitting mode, or None.
+      account_id: internal use
+      cache_seconds: how long to keep the listing in memcache, or None.
+
+    Returns:
+      The GCSFileStats of the files in the order of file_names, with those of
+      the .members and .lines objects of the files named in full that exist.
+    """
+    if cache_seconds:
+      cache_key = 'GoogleCloudStorageLineInputReader.listing:' + hashlib.sha1(
+          repr((bucket, file_names, delimiter, account_id))).hexdigest()
+      cached = cls._get_cached_listing(cache_key)
+      if cached is not None:
+        return cached
+    all_file_names = []
+    named = []
+    for file_name in file_names:
+      if file_name.endswith('*'):
+        all_file_names.extend(cls._list_prefix(
+            '/' + bucket + '/' + file_name[:-1], delimiter, account_id))
+      else:
+        path = '/%s/%s' % (bucket, file_name)
+        named.append((len(all_file_names), path))
+        all_file_names.append(None)
+    paths = []
+    for _, path in named:
+      paths.extend([path, cls._sidecar(path)])
+    stats = cloudstorage.stat_multi(paths, _account_id=account_id)
+    for (i, path), file_stats, sidecar_stats in zip(
+        named, stats[::2], stats[1::2]):
+      if file_stats is None:
+        logging.warning('File %s may have been removed. Skipping file.', path)
+        all_file_names[i] = []
+      else:
+        all_file_names[i] = [file_stats, sidecar_stats]
+    listing = []
+    for file_stats in all_file_names:
+      if isinstance(file_stats, list):
+        listing.extend(stats for stats in file_stats if stats is not None)
+      else:
+        listing.append(file_stats)
+    if cache_seconds:
+      cls._set_cached_listing(cache_key, listing, cache_seconds)
+    return listing
+
+  @classmethod
+  def _list_prefix(cls, path_prefix, delimiter, account_id):
+    """Returns the GCSFileStats of the files under a prefix.
+
+    Without a delimiter, the directories right under the prefix are listed
+    at the same time, up to _LIST_CONCURRENCY of them, rather than paging
+    through the whole prefix one request after another.
+
+    Args:
+      path_prefix: /bucket/prefix of the files.
+      delimiter: the delimiter of the shallow splitting mode, or None.
+      account_id: internal use
+
+    Returns:
+      The GCSFileStats of the files, sorted by name.
+    """
+    if delimiter:
+      return [file_stats for file_stats in cloudstorage.listbucket(
+          path_prefix, delimiter=delimiter, _account_id=account_id)
+              if not file_stats.is_dir]
+    listing = []
+    directories = []
+    for file_stats in cloudstorage.listbucket(
+        path_prefix, delimiter='/', _account_id=account_id):
+      if file_stats.is_dir:
+        directories.append(file_stats.filename)
+      else:
+        listing.append(file_stats)
+    # A listing requests its first page as soon as it is created.
+    listings = collections.deque()
+    for directory in directories:
+      if len(listings) == cls._LIST_CONCURRENCY:
+        listing.extend(listings.popleft())
+      listings.append(cloudstorage.listbucket(
+          directory, _account_id=account_id))
+    while listings:
+      listing.extend(listings.popleft())
+    listing.sort(key=lambda file_stats: file_stats.filename)
+    return listing
+
+  @classmethod
+  def _get_cached_listing(cls, cache_key):
+    """Returns a listing stored by _set_cached_listing, or None."""
+    header = memcache.get(cache_key)
+    if not header:
+      return None
+    token, count = header
+    chunk_keys = ['%s:%s:%d' % (cache_key, token, i) for i in xrange(count)]
+    chunks = memcache.get_multi(chunk_keys)
+    if len(chunks) != count:
+      return None
+    entries = pickle.loads(zlib.decompress(
+        ''.join(chunks[chunk_key] for chunk_key in chunk_keys)))
+    return [cloudstorage.GCSFileStat(filename, st_size, etag, st_ctime)
+            for filename, st_size, etag, st_ctime in entries]
+
+  @classmethod
+  def _set_cached_listing(cls, cache_key, listing, cache_seconds):
+    """Stores a listing in memcache in chunks of _LISTING_CHUNK_SIZE bytes.
+
+    The chunks are written under a new token before the header pointing to
+    them, so that a reader never combines chunks of two listings.
+    """
+    data = zlib.compress(pickle.dumps(
+        [(file_stats.filename, file_stats.st_size, file_stats.etag,
+          file_stats.st_ctime) for file_stats in listing],
+        pickle.HIGHEST_PROTOCOL))
+    token = '%x' % random.getrandbits(32)
+    chunks = dict(('%s:%s:%d' % (cache_key, token, i),
+                   data[offset:offset + cls._LISTING_CHUNK_SIZE])
+                  for i, offset in enumerate(
+                      xrange(0, len(data), cls._LISTING_CHUNK_SIZE)))
+    if memcache.set_multi(chunks, time=cache_seconds):
+      # Some chunks were not stored.
+      return
+    memcache.set(cache_key, [token, len(chunks)], time=cache_seconds)
+
+  @classmethod
+  def _sidecar(cls, file_name):
+    """Returns the name of the .members or .lines object of a file."""
+    if cls._is_gzip(file_name):
+      return file_name + cls.MEMBERS_SUFFIX
+    return file_name + cls.LINE_INDEX_SUFFIX
+
+  @classmethod
+  def _parse_line_index(cls, file_stats, content):
+    """Returns the line index of a file, or None if it has none.
+
+    Args:
+      file_stats: the GCSFileStat of the file.
+      content: the content of the .lines object of the file, or None.
+
+    Returns:
+      [lines between indexed lines, number of lines, size, offsets of the
+      indexed lines] if the file has an index for its current size.
+    """
+    if content is None:
+      return None
+    numbers = [int(number) for number in content.split()]
+    every, rows, size, offsets = numbers[0], numbers[1], numbers[2], numbers[3:]
+    if size != file_stats.st_size or not offsets:
+      logging.warning('%s of %s is out of date. Not using it.',
+                      cls.LINE_INDEX_SUFFIX, file_stats.filename)
+      return None
+    return [every, rows, size, offsets]
+
+  @staticmethod
+  def _line_position(line_index, row):
+    """Returns the range position at which to cut a file before a line.
+
+    The position is that of the newline before the indexed line, since a
+    range reads the lines that start strictly after its start position.
+
+    Args:
+      line_index: the line index of the file.
+      row: 0, the number of lines, or a multiple of the lines between indexed
+        lines.
+    """
+    every, rows, size, offsets = line_index
+    if row <= 0:
+      return 0
+    if row >= rows:
+      return size
+    return offsets[row // every] - 1
+
+  @staticmethod
+  def _line_row(line_index, position):
+    """Returns the number of lines before a position from _line_position."""
+    every, rows, size, offsets = line_index
+    if position <= 0:
+      return 0
+    if position >= size:
+      return rows
+    return every * bisect.bisect_left(offsets, position + 1)
+
+  @classmethod
+  def _is_gzip(cls, file_name):
+    """Whether a file is read as gzip."""
+    return file_name.endswith(cls.GZIP_SUFFIX)
+
+  @classmethod
+  def _parse_members(cls, file_stats, content):
+    """Returns the member offsets of a gzip file, or [] if they are not known.
+
+    Args:
+      file_stats: the GCSFileStat of the file.
+      content: the content of the .members object of the file, or None.
+
+    Raises:
+      BadReaderParamsError: if there is no .members object for a file of more
+        than _MAX_GZIP_SIZE_WITHOUT_MEMBERS bytes.
+    """
+    if content is None:
+      if file_stats.st_size > cls._MAX_GZIP_SIZE_WITHOUT_MEMBERS:
+        raise errors.BadReaderParamsError(
+            'No %s for %s of %s bytes. Gzip files of more than %s bytes '
+            'need one, see tools/gzip_blocks.py.' %
+            (cls.MEMBERS_SUFFIX, file_stats.filename, file_stats.st_size,
+             cls._MAX_GZIP_SIZE_WITHOUT_MEMBERS))
+      logging.warning('No %s for %s. The file will not be split, and each '
+                      'slice decompresses it again up to where it resumes.',
+                      cls.MEMBERS_SUFFIX, file_stats.filename)
+      return []
+    return [int(line) for line in content.split()]
+
+  @classmethod
+  def _plan_ranges(cls, ranges_to_plan, shard_count, split_points=None):
+    """Splits a list of byte ranges into shards of about the same size.
+
+    Ranges are taken in order. A shard takes the rest of the current range if
+    it fits, and a part of it otherwise, until it has its share of the bytes.
+    The ranges do not need to be cut at line boundaries, the reader of a range
+    only reads the lines that start in it.
+
+    Args:
+      ranges_to_plan: list of [file name, start position, end position] ranges
+        with at least one byte in all.
+      shard_count: the maximum number of shards.
+      split_points: dict of the sorted lists of the only positions at which
+        the ranges of a file may be cut, by file name. Ranges of the files that
+        are not in it are cut anywhere. A range that would be cut between
+        two points is cut at the next one instead.
+
+    Returns:
+      A list of at most shard_count non empty lists of
+      [file name, start position, end position] ranges.
+    """
+    total_size = sum(end - start for _, start, end in ranges_to_plan)
+    shard_size = max(1, (total_size + shard_count - 1) // shard_count)
+    shards = []
+    ranges = []
+    room = shard_size
+    for file_name, position, end in ranges_to_plan:
+      points = (split_points or {}).get(file_name)
+      while position < end:
+        end_position = min(end, position + room)
+        if points is not None and end_position < end:
+          index = bisect.bisect_left(points, end_position)
+          end_position = min(end, points[index]) if index < len(points) else end
+        ranges.append([file_name, position, end_position])
+        room -= end_position - position
+        position = end_position
+        if room <= 0:
+          shards.append(ranges)
+          ranges = []
+          room = shard_size
+    if ranges:
+      shards.append(ranges)
+    return shards
+
+  @staticmethod
+  def _for_ranges(by_file_name, ranges):
+    """Returns the entries of a dict by file name for the files of ranges."""
+    return dict((file_name, by_file_name[file_name])
+                for file_name, _, _ in ranges if file_name in by_file_name)
+
+  def _remaining_size(self):
+    """Returns the number of bytes left to this reader."""
+    size = max(0, self._end_position - self._file_reader.tell())
+    return size + sum(end - start for _, start, end in self._ranges)
+
+  def _buffered_size(self):
+    """Returns the number of bytes left in the buffer of the current file."""
+    return self._file_reader.buffered()
+
+  def _prefetched_size(self):
+    """Returns the number of bytes requested after the buffer of the file."""
+    return self._file_reader.prefetched()
+
+  def _stop_prefetch(self):
+    """Stops prefetching in the current file and in the files opened later."""
+    self._prefetch_stopped = True
+    self._file_reader.stop_prefetch()
+
+  def _split_remaining(self):
+    """Gives the second half of the bytes left to a new reader."""
+    position = self._file_reader.tell()
+    if position < self._end_position:
+      remaining = ([[self._file_name, position, self._end_position]] +
+                   self._ranges)
+    else:
+      # Whatever is left of the current range stays with this reader.
+      remaining = self._ranges
+    if sum(end - start for _, start, end in remaining) < self._MIN_SPLIT_SIZE:
+      return None
+    split_points = dict((file_name, self._members.get(file_name, []))
+                        for file_name, _, _ in remaining
+                        if self._is_gzip(file_name))
+    plan = self._plan_ranges(remaining, 2, split_points)
+    if len(plan) < 2:
+      return None
+    kept, given = plan
+    if position < self._end_position:
+      # The first range kept starts where this reader is.
+      self._end_position = kept[0][2]
+      if self._is_gzip(self._file_name):
+        self._file_reader.end_position = self._end_position
+      self._ranges = kept[1:]
+    else:
+      self._ranges = kept
+    file_name, start_position, end_position = given[0]
+    return self.__class__(file_name, start_position, end_position,
+                          buffer_size=self._buffer_size,
+                          prefetch=self._prefetch,
+                          delimiter=self._delimiter,
+                          account_id=self._account_id,
+                          lines_per_block=self._lines_per_block,
+                          ranges=given[1:],
+                          file_stats=self._for_ranges(self._file_stats, given),
+                          members=self._for_ranges(self._members, given))
+
   def to_json(self):
     """Returns an json-compatible input shard spec for remaining inputs."""
     new_pos = self._file_reader.tell()
-    if self._has_iterated:
+    skip = 0
+    if self._is_gzip(self._file_name):
+      skip = self._file_reader.skip()
+    elif self._has_iterated:
       new_pos -= 1
     return {self.OBJECT_NAMES_PARAM: self._file_name,
         self.INITIAL_POSITION_PARAM: new_pos,
-        self.END_POSITION_PARAM: self._end_position}
+        self.SKIP_PARAM: skip,
+        self.END_POSITION_PARAM: self._end_position,
+        self.BUFFER_SIZE_PARAM: self._buffer_size,
+        self.PREFETCH_PARAM: self._prefetch,
+        self.DELIMITER_PARAM: self._delimiter,
+        self._ACCOUNT_ID_PARAM: self._account_id,
+        self.LINES_PER_BLOCK_PARAM: self._lines_per_block,
+        self.RANGES_PARAM: self._ranges,
+        self.FILE_STATS_PARAM: self._for_ranges(
+            self._file_stats,
+            [[self._file_name, None, None]] + self._ranges),
+        self.MEMBERS_PARAM: self._for_ranges(
+            self._members,
+            [[self._file_name, None, None]] + self._ranges),
+        self.PLANNED_ROWS_PARAM: self._planned_rows}
 
   def __str__(self):
     """Returns the string representation of this LineInputReader."""
@@ -2715,11 +3432,23 @@ class GoogleCloudStorageLineInputReader(InputReader):
     """Instantiates an instance of this InputReader for the given shard spec."""
     return cls(json[cls.OBJECT_NAMES_PARAM],
            json[cls.INITIAL_POSITION_PARAM],
-           json[cls.END_POSITION_PARAM])
+           json[cls.END_POSITION_PARAM],
+           buffer_size=json.get(cls.BUFFER_SIZE_PARAM),
+           prefetch=json.get(cls.PREFETCH_PARAM),
+           delimiter=json.get(cls.DELIMITER_PARAM),
+           account_id=json.get(cls._ACCOUNT_ID_PARAM),
+           lines_per_block=json.get(cls.LINES_PER_BLOCK_PARAM),
+           ranges=json.get(cls.RANGES_PARAM),
+           file_stats=json.get(cls.FILE_STATS_PARAM),
+           members=json.get(cls.MEMBERS_PARAM),
+           skip=json.get(cls.SKIP_PARAM),
+           planned_rows=json.get(cls.PLANNED_ROWS_PARAM))
 
   # pylint: disable=too-many-arguments
   def __init__(self, file_name, start_position, end_position,
-               buffer_size=None, delimiter=None, account_id=None):
+               buffer_size=None, delimiter=None, account_id=None,
+               lines_per_block=None, ranges=None, file_stats=None,
+               prefetch=None, members=None, skip=None, planned_rows=None):
     """Initializes this instance with the given file name and character range.
     This GoogleCloudStorageLineInputReader will read from the first record
     starting strictly after start_position until the first record ending at or
@@ -2733,21 +3462,51 @@ class GoogleCloudStorageLineInputReader(InputReader):
       delimiter: The delimiter is used as a path separator to designate
       directory hierarchy.
       account_id: internal use
+      lines_per_block: if set, return blocks of up to this many lines.
+      ranges: list of [file name, start position, end position] ranges to
+        read the same way after this one.
+      file_stats: dict of the [size, etag] of the files by file name. Files
+        with a known size are opened without a HEAD request.
+      prefetch: number of buffers the GCS reader requests ahead.
+      members: dict of the member offsets of the gzip files by file name.
+      skip: decompressed bytes to skip at start_position in a gzip file.
+      planned_rows: lines of the ranges to add to io-total-rows.
     """
-    self._file_name = file_name
+    self._lines_per_block = lines_per_block
     self._buffer_size = buffer_size
+    self._prefetch = prefetch
     self._account_id = account_id
     self._delimiter = delimiter
+    self._ranges = list(ranges or [])
+    self._file_stats = file_stats or {}
+    self._members = members or {}
+    self._planned_rows = planned_rows or 0
+    self._prefetch_stopped = False
+    try:
+      self._open(file_name, start_position, end_position, skip or 0)
+    except StopIteration:
+      self._next_range()
+
+  def _open(self, file_name, start_position, end_position, skip=0):
+    """Opens the file of a range at the start of the range.
+
+    A gzip file is opened at the member offset start_position, and skip
+    decompressed bytes of the member are skipped.
+    """
+    self._file_name = file_name
     self._start_position = start_position
-    options = {}
+    options = {'offset': start_position}
+    if file_name in self._file_stats:
+      options['file_size'], options['etag'] = self._file_stats[file_name]
     if self._buffer_size:
       options['read_buffer_size'] = self._buffer_size
+    if self._prefetch:
+      options['prefetch'] = self._prefetch
     if self._account_id:
       options['_account_id'] = self._account_id
     try:
       # pylint: disable=star-args
       self._file_reader = cloudstorage.open(file_name, **options)
-      self._file_reader.seek(start_position)
     except cloudstorage.NotFoundError:
       logging.warning('File %s may have been removed. Skipping file.',
             file_name)
@@ -2755,9 +3514,54 @@ class GoogleCloudStorageLineInputReader(InputReader):
     self._end_position = end_position
     self._has_iterated = False
     self._read_before_start = bool(start_position)
+    if self._is_gzip(file_name):
+      self._file_reader = _GzipLineReader(self._file_reader, start_position,
+                                          end_position, skip)
+      self._read_before_start = False
+    if self._prefetch_stopped:
+      self._file_reader.stop_prefetch()
+
+  def _next_range(self):
+    """Moves on to the next range that can be opened.
+
+    Raises:
+      StopIteration: if there are no ranges left.
+    """
+    while self._ranges:
+      try:
+        self._open(*self._ranges.pop(0))
+        return
+      except StopIteration:
+        pass
+    raise StopIteration()
 
   def next(self):
-    """Returns the next input from as an (( file_name, offset), line) tuple."""
+    """Returns the next input from as an (( file_name, offset), line) tuple.
+
+    In block mode the next input is a ((file_name, offset), [line, ...]) tuple
+    where offset is the position of the first line of the block. A block ends
+    early at the end of the range, so the position of the reader after a block
+    is always the start of the next unread line.
+    """
+    ctx = context.get()
+    if ctx and self._planned_rows:
+      operation.counters.Increment(COUNTER_IO_TOTAL_ROWS,
+                                   self._planned_rows)(ctx)
+      self._planned_rows = 0
+    while True:
+      try:
+        position, lines = self._next_in_range()
+        break
+      except StopIteration:
+        self._next_range()
+    if ctx:
+      operation.counters.Increment(
+          COUNTER_IO_READ_ROWS,
+          len(lines) if self._lines_per_block else 1)(ctx)
+    return position, lines
+
+  def _next_in_range(self):
+    """Returns the next input from the current range."""
     self._has_iterated = True
     if self._read_before_start:
       self._file_reader.readline()
@@ -2765,6 +3569,19 @@ class GoogleCloudStorageLineInputReader(InputReader):
     start_position = self._file_reader.tell()
     if start_position > self._end_position:
       raise StopIteration()
+    if self._lines_per_block and self._is_gzip(self._file_name):
+      # The gzip reader stops at the end position itself.
+      lines = self._file_reader.readlines(self._lines_per_block)
+      if not lines:
+        raise StopIteration()
+      return (self._file_name, start_position), lines
+    if self._lines_per_block:
+      # Lines that start at or before the end position belong to this range.
+      lines = self._file_reader.readlines(
+          self._lines_per_block, self._end_position - start_position + 1)
+      if not lines:
+        raise StopIteration()
+      return (self._file_name, start_position), lines
     line = self._file_reader.readline()
     if not line:
       raise StopIteration()
@@ -2822,6 +3639,47 @@ class _GoogleCloudStorageRecordInputReader(_GoogleCloudStorageInputReader):
 
 GoogleCloudStorageRecordInputReader = _GoogleCloudStorageRecordInputReader
 
+# JRW added class below
+
+class GoogleCloudStorageRowInputReader(_GoogleCloudStorageRecordInputReader):
+  """Input reader for rows precompiled into LevelDB format files.
+
+  The files are written by tools/compile_rows.py. The first record of a file is
+  the marshalled tuple of the names of its columns, and every other record is
+  the marshalled tuple of a block of rows, each a tuple of the cleaned values
+  of the columns with None for the empty ones. Files are not split across
+  shards, see GoogleCloudStorageInputReader for the configuration. The rows
+  read are counted in io-read-rows.
+
+  Outputs:
+    ((File name, column names), [row, ...])
+  """
+
+  # Rows per record of the files written by tools/compile_rows.py, which is
+  # the number of rows per output.
+  ROWS_PER_RECORD = 100
+
+  def next(self):
+    """Returns the next block of rows from this input reader.
+
+    Raises:
+      StopIteration: all the files have been read.
+    """
+    while True:
+      content = super(GoogleCloudStorageRowInputReader, self).next()
+      # The first record of a file is the only one that ends right after its
+      # record header. The record reader is made again when a slice resumes,
+      # so it can not tell.
+      if self._cur_handle.tell() == records._HEADER_LENGTH + len(content):
+        self._columns = marshal.loads(content)
+        continue
+      rows = marshal.loads(content)
+      ctx = context.get()
+      if ctx:
+        operation.counters.Increment(COUNTER_IO_READ_ROWS, len(rows))(ctx)
+      return (self._cur_handle.name, self._columns), list(rows)
+# JRW added class above
+
 
 class _ReducerReader(_GoogleCloudStorageRecordInputReader):
   """Reader to read KeyValues records from GCS."""
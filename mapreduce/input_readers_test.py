@@ -0,0 +1,416 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the GCS line reader of input_readers.py."""
+
+import gzip
+import random
+import StringIO
+import unittest
+
+import cloudstorage
+from cloudstorage import storage_api
+from mapreduce import input_readers
+
+
+class PlanRangesTest(unittest.TestCase):
+  """Tests for GoogleCloudStorageLineInputReader._plan_ranges."""
+
+  def plan(self, ranges, shard_count, split_points=None):
+    return input_readers.GoogleCloudStorageLineInputReader._plan_ranges(
+        ranges, shard_count, split_points)
+
+  def assertCovers(self, ranges, shards):
+    """Asserts that shards are ranges cut in order, without gaps or overlaps."""
+    planned = [r for shard in shards for r in shard]
+    for shard in shards:
+      self.assertTrue(shard)
+    for file_name, start, end in ranges:
+      position = start
+      while position < end:
+        self.assertEqual(file_name, planned[0][0])
+        self.assertEqual(position, planned[0][1])
+        self.assertTrue(position < planned[0][2] <= end)
+        position = planned.pop(0)[2]
+    self.assertEqual([], planned)
+
+  def testEvenSplit(self):
+    self.assertEqual([[["a", 0, 50]], [["a", 50, 100]], [["b", 0, 50]]],
+                     self.plan([["a", 0, 100], ["b", 0, 50]], 3))
+
+  def testShardsTakeSeveralFiles(self):
+    self.assertEqual([[["a", 0, 30], ["b", 0, 20]],
+                      [["b", 20, 30], ["c", 0, 40]]],
+                     self.plan([["a", 0, 30], ["b", 0, 30], ["c", 0, 40]], 2))
+
+  def testMoreShardsThanBytes(self):
+    self.assertEqual([[["a", 0, 1]], [["a", 1, 2]], [["a", 2, 3]]],
+                     self.plan([["a", 0, 3]], 10))
+
+  def testSplitPoints(self):
+    self.assertEqual([[["a", 0, 40]], [["a", 40, 90]], [["a", 90, 100]]],
+                     self.plan([["a", 0, 100]], 4, {"a": [0, 40, 90]}))
+    self.assertEqual([[["a", 0, 100]], [["b", 0, 25]], [["b", 25, 50]]],
+                     self.plan([["a", 0, 100], ["b", 0, 50]], 6,
+                               {"a": [0, 100]}))
+
+  def testRandomRanges(self):
+    rnd = random.Random(2018)
+    for _ in range(200):
+      ranges = []
+      for i in range(rnd.randint(1, 5)):
+        name = "file%d" % i
+        start = rnd.randint(0, 1000)
+        end = start + rnd.randint(1, 10000)
+        ranges.append([name, start, end])
+      shard_count = rnd.randint(1, 30)
+      shards = self.plan(ranges, shard_count)
+      self.assertTrue(len(shards) <= shard_count)
+      self.assertCovers(ranges, shards)
+      sizes = [sum(end - start for _, start, end in shard) for shard in shards]
+      # Every shard but the last has the same share of the bytes.
+      self.assertEqual(set([sizes[0]]), set(sizes[:-1] or sizes))
+      self.assertTrue(sizes[-1] <= sizes[0])
+
+
+  def testRandomSplitPoints(self):
+    rnd = random.Random(2018)
+    for _ in range(200):
+      ranges = []
+      split_points = {}
+      for i in range(rnd.randint(1, 5)):
+        name = "file%d" % i
+        start = rnd.randint(0, 1000)
+        end = start + rnd.randint(10, 10000)
+        ranges.append([name, start, end])
+        if rnd.random() < 0.5:
+          split_points[name] = sorted(rnd.sample(xrange(start, end), 5))
+      shard_count = rnd.randint(1, 30)
+      shards = self.plan(ranges, shard_count, split_points)
+      self.assertTrue(len(shards) <= shard_count)
+      self.assertCovers(ranges, shards)
+      ends = dict((name, end) for name, _, end in ranges)
+      for shard in shards:
+        for name, _, end in shard:
+          if name in split_points and end != ends[name]:
+            self.assertTrue(end in split_points[name])
+
+
+def _gzip_members(chunks):
+  """Returns chunks gzipped as one member each, and the member offsets."""
+  data = []
+  offsets = []
+  size = 0
+  for chunk in chunks:
+    member = StringIO.StringIO()
+    gzip_file = gzip.GzipFile(fileobj=member, mode="wb")
+    gzip_file.write(chunk)
+    gzip_file.close()
+    offsets.append(size)
+    data.append(member.getvalue())
+    size += len(data[-1])
+  return "".join(data), offsets
+
+
+class _FakeFileReader(object):
+  """Reads a string from an offset like a cloudstorage ReadBuffer."""
+
+  def __init__(self, content, offset):
+    self._file = StringIO.StringIO(content)
+    self._file.seek(offset)
+
+  def read(self, size):
+    return self._file.read(size)
+
+
+class GzipLineReaderTest(unittest.TestCase):
+  """Tests for _GzipLineReader."""
+
+  def setUp(self):
+    rnd = random.Random(2018)
+    self.lines = ["line %d %s\n" % (i, "x" * rnd.randint(0, 100))
+                  for i in range(2000)]
+    self.text = "".join(self.lines)
+    # Members cut in the middle of lines.
+    cuts = sorted(rnd.sample(xrange(1, len(self.text)), 20))
+    self.data, self.offsets = _gzip_members(
+        [self.text[start:end]
+         for start, end in zip([0] + cuts, cuts + [len(self.text)])])
+    # Members of whole lines.
+    self.block_data, self.block_offsets = _gzip_members(
+        ["".join(self.lines[i:i + 150]) for i in range(0, 2000, 150)])
+
+  def reader(self, data, offset=0, end_position=None, skip=0):
+    if end_position is None:
+      end_position = len(data)
+    return input_readers._GzipLineReader(_FakeFileReader(data, offset), offset,
+                                         end_position, skip)
+
+  def readlines(self, reader):
+    lines = []
+    while True:
+      line = reader.readline()
+      if not line:
+        return lines
+      lines.append(line)
+
+  def testReadline(self):
+    self.assertEqual(self.lines, self.readlines(self.reader(self.data)))
+
+  def testReadlines(self):
+    for max_lines in (-1, 1, 7, 500):
+      reader = self.reader(self.data)
+      lines = []
+      while True:
+        block = reader.readlines(max_lines)
+        if not block:
+          break
+        lines.extend(line + "\n" for line in block)
+      self.assertEqual(self.lines, lines)
+
+  def testTellAndSkip(self):
+    reader = self.reader(self.data)
+    for i in range(len(self.lines)):
+      if i % 97 == 0:
+        restored = self.reader(self.data, reader.tell(), skip=reader.skip())
+        self.assertEqual(self.lines[i:], self.readlines(restored))
+      self.assertTrue(reader.tell() in self.offsets)
+      reader.readline()
+    self.assertEqual("", reader.readline())
+
+  def testRangesAtMemberOffsets(self):
+    ends = self.block_offsets[1:] + [len(self.block_data)]
+    lines = []
+    for start, end in zip(self.block_offsets, ends):
+      lines.extend(self.readlines(self.reader(self.block_data, start, end)))
+    self.assertEqual(self.lines, lines)
+
+    middle = self.block_offsets[5]
+    lines = self.readlines(self.reader(self.block_data, 0, middle))
+    self.assertEqual(self.lines[:750], lines)
+    lines = self.readlines(self.reader(self.block_data, middle))
+    self.assertEqual(self.lines[750:], lines)
+
+  def testEndPositionInsideMember(self):
+    # The lines that start in the members before end_position are read, even
+    # the last one, which ends in the next member.
+    member_end = len(gzip.GzipFile(
+        fileobj=StringIO.StringIO(self.data[:self.offsets[11]])).read())
+    expected = []
+    start = 0
+    for line in self.lines:
+      if start >= member_end:
+        break
+      expected.append(line)
+      start += len(line)
+    self.assertEqual(expected, self.readlines(
+        self.reader(self.data, 0, self.offsets[10] + 1)))
+
+
+class _FakeFuture(object):
+  """A finished future of a segment."""
+
+  def __init__(self, content):
+    self._content = content
+
+  def done(self):
+    return True
+
+  def get_result(self):
+    return self._content
+
+
+class _FakeReadBuffer(storage_api.ReadBuffer):
+  """A ReadBuffer that reads from a string instead of GCS."""
+
+  def __init__(self, content, file_name, offset=0, read_buffer_size=100,
+               **_):
+    self._content = content
+    super(_FakeReadBuffer, self).__init__(
+        None, file_name, buffer_size=read_buffer_size, offset=offset,
+        file_size=len(content), etag="etag")
+
+  def _get_segment(self, start, request_size, check_response=True):
+    return _FakeFuture(self._content[start:start + request_size])
+
+
+class BlockModeTest(unittest.TestCase):
+  """Tests for GoogleCloudStorageLineInputReader with lines_per_block."""
+
+  def setUp(self):
+    rnd = random.Random(2018)
+    self.lines = ["line %d %s" % (i, "x" * rnd.randint(0, 60))
+                  for i in range(300)]
+    self.content = "\n".join(self.lines) + "\n"
+    self._open = cloudstorage.open
+    cloudstorage.open = lambda file_name, **options: _FakeReadBuffer(
+        self.content, file_name, **options)
+
+  def tearDown(self):
+    cloudstorage.open = self._open
+
+  def reader(self, start, end, lines_per_block=7):
+    return input_readers.GoogleCloudStorageLineInputReader(
+        "/bucket/file", start, end, lines_per_block=lines_per_block)
+
+  def blocks(self, reader):
+    blocks = []
+    while True:
+      try:
+        blocks.append(reader.next())
+      except StopIteration:
+        return blocks
+
+  def testBlocksOfShards(self):
+    ends = sorted(random.Random(2018).sample(xrange(1, len(self.content)), 9))
+    lines = []
+    for start, end in zip([0] + ends, ends + [len(self.content)]):
+      for (file_name, offset), block in self.blocks(self.reader(start, end)):
+        self.assertEqual("/bucket/file", file_name)
+        self.assertTrue(1 <= len(block) <= 7)
+        self.assertTrue(offset <= end)
+        self.assertEqual(block[0] + "\n", self.content[offset:offset +
+                                                        len(block[0]) + 1])
+        lines.extend(block)
+    self.assertEqual(self.lines, lines)
+
+  def testBlocksMatchLines(self):
+    lines = [line for _, line in self.blocks(self.reader(
+        0, len(self.content), None))]
+    self.assertEqual(lines, self.read_all(self.reader(0, len(self.content))))
+
+  def read_all(self, reader):
+    return sum([block for _, block in self.blocks(reader)], [])
+
+  def testResumeFromJson(self):
+    expected = self.read_all(self.reader(100, 5000))
+    reader = self.reader(100, 5000)
+    lines = []
+    while True:
+      restored = input_readers.GoogleCloudStorageLineInputReader.from_json(
+          reader.to_json())
+      self.assertEqual(expected, lines + self.read_all(restored))
+      try:
+        lines.extend(reader.next()[1])
+      except StopIteration:
+        break
+    self.assertEqual(expected, lines)
+
+
+class _FakeMemcache(object):
+  """A dict standing in for memcache."""
+
+  def __init__(self):
+    self.store = {}
+
+  def get(self, key):
+    return self.store.get(key)
+
+  def get_multi(self, keys):
+    return dict((key, self.store[key]) for key in keys if key in self.store)
+
+  def set(self, key, value, time=0):
+    self.store[key] = value
+    return True
+
+  def set_multi(self, mapping, time=0):
+    self.store.update(mapping)
+    return []
+
+
+def _file_stat(filename, is_dir=False):
+  return cloudstorage.GCSFileStat(filename, len(filename), "etag-" + filename,
+                                  1.5, is_dir=is_dir)
+
+
+class ListingTest(unittest.TestCase):
+  """Tests for how GoogleCloudStorageLineInputReader lists its files."""
+
+  def setUp(self):
+    self.reader_class = input_readers.GoogleCloudStorageLineInputReader
+    self._memcache = input_readers.memcache
+    self._listbucket = cloudstorage.listbucket
+    self._stat_multi = cloudstorage.stat_multi
+    input_readers.memcache = _FakeMemcache()
+    cloudstorage.stat_multi = lambda paths, _account_id=None: [None] * len(
+        paths)
+    self._class_attributes = dict(
+        (name, self.reader_class.__dict__[name])
+        for name in ("_LISTING_CHUNK_SIZE", "_LIST_CONCURRENCY",
+                     "_list_prefix"))
+    self.reader_class._LISTING_CHUNK_SIZE = 50
+
+  def tearDown(self):
+    input_readers.memcache = self._memcache
+    cloudstorage.listbucket = self._listbucket
+    cloudstorage.stat_multi = self._stat_multi
+    for name, value in self._class_attributes.iteritems():
+      setattr(self.reader_class, name, value)
+
+  def assertSameStats(self, expected, actual):
+    self.assertEqual(
+        [(s.filename, s.st_size, s.etag, s.st_ctime) for s in expected],
+        [(s.filename, s.st_size, s.etag, s.st_ctime) for s in actual])
+
+  def testCachedListing(self):
+    listing = [_file_stat("/bucket/file%d" % i) for i in range(30)]
+    self.reader_class._set_cached_listing("key", listing, 60)
+    # The listing is stored in several chunks.
+    self.assertTrue(len(input_readers.memcache.store) > 2)
+    self.assertSameStats(listing,
+                         self.reader_class._get_cached_listing("key"))
+    self.assertEqual(None, self.reader_class._get_cached_listing("other"))
+
+  def testCachedListingWithMissingChunk(self):
+    listing = [_file_stat("/bucket/file%d" % i) for i in range(30)]
+    self.reader_class._set_cached_listing("key", listing, 60)
+    chunk_key = [key for key in input_readers.memcache.store if key != "key"][0]
+    del input_readers.memcache.store[chunk_key]
+    self.assertEqual(None, self.reader_class._get_cached_listing("key"))
+
+  def testListFilesFromCache(self):
+    calls = []
+    def list_prefix(path_prefix, delimiter, account_id):
+      calls.append(path_prefix)
+      return [_file_stat(path_prefix + "a"), _file_stat(path_prefix + "b")]
+    self.reader_class._list_prefix = staticmethod(list_prefix)
+    first = self.reader_class._list_files("bucket", ["dir/*"], None, None, 60)
+    second = self.reader_class._list_files("bucket", ["dir/*"], None, None, 60)
+    self.assertEqual(["/bucket/dir/"], calls)
+    self.assertSameStats(first, second)
+    self.reader_class._list_files("bucket", ["dir/*"], None, None, None)
+    self.assertEqual(["/bucket/dir/", "/bucket/dir/"], calls)
+
+  def testListPrefixListsDirectoriesTogether(self):
+    listings = {
+        "/b/p": [_file_stat("/b/p/z"), _file_stat("/b/p/d1/", True),
+                 _file_stat("/b/p/d2/", True), _file_stat("/b/p/d3/", True)],
+        "/b/p/d1/": [_file_stat("/b/p/d1/y")],
+        "/b/p/d2/": [_file_stat("/b/p/d2/x"), _file_stat("/b/p/d2/e/w")],
+        "/b/p/d3/": []}
+    def listbucket(path_prefix, delimiter=None, _account_id=None):
+      self.assertEqual(delimiter, "/" if path_prefix == "/b/p" else None)
+      return iter(listings[path_prefix])
+    cloudstorage.listbucket = listbucket
+    self.reader_class._LIST_CONCURRENCY = 2
+    self.assertEqual(
+        ["/b/p/d1/y", "/b/p/d2/e/w", "/b/p/d2/x", "/b/p/z"],
+        [file_stats.filename
+         for file_stats in self.reader_class._list_prefix("/b/p", None, None)])
+
+
+if __name__ == "__main__":
+  unittest.main()
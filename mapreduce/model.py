@@ -885,6 +885,11 @@ class ShardState(db.Model):
     writer_state: writer state for this shard. The shard's output writer
       instance can save in-memory output references to this field in its
       "finalize" method.
+    input_remaining: the amount of input left to this shard as reported by
+      its input reader at the end of the last slice, or None if unknown.
+    split_request: the number of an idle shard the controller asked this
+      shard to give half of its remaining input to, or None. See
+      handlers.ControllerCallbackHandler._request_splits.
 
    Properties about slice management:
     slice_id: slice id of current executing slice. A slice's task
@@ -938,6 +943,8 @@ class ShardState(db.Model):
   slice_request_id = db.ByteStringProperty(indexed=False)
   slice_retries = db.IntegerProperty(default=0, indexed=False)
   acquired_once = db.BooleanProperty(default=False, indexed=False)
+  input_remaining = db.IntegerProperty(indexed=False)
+  split_request = db.IntegerProperty(indexed=False)
 
   # For UI purposes only.
   update_time = db.DateTimeProperty(auto_now=True, indexed=False)
@@ -984,6 +991,24 @@ class ShardState(db.Model):
     self.slice_retries = 0
     self.acquired_once = False
 
+  def reset_for_split(self):
+    """Reset a successfully finished self to read input split from a shard.
+
+    Counters are kept so that they add up over all the inputs of the shard.
+    The slice id is advanced so that tasks from before are dropped.
+    """
+    self.last_work_item = ""
+    self.active = True
+    self.result_status = None
+    self.input_finished = False
+    self.input_remaining = None
+    self.split_request = None
+    self.slice_id += 1
+    self.slice_start_time = None
+    self.slice_request_id = None
+    self.slice_retries = 0
+    self.acquired_once = False
+
   def advance_for_next_slice(self, recovery_slice=False):
     """Advance self for next slice.
 
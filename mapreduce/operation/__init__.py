@@ -26,6 +26,7 @@ on recieving from handler function.
 # These are all relative imports.
 import db
 import counters
+import search
 from base import Operation
 
-__all__ = ['db', 'counters', 'Operation']
+__all__ = ['db', 'counters', 'search', 'Operation']
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#
+# Copyright 2010 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Search API related operations."""
+
+
+
+__all__ = ['Put']
+
+
+from mapreduce.operation import base
+
+# pylint: disable=protected-access
+
+
+class Put(base.Operation):
+  """Put document into a search index via search_pool.
+
+  See mapreduce.context._SearchPool.
+  """
+
+  def __init__(self, document, index_name, namespace=None):
+    """Constructor.
+
+    Args:
+      document: a search.Document to put.
+      index_name: name of the index to put the document in.
+      namespace: namespace of the index. None for the current namespace.
+    """
+    self.document = document
+    self.index_name = index_name
+    self.namespace = namespace
+
+  def __call__(self, context):
+    """Perform operation.
+
+    Args:
+      context: mapreduce context as context.Context.
+    """
+    context._search_pool.put(self.document, self.index_name, self.namespace)
@@ -216,9 +216,25 @@ class _ConfigDefaults(object):
   # scheduled as soon as current one takes this long.
   _SLICE_DURATION_SEC = 15
 
+  # A slice may end up to this many seconds before _SLICE_DURATION_SEC when
+  # the input reader has used up its read buffer, so that the next slice does
+  # not fetch the rest of the buffer again. The input reader stops prefetching
+  # for the same reason.
+  _SLICE_BUFFER_GRACE_SEC = 3
+
   # Delay between consecutive controller callback invocations.
   _CONTROLLER_PERIOD_SEC = 2
 
+  # In jobs with the work_stealing mapper parameter, a shard with more than
+  # this many times the median remaining input of the running shards gives
+  # half of its remaining input to a shard that has finished.
+  _STRAGGLER_FACTOR = 2
+
+  # Shards with less remaining input than this are never asked to split, the
+  # split would cost more than it saves. In the unit of the input reader's
+  # _remaining_size, bytes for the GoogleCloudStorageLineInputReader.
+  _STRAGGLER_MIN_REMAINING = 8 * 1024 * 1024
+
 
 # TODO(user): changes this name to app_config
 config = lib_config.register(CONFIG_NAMESPACE, _ConfigDefaults.__dict__)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""Job-wide adaptive control of the processing rate."""
+
+__all__ = ["ADAPTIVE_RATE_PARAM",
+           "get_rate",
+           "report"]
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.ext import db
+from mapreduce import parameters
+
+
+# pylint: disable=protected-access
+# pylint: disable=g-bad-name
+
+
+# Mapper parameter that turns the adaptive rate on. processing_rate is then
+# only the rate the job starts at.
+ADAPTIVE_RATE_PARAM = "adaptive_rate"
+
+# Share of the starting rate added to the job rate per slice duration while
+# the shards run at their limit without being throttled.
+_RATE_INCREASE = 0.05
+
+# Factor the job rate is cut by when a shard was throttled.
+_RATE_DECREASE = 0.5
+
+# The job rate is not cut below this many map calls per second.
+_MIN_RATE = 1.0
+
+# Number of compare and set attempts on the memcache rate before giving up.
+_CAS_ATTEMPTS = 3
+
+# Seconds a job rate is kept in memcache after its last change.
+_MEMCACHE_TIME = 24 * 60 * 60
+
+
+class _JobRate(db.Model):
+  """The rate of a job, for when memcache loses or can not hold it.
+
+  Stored with the mapreduce id as key name. Written when the rate is cut, so
+  that a job does not go back to a rate that was throttled when memcache
+  loses the rate or fails.
+
+  Properties:
+    rate: the job rate in map calls per second.
+    decreased: time.time() of the last cut of the rate, 0 if none.
+  """
+
+  rate = db.FloatProperty(indexed=False)
+  decreased = db.FloatProperty(indexed=False, default=0.0)
+
+
+def _memcache_key(spec):
+  return "GAE-MR-rate: %s" % spec.mapreduce_id
+
+
+def _initial_state(spec):
+  """Returns the [rate, decreased] the job starts with or was saved with."""
+  job_rate = _JobRate.get_by_key_name(spec.mapreduce_id)
+  if job_rate is not None:
+    return [job_rate.rate, job_rate.decreased]
+  return [float(spec.mapper.params.get("processing_rate", 0)), 0.0]
+
+
+def get_rate(spec):
+  """Gets the current processing rate of a job.
+
+  Args:
+    spec: model.MapreduceSpec of a job with ADAPTIVE_RATE_PARAM set.
+
+  Returns:
+    The job-wide rate in map calls per second.
+  """
+  key = _memcache_key(spec)
+  state = memcache.get(key)
+  if state is None:
+    state = _initial_state(spec)
+    memcache.add(key, state, time=_MEMCACHE_TIME)
+  return state[0]
+
+
+def report(spec, throttled, limited):
+  """Adjusts the rate of a job to what a shard saw in its last slice.
+
+  The rate is increased additively when the shard ran at its limit and was
+  not throttled, and cut multiplicatively when it was throttled, but at most
+  once per slice duration, since all the shards see the same throttling.
+
+  Args:
+    spec: model.MapreduceSpec of a job with ADAPTIVE_RATE_PARAM set.
+    throttled: number of documents of the slice that failed transiently.
+    limited: whether the slice stopped at its processing limit.
+  """
+  if not throttled and not limited:
+    return
+  now = time.time()
+  key = _memcache_key(spec)
+  client = memcache.Client()
+  for _ in range(_CAS_ATTEMPTS):
+    state = client.gets(key)
+    if state is None:
+      # Start over from the saved or the starting rate.
+      client.add(key, _initial_state(spec), time=_MEMCACHE_TIME)
+      continue
+    new_state = _adjust(spec, state, throttled, now)
+    if new_state is None:
+      return
+    if client.cas(key, new_state, time=_MEMCACHE_TIME):
+      if throttled:
+        _save(spec, new_state)
+      return
+  if throttled:
+    # memcache is down or too contended, keep at least the cut.
+    new_state = _adjust(spec, _initial_state(spec), throttled, now)
+    if new_state is not None:
+      _save(spec, new_state)
+
+
+def _save(spec, state):
+  _JobRate(key_name=spec.mapreduce_id, rate=state[0],
+           decreased=state[1]).put()
+
+
+def _adjust(spec, state, throttled, now):
+  """Returns the next [rate, decreased] of a job, or None to keep state."""
+  rate, decreased = state
+  slice_duration = parameters.config._SLICE_DURATION_SEC
+  if throttled:
+    if now - decreased < slice_duration:
+      return None
+    return [max(_MIN_RATE, rate * _RATE_DECREASE), now]
+  initial_rate = float(spec.mapper.params.get("processing_rate", 0))
+  # Every shard reports once per slice duration, so each adds its share.
+  return [rate + initial_rate * _RATE_INCREASE /
+          int(spec.mapper.shard_count), decreased]
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script measures how many rows per second of a harvest file the indexer can turn
+# into row values, comparing the per-line dict(zip(HEADER, ...)) and get_rec_dict path
+# with field_utils.decode_row. It needs only the harvest file, not the App Engine SDK.
+#
+# Example:
+#
+# python bench_decode_row.py ../../harvest/processed/mvz_mammals.tsv 100000
+
+__author__ = "John Wieczorek"
+__contributors__ = "Aaron Steele, John Wieczorek"
+__copyright__ = "Copyright 2018 vertnet.org"
+__version__ = "bench_decode_row.py 2018-04-07T19:30-3:00"
+
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from field_utils import decode_row, index_fields
+
+HEADER = index_fields()
+
+def get_rec_dict(rec):
+    """The per-line cleaning the indexer did before decode_row."""
+    val = {}
+    for name, value in rec.iteritems():
+        if value:
+            val[name] = re.sub('[\v\t\r\n]+', ' ', value).strip(' ')
+    return val
+
+def zip_dict_rows(rows):
+    for row in rows:
+        data = get_rec_dict(dict(zip(HEADER, row.split('\t'))))
+        map(data.get, HEADER)
+
+def decode_rows(rows):
+    for row in rows:
+        decode_row(row, HEADER)
+
+def rows_per_second(parse, rows, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        parse(rows)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return len(rows) / best
+
+def main():
+    if len(sys.argv) < 2:
+        print 'Usage: python bench_decode_row.py <harvest file> [max rows]'
+        return 1
+    max_rows = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    rows = []
+    with open(sys.argv[1]) as harvest_file:
+        for line in harvest_file:
+            rows.append(line.rstrip('\n'))
+            if max_rows is not None and len(rows) >= max_rows:
+                break
+    if not rows:
+        print 'No rows in %s' % sys.argv[1]
+        return 1
+
+    for row in rows:
+        if decode_row(row, HEADER)[1] != get_rec_dict(dict(zip(HEADER, row.split('\t')))):
+            print 'decode_row differs from get_rec_dict on row:\n%s' % row
+            return 1
+
+    before = rows_per_second(zip_dict_rows, rows)
+    after = rows_per_second(decode_rows, rows)
+    print 'Rows: %s' % len(rows)
+    print 'zip/dict/get_rec_dict: %.0f rows/sec' % before
+    print 'decode_row:            %.0f rows/sec' % after
+    print 'Speedup:               %.2fx' % (after / before)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script precompiles a harvest file for the indexer. The lines are split and 
+# cleaned once with field_utils.decode_row and written in the LevelDB records format of 
+# the mapreduce library to <file>-00000.rows, <file>-00001.rows, ... with up to 
+# ROWS_PER_FILE rows each, since files are not split across shards. The first record of
+# a file is the tuple of the column names, and every other record is a block of 
+# ROWS_PER_RECORD rows, all marshalled. Copy the files to a prefix of their own in the 
+# bucket and index them with &precompiled=1. Reindexing them into a new namespace does
+# not parse the harvest file again. Compile the files again after a change of the index
+# fields.
+#
+# Example:
+#
+# python compile_rows.py ../../harvest/processed/mvz_mammals.tsv
+# gsutil cp ../../harvest/processed/mvz_mammals.tsv-*.rows gs://vertnet-harvesting/compiled/
+
+__author__ = "John Wieczorek"
+__contributors__ = "Aaron Steele, John Wieczorek"
+__copyright__ = "Copyright 2018 vertnet.org"
+__version__ = "compile_rows.py 2018-04-23T10:20-3:00"
+
+import marshal
+import os
+import sys
+from itertools import islice
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from field_utils import decode_row, index_fields
+from mapreduce import records
+
+HEADER = index_fields()
+# Rows per record, which is the block of rows the mapper is called with. IndexGcsPath
+# converts processing_rate with GoogleCloudStorageRowInputReader.ROWS_PER_RECORD, keep
+# them the same.
+ROWS_PER_RECORD = 100
+# Rows per file. A file is read by a single shard.
+ROWS_PER_FILE = 100000
+
+def compile_rows(lines, out_file, rows_per_record=ROWS_PER_RECORD):
+    """
+    Writes the lines of a harvest file to out_file as records of precompiled rows.
+
+    parameters:
+        lines - iterator over the lines of the harvest file
+        out_file - file to write the records to
+        rows_per_record - rows per record
+    returns:
+        the number of rows written
+    """
+    writer = records.RecordsWriter(out_file)
+    writer.write(marshal.dumps(tuple(HEADER)))
+    count = 0
+    block = []
+    for line in lines:
+        values, _ = decode_row(line.rstrip('\r\n'), HEADER)
+        block.append(tuple(values))
+        if len(block) == rows_per_record:
+            writer.write(marshal.dumps(tuple(block)))
+            count += len(block)
+            block = []
+    if block:
+        writer.write(marshal.dumps(tuple(block)))
+        count += len(block)
+    return count
+
+def main():
+    if len(sys.argv) < 2:
+        print 'Usage: python compile_rows.py <harvest file> [rows per file]'
+        return 1
+    rows_per_file = int(sys.argv[2]) if len(sys.argv) > 2 else ROWS_PER_FILE
+    with open(sys.argv[1], 'rb') as in_file:
+        part = 0
+        count = 0
+        while True:
+            lines = list(islice(in_file, rows_per_file))
+            if not lines:
+                break
+            out_name = '%s-%05d.rows' % (sys.argv[1], part)
+            with open(out_name, 'wb') as out_file:
+                count += compile_rows(lines, out_file)
+            part += 1
+    print 'Wrote %s rows to %s files' % (count, part)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
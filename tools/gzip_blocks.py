@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script compresses a harvest file for the indexer into <file>.gz, a series of
+# gzip members of whole lines, and writes the offsets of the members one per line to
+# <file>.gz.members. Copy both to the bucket. The GoogleCloudStorageLineInputReader
+# splits the .gz file across shards at those offsets. Any gzip tool can decompress
+# the .gz file.
+#
+# Example:
+#
+# python gzip_blocks.py ../../harvest/processed/mvz_mammals.tsv
+# gsutil cp ../../harvest/processed/mvz_mammals.tsv.gz* gs://vertnet-harvesting/processed/
+
+__author__ = "John Wieczorek"
+__contributors__ = "Aaron Steele, John Wieczorek"
+__copyright__ = "Copyright 2018 vertnet.org"
+__version__ = "gzip_blocks.py 2018-04-21T14:10-3:00"
+
+import sys
+import zlib
+
+# Uncompressed bytes per member. Members are the smallest unit a file is split into, and
+# a slice decompresses at most one member again when it resumes.
+MEMBER_SIZE = 4 * 1024 * 1024
+
+def compress_member(lines):
+    """Returns the lines compressed as a gzip member."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(''.join(lines)) + compressor.flush()
+
+def gzip_blocks(in_file, out_file, member_size=MEMBER_SIZE):
+    """
+    Writes the lines of in_file to out_file as gzip members of about member_size bytes.
+
+    parameters:
+        in_file - file to read the lines from
+        out_file - file to write the members to
+        member_size - uncompressed bytes per member
+    returns:
+        the list of the offsets of the members in out_file
+    """
+    offsets = []
+    offset = 0
+    lines = []
+    size = 0
+    for line in in_file:
+        lines.append(line)
+        size += len(line)
+        if size >= member_size:
+            member = compress_member(lines)
+            out_file.write(member)
+            offsets.append(offset)
+            offset += len(member)
+            lines = []
+            size = 0
+    if lines:
+        out_file.write(compress_member(lines))
+        offsets.append(offset)
+    return offsets
+
+def main():
+    if len(sys.argv) < 2:
+        print 'Usage: python gzip_blocks.py <harvest file> [member size]'
+        return 1
+    member_size = int(sys.argv[2]) if len(sys.argv) > 2 else MEMBER_SIZE
+    out_name = sys.argv[1] + '.gz'
+    with open(sys.argv[1], 'rb') as in_file:
+        with open(out_name, 'wb') as out_file:
+            offsets = gzip_blocks(in_file, out_file, member_size)
+    with open(out_name + '.members', 'w') as members_file:
+        members_file.write(''.join('%s\n' % offset for offset in offsets))
+    print 'Wrote %s members to %s' % (len(offsets), out_name)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
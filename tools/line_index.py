@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# This script writes the line index <file>.lines of a harvest file in one pass over it.
+# The first line of the index has the number of lines between indexed lines, the number
+# of lines and the size of the file. The offsets of line 0, N, 2N, ... follow, one per
+# line. Copy the index next to the file in the bucket. The
+# GoogleCloudStorageLineInputReader then splits the file exactly at indexed lines, gives
+# the shards the same number of lines when all files have an index, and counts the lines
+# read out of the total. An index is ignored once the size of its file changes.
+#
+# Example:
+#
+# python line_index.py ../../harvest/processed/mvz_mammals.tsv
+# gsutil cp ../../harvest/processed/mvz_mammals.tsv.lines gs://vertnet-harvesting/processed/
+
+__author__ = "John Wieczorek"
+__contributors__ = "Aaron Steele, John Wieczorek"
+__copyright__ = "Copyright 2018 vertnet.org"
+__version__ = "line_index.py 2018-04-22T11:40-3:00"
+
+import sys
+
+# Lines between indexed lines. Files are cut only at indexed lines.
+LINES_PER_ENTRY = 1000
+
+def line_index(in_file, every=LINES_PER_ENTRY):
+    """
+    Indexes the lines of a file.
+
+    parameters:
+        in_file - file to index, read from its start
+        every - lines between indexed lines
+    returns:
+        (number of lines, size of the file, offsets of lines 0, every, 2 * every, ...)
+    """
+    offsets = []
+    rows = 0
+    offset = 0
+    for line in in_file:
+        if rows % every == 0:
+            offsets.append(offset)
+        rows += 1
+        offset += len(line)
+    return rows, offset, offsets
+
+def main():
+    if len(sys.argv) < 2:
+        print 'Usage: python line_index.py <harvest file> [lines per entry]'
+        return 1
+    every = int(sys.argv[2]) if len(sys.argv) > 2 else LINES_PER_ENTRY
+    with open(sys.argv[1], 'rb') as in_file:
+        rows, size, offsets = line_index(in_file, every)
+    with open(sys.argv[1] + '.lines', 'w') as index_file:
+        index_file.write('%s %s %s\n' % (every, rows, size))
+        index_file.write(''.join('%s\n' % offset for offset in offsets))
+    print 'Indexed %s lines of %s' % (rows, sys.argv[1])
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())